@@ -1,4 +1,9 @@
+import multiprocessing as mp
 import os
+import shutil
+import signal
+import time
+from multiprocessing.connection import Connection
 
 from app import codeql, definitions, emitter, infer, utilities, values
 from app.equivalence.cluster import ClusterManager
@@ -11,6 +16,28 @@ def config_program():
     utilities.execute_command(values.CONF_COMMAND_CONFIG)
 
 
+def record_compilation_database():
+    """
+    Build the program once, recording the compile commands into a compilation
+    database that both codeql and Infer are run on.
+    """
+    os.chdir(values.CONF_DIR_SRC_BUILD)
+
+    # first clean the build
+    utilities.execute_command(values.CONF_COMMAND_CLEAN)
+    if os.path.isfile(values.FILE_COMPILE_COMMANDS):
+        os.remove(values.FILE_COMPILE_COMMANDS)
+
+    cmd = "bear --output " + values.FILE_COMPILE_COMMANDS + " -- "
+    cmd += values.CONF_COMMAND_BUILD_PROJECT
+    utilities.execute_command(cmd)
+
+    if not os.path.isfile(values.FILE_COMPILE_COMMANDS):
+        utilities.error_exit(
+            "Recording the build did not produce a compilation database."
+        )
+
+
 def pre_analyze():
     emitter.title("Pre-analyzing Program")
 
@@ -20,6 +47,17 @@ def pre_analyze():
     config_program()
     utilities.global_timer.stop(definitions.DURATION_CONFIG_PROG)
 
+    # (1-1) build only once; later steps use the recorded compile commands
+    if values.USE_COMPILATION_DATABASE:
+        utilities.global_timer.start(definitions.DURATION_RECORD_COMPILE_COMMANDS)
+        emitter.sub_title("Building Target Program, recording compile commands")
+        record_compilation_database()
+        utilities.global_timer.stop(definitions.DURATION_RECORD_COMPILE_COMMANDS)
+
+    if values.CONCURRENT_PRE:
+        build_concurrently()
+        return
+
     # NOTE: must run Infer last, since we want to preserve the built artifacts
     # for later stage
 
@@ -36,6 +74,81 @@ def pre_analyze():
     utilities.global_timer.stop(definitions.DURATION_INFER_DETECTION)
 
 
+def create_db_in_process(src_dir: str, send_conn: Connection):
+    """
+    Runs in a separate process: build the codeql database from the given source tree.
+    Sends the time spent back.
+    """
+    # a process group of its own, so that codeql and its JVM can be killed with it
+    os.setpgid(0, 0)
+    time_start = time.perf_counter()
+    values.CONF_DIR_SRC = src_dir
+    values.CONF_DIR_SRC_BUILD = os.path.join(src_dir, values.CONF_BUILD_DIR)
+    codeql.create_db()
+    send_conn.send(time.perf_counter() - time_start)
+
+
+def build_concurrently():
+    """
+    Build the codeql database and run Infer on the whole program at the same time.
+    If they build the program, each does it in its own copy of the (configured)
+    source tree. The original tree is the one Infer builds, since its artifacts are
+    used by the repair stage; the copy for codeql is removed afterwards.
+    With a compilation database, the program has been built already, and both work
+    on the original tree.
+    """
+    num_cpus = os.cpu_count() or 2
+    values.CODEQL_THREADS = max(1, num_cpus // 2)
+    values.INFER_JOBS = max(1, num_cpus - values.CODEQL_THREADS)
+
+    if values.USE_COMPILATION_DATABASE:
+        src_dir = values.CONF_DIR_SRC
+    else:
+        emitter.sub_title("Copying source tree for generating codeql database")
+        src_dir = os.path.join(values.DIR_RUNTIME_PRE, "codeql-src")
+        utilities.remove_dir_if_exists(src_dir)
+        shutil.copytree(values.CONF_DIR_SRC, src_dir, symlinks=True)
+
+    emitter.sub_title(
+        f"Generating codeql database ({values.CODEQL_THREADS} threads) and running "
+        f"Infer on Whole Program ({values.INFER_JOBS} jobs) concurrently"
+    )
+    # fork, so that the child inherits configurations
+    ctx = mp.get_context("fork")
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=create_db_in_process, args=(src_dir, send_conn))
+    process.start()
+    send_conn.close()
+    # also set in the parent, in case it has to kill the group before the child runs
+    try:
+        os.setpgid(process.pid, process.pid)
+    except OSError:
+        pass
+
+    try:
+        utilities.global_timer.start(definitions.DURATION_INFER_DETECTION)
+        infer.infer_whole_program()
+        utilities.global_timer.stop(definitions.DURATION_INFER_DETECTION)
+        process.join()
+        elapsed = recv_conn.recv()
+    except BaseException as e:
+        # also on Ctrl-C and termination, leave no codeql process behind
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.join()
+        if src_dir != values.CONF_DIR_SRC:
+            utilities.remove_dir_if_exists(src_dir)
+        if isinstance(e, EOFError):
+            utilities.error_exit("Generating codeql database failed.")
+        raise
+    utilities.global_timer.accumulate(definitions.DURATION_CODEQL_CAPTURE, elapsed)
+    utilities.global_timer.print_and_return(definitions.DURATION_CODEQL_CAPTURE)
+    if src_dir != values.CONF_DIR_SRC:
+        utilities.remove_dir_if_exists(src_dir)
+
+
 def analyze():
     emitter.title("Analyzing Program for Repair")
 
@@ -57,6 +170,20 @@ def analyze():
 
     assert values.TARGET_BUG is not None
 
+    # (1-1) run the codeql queries that do not depend on fix locations, in one batch
+    utilities.global_timer.start(definitions.DURATION_CODEQL_FUNC_QUERIES)
+    emitter.information(
+        "[Codeql] Running localization and patch ingredient (return stmts, labels) queries"
+    )
+    filter_query = localizer.cfg_filter_query(values.TARGET_BUG)
+    return_stmts_query = codeql.return_stmts_query(values.TARGET_BUG.procedure)
+    labels_query = codeql.labels_query(values.TARGET_BUG.procedure)
+    queries = [return_stmts_query, labels_query]
+    if filter_query is not None:
+        queries.append(filter_query)
+    codeql.run_query_batch(queries)
+    utilities.global_timer.stop(definitions.DURATION_CODEQL_FUNC_QUERIES)
+
     # (2) get fix locations
     utilities.global_timer.start(definitions.DURATION_LOCALIZATION)
     emitter.sub_title("Performing fix localization")
@@ -67,7 +194,10 @@ def analyze():
 
     assert summary_json_path is not None
 
-    fix_loc_lines = localizer.localize(summary_json_path, values.TARGET_BUG)
+    filter_res_file = filter_query[1] if filter_query is not None else None
+    fix_loc_lines = localizer.localize(
+        summary_json_path, values.TARGET_BUG, filter_res_file
+    )
     if not fix_loc_lines:
         utilities.error_exit("No fix locations found.")
 
@@ -79,20 +209,12 @@ def analyze():
     emitter.information("Target bug signature: " + str(values.TARGET_BUG_SIG))
 
     # (3) get patch ingredients that are idependent of fix location
-    utilities.global_timer.start(definitions.DURATION_CODEQL_RETURN_STMTS)
-    emitter.information("[Codeql] Running patch ingredient (return stmts) query")
-    codeql.run_return_stmts_query(values.TARGET_BUG.procedure)
-    return_stmts = codeql.parse_return_stmts_query_result()
+    return_stmts = codeql.parse_return_stmts_query_result(return_stmts_query[1])
     emitter.highlight("Return statements: " + str(return_stmts))
     result.returns(return_stmts)
-    utilities.global_timer.stop(definitions.DURATION_CODEQL_RETURN_STMTS)
 
-    utilities.global_timer.start(definitions.DURATION_CODEQL_LABELS)
-    emitter.information("[Codeql] Running patch ingredient (labels) query")
-    codeql.run_labels_query(values.TARGET_BUG.procedure)
-    labels = codeql.parse_labels_query_result()
+    labels = codeql.parse_labels_query_result(labels_query[1])
     emitter.highlight("Labels: " + str(labels))
     result.labels(labels)
-    utilities.global_timer.stop(definitions.DURATION_CODEQL_LABELS)
 
     return fix_loc_lines, return_stmts, labels
@@ -3,23 +3,61 @@ Handles all calls to codeql.
 """
 
 import csv
+import glob
+import hashlib
+import json
 import os
+import shlex
 import shutil
+import tempfile
 from collections.abc import Mapping
 
-from app import definitions, utilities, values
+from app import definitions, emitter, utilities, values
+
+
+def write_compile_commands_script(script_path: str):
+    """
+    Write a shell script replaying the compile commands in the compilation database,
+    values.CODEQL_THREADS of them at a time.
+    """
+    with open(values.FILE_COMPILE_COMMANDS) as f:
+        entries = json.load(f)
+
+    lines = ["#!/bin/sh"]
+    for index, entry in enumerate(entries):
+        if "arguments" in entry:
+            command = shlex.join(entry["arguments"])
+        else:
+            command = entry["command"]
+        lines.append(f"(cd {shlex.quote(entry['directory'])} && {command}) &")
+        if (index + 1) % values.CODEQL_THREADS == 0:
+            lines.append("wait")
+    if lines[-1] != "wait":
+        lines.append("wait")
+
+    with open(script_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
 
 
 def create_db():
     """
     Create codeql database for the target program source code.
+    With a compilation database, codeql traces the recorded compile commands,
+    instead of a clean build of the whole program.
     """
     os.chdir(values.CONF_DIR_SRC_BUILD)
 
     utilities.remove_dir_if_exists(values.DIR_CODEQL_DB)
 
-    # first clean the build
-    utilities.execute_command(values.CONF_COMMAND_CLEAN)
+    if values.USE_COMPILATION_DATABASE:
+        script_path = os.path.join(values.DIR_RUNTIME_PRE, "compile_commands.sh")
+        write_compile_commands_script(script_path)
+        build_command = "sh " + script_path
+    else:
+        # first clean the build
+        utilities.execute_command(values.CONF_COMMAND_CLEAN)
+        build_command = values.CONF_COMMAND_BUILD_PROJECT
+
     # then run
     cmd_list = [
         "codeql",
@@ -27,30 +65,40 @@ def create_db():
         "create",
         values.DIR_CODEQL_DB,
         "--language=cpp",
-        "--threads=32",
+        "--threads=" + str(values.CODEQL_THREADS),
     ]
 
     cmd = " ".join(cmd_list)
-    cmd += ' --command="' + values.CONF_COMMAND_BUILD_PROJECT + '"'
+    cmd += ' --command="' + build_command + '"'
     utilities.execute_command(cmd)
 
 
-def run_query_helper(
-    template_name: str, res_file_name: str, replace_dict: Mapping[str, str]
-):
-    """
-    Prepare, compile, and run a codeql query.
-    """
+# a query to run: (query file name, result file, parameters)
+QueryRequest = tuple[str, str, Mapping[str, str]]
 
-    if not values.DIR_CODEQL_DB or not os.path.isdir(values.DIR_CODEQL_DB):
-        utilities.error_exit("Codeql database not found.")
 
+def prepare_query_dir() -> str:
+    """
+    Create the directory where queries are placed, with the query pack installed.
+    Queries are copied only once, so that their compiled forms are reused by
+    later runs in the same runtime directory.
+    :return: path to the directory.
+    """
     codeql_query_dir = os.path.join(values.DIR_RUNTIME_REPAIR, "codeql-queries")
 
     # create query src dir in the runtime directory
     utilities.create_dir_if_nonexists(codeql_query_dir)
     real_qlpack_path = os.path.join(codeql_query_dir, "qlpack.yml")
     if not os.path.isfile(real_qlpack_path):
+        for query_src in glob.glob(
+            os.path.join(definitions.DIR_CODEQL_TEMPLATE, "*.ql*")
+        ):
+            shutil.copy(query_src, codeql_query_dir)
+        parameters_path = os.path.join(
+            codeql_query_dir, definitions.FNAME_CODEQL_PARAMETERS
+        )
+        utilities.create_dir_if_nonexists(os.path.dirname(parameters_path))
+        write_query_parameters(parameters_path, [])
         shutil.copy(
             os.path.join(definitions.DIR_CODEQL_SRC, "qlpack.yml"), real_qlpack_path
         )
@@ -58,74 +106,208 @@ def run_query_helper(
         os.chdir(codeql_query_dir)
         utilities.execute_command("codeql pack install")
 
-    # prepare query file
-    template_path = os.path.join(definitions.DIR_CODEQL_TEMPLATE, template_name)
-    real_query_path = os.path.join(codeql_query_dir, template_name)
+    return codeql_query_dir
+
+
+def write_query_parameters(parameters_path: str, queries: list[QueryRequest]):
+    """
+    Write the parameters of queries as a data extension; the index of a query in
+    the list is its instance.
+    """
+    rows = []
+    for instance, (query_name, _, parameters) in enumerate(queries):
+        query = os.path.splitext(query_name)[0]
+        rows.append([str(instance), definitions.PARAM_QUERY, query])
+        for key, value in parameters.items():
+            rows.append([str(instance), key, value])
+
+    # JSON strings are valid in YAML, and take care of quoting
+    lines = [
+        "extensions:",
+        "  - addsTo:",
+        "      pack: " + definitions.CODEQL_QUERY_PACK,
+        "      extensible: " + definitions.CODEQL_PARAMETER_PREDICATE,
+        "    data:" if rows else "    data: []",
+    ]
+    lines += ["      - " + json.dumps(row) for row in rows]
+    with open(parameters_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def get_db_fingerprint() -> str:
+    """
+    Fingerprint of the codeql database, which changes whenever it is created again.
+    """
+    hasher = hashlib.sha256()
+    db_yml_path = os.path.join(values.DIR_CODEQL_DB, "codeql-database.yml")
+    if os.path.isfile(db_yml_path):
+        with open(db_yml_path, "rb") as f:
+            hasher.update(f.read())
+        hasher.update(b"\0" + str(os.stat(db_yml_path).st_mtime_ns).encode())
+    return hasher.hexdigest()
+
+
+def get_query_cache_key(db_fingerprint: str, query: QueryRequest) -> str:
+    """
+    Key of the result cache entry of a query. Besides the parameters, the key covers
+    the database and the source of the query (and the library it imports).
+    """
+    query_name, _, parameters = query
+    hasher = hashlib.sha256(db_fingerprint.encode())
+    for query_src in [query_name, "parameters.qll"]:
+        with open(os.path.join(definitions.DIR_CODEQL_TEMPLATE, query_src), "rb") as f:
+            hasher.update(b"\0" + hashlib.sha256(f.read()).digest())
+    hasher.update(b"\0" + json.dumps(sorted(parameters.items())).encode())
+    return hasher.hexdigest()
+
+
+def lookup_query_cache(cache_key: str, res_file_name: str) -> bool:
+    """
+    :return: whether there is an entry; if so, it is copied to the result file.
+    """
+    cached_path = os.path.join(values.DIR_CODEQL_CACHE, cache_key + ".csv")
+    if not os.path.isfile(cached_path):
+        return False
+    shutil.copyfile(cached_path, res_file_name)
+    return True
+
+
+def store_query_cache(cache_key: str, res_file_name: str):
+    """
+    Store the result file of a query as a new entry, atomically.
+    """
+    os.makedirs(values.DIR_CODEQL_CACHE, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=values.DIR_CODEQL_CACHE, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(res_file_name, tmp_path)
+    os.replace(tmp_path, os.path.join(values.DIR_CODEQL_CACHE, cache_key + ".csv"))
 
-    shutil.copy(template_path, real_query_path)
 
-    # replace holder variable with real values
-    with open(real_query_path) as f:
-        query_src = f.read()
+def run_query_batch(queries: list[QueryRequest]):
+    """
+    Run several codeql queries, and put the result rows of each query in its result file.
+    Results are cached across repair runs, as long as the database stays the same;
+    only queries without cached results are run.
+    """
+    if not queries:
+        return
 
-    for key, value in replace_dict.items():
-        query_src = query_src.replace(key, value)
+    if not values.DIR_CODEQL_DB or not os.path.isdir(values.DIR_CODEQL_DB):
+        utilities.error_exit("Codeql database not found.")
+
+    if not values.USE_CODEQL_CACHE:
+        run_query_batch_uncached(queries)
+        return
+
+    db_fingerprint = get_db_fingerprint()
+    missed = []
+    for query in queries:
+        cache_key = get_query_cache_key(db_fingerprint, query)
+        if not lookup_query_cache(cache_key, query[1]):
+            missed.append((query, cache_key))
+
+    num_hits = len(queries) - len(missed)
+    if num_hits:
+        emitter.information(
+            f"[Codeql] Reusing cached results of {num_hits} out of {len(queries)} queries"
+        )
+    if not missed:
+        return
 
-    with open(real_query_path, "w") as f:
-        f.write(query_src)
+    run_query_batch_uncached([query for query, _ in missed])
+    for (_, res_file_name, _), cache_key in missed:
+        store_query_cache(cache_key, res_file_name)
 
-    # (optional) remove query compile cache, so that we have the correct timing
-    codeql_cache_dir = os.path.join(codeql_query_dir, ".cache")
-    utilities.remove_dir_if_exists(codeql_cache_dir)
 
-    # compile and run query
+def run_query_batch_uncached(queries: list[QueryRequest]):
+    """
+    Run several codeql queries with one `codeql database analyze`, so that the
+    database is opened only once. Each query file is evaluated once for all the
+    instances of it in the batch.
+    Result rows are split back into the result file of each query.
+    """
+    codeql_query_dir = prepare_query_dir()
+
+    write_query_parameters(
+        os.path.join(codeql_query_dir, definitions.FNAME_CODEQL_PARAMETERS), queries
+    )
+    query_paths = sorted(
+        {os.path.join(codeql_query_dir, query_name) for query_name, _, _ in queries}
+    )
+
+    if values.CODEQL_CLEAR_CACHE:
+        # force recompilation, so that timings include it (for benchmarking)
+        codeql_cache_dir = os.path.join(codeql_query_dir, ".cache")
+        utilities.remove_dir_if_exists(codeql_cache_dir)
+
+    # run queries; --rerun, since results for old parameters are cached in the database
+    batch_res_file = os.path.join(codeql_query_dir, "batch-results.csv")
+    if os.path.isfile(batch_res_file):
+        os.remove(batch_res_file)
     cmd_list = [
         "codeql",
         "database",
         "analyze",
         values.DIR_CODEQL_DB,
-        real_query_path,
+        *query_paths,
         "--format=csv",
         "--rerun",
-        "--output=" + res_file_name,
+        "--output=" + batch_res_file,
     ]
 
     cmd = " ".join(cmd_list)
     utilities.execute_command(cmd)
 
+    if not os.path.isfile(batch_res_file):
+        utilities.error_exit("Codeql query result not found.")
 
-def run_extract_var_query(file: str, func: str, trace_start: int, fix_loc: int):
+    # messages are tagged with the instance producing them: "<instance>|<message>"
+    instance_to_rows: list[list[list[str]]] = [[] for _ in queries]
+    with open(batch_res_file) as f:
+        csvreader = csv.reader(f)
+        for row in csvreader:
+            if len(row) < 4:
+                continue
+            instance, _, message = row[3].partition("|")
+            if not instance.isdigit() or int(instance) >= len(queries):
+                continue
+            row[3] = message
+            instance_to_rows[int(instance)].append(row)
+
+    for (_, res_file_name, _), rows in zip(queries, instance_to_rows):
+        with open(res_file_name, "w", newline="") as f:
+            csv.writer(f).writerows(rows)
+
+
+def extract_var_query(
+    file: str, func: str, trace_start: int, fix_loc: int
+) -> QueryRequest:
     """
-    Run a codeql query to get patch ingredients.
+    Query to get patch ingredients at a fix location.
     """
-
-    values.FILE_CODEQL_RES_EXTRACT_VAR = os.path.join(
-        values.DIR_RUNTIME_REPAIR, "codeql-res-ingredient.csv"
+    res_file_name = os.path.join(
+        values.DIR_RUNTIME_REPAIR, f"codeql-res-ingredient-L{fix_loc}.csv"
     )
 
     file_base_name = os.path.basename(file)
 
-    replace_dict = {
-        definitions.HOLDER_FILE: '"' + file_base_name + '"',
-        definitions.HOLDER_FUNC: '"' + func + '"',
-        definitions.HOLDER_START_LINE: str(trace_start),
-        definitions.HOLDER_FIX_LINE: str(fix_loc),
+    parameters = {
+        definitions.PARAM_FILE: file_base_name,
+        definitions.PARAM_FUNC: func,
+        definitions.PARAM_START_LINE: str(trace_start),
+        definitions.PARAM_FIX_LINE: str(fix_loc),
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_EXTRACT_VAR,
-        values.FILE_CODEQL_RES_EXTRACT_VAR,
-        replace_dict,
-    )
+    return definitions.FNAME_CODEQL_EXTRACT_VAR, res_file_name, parameters
 
 
-def parse_extract_var_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_EXTRACT_VAR):
+def parse_extract_var_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     all_vars = []
 
-    with open(values.FILE_CODEQL_RES_EXTRACT_VAR) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             vars_entry = row[3]
@@ -146,35 +328,31 @@ def parse_extract_var_query_result():
     return pointers, non_pointers
 
 
-def run_stmt_boundary_query(file_path: str, stmt_start_line: int):
+def stmt_boundary_query(file_path: str, stmt_start_line: int) -> QueryRequest:
     """
-    Run a codeql query to get boudary for the statement at stmt_start_line, in file file_path.
+    Query to get boudary for the statement at stmt_start_line, in file file_path.
     """
-
-    values.FILE_CODEQL_RES_STMT_BOUNDARY = os.path.join(
-        values.DIR_RUNTIME_REPAIR, "codeql-res-stmt-boundary.csv"
+    res_file_name = os.path.join(
+        values.DIR_RUNTIME_REPAIR,
+        f"codeql-res-stmt-boundary-L{stmt_start_line}.csv",
     )
 
     base_file_path = os.path.basename(file_path)
-    replace_dict = {
-        definitions.HOLDER_FILE: '"' + base_file_path + '"',
-        definitions.HOLDER_START_LINE: str(stmt_start_line),
+    parameters = {
+        definitions.PARAM_FILE: base_file_path,
+        definitions.PARAM_START_LINE: str(stmt_start_line),
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_STMT_BOUNDARY,
-        values.FILE_CODEQL_RES_STMT_BOUNDARY,
-        replace_dict,
-    )
+    return definitions.FNAME_CODEQL_STMT_BOUNDARY, res_file_name, parameters
 
 
-def parse_stmt_boudary_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_STMT_BOUNDARY):
+def parse_stmt_boudary_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     found_endlines = set()
 
-    with open(values.FILE_CODEQL_RES_STMT_BOUNDARY) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             line_info = row[3].split(":")
@@ -194,34 +372,29 @@ def parse_stmt_boudary_query_result():
     return found_endlines[0]
 
 
-def run_return_stmts_query(func: str):
+def return_stmts_query(func: str) -> QueryRequest:
     """
-    Run a codeql query to get all return stmts in the codebase,
+    Query to get all return stmts in the codebase,
     which has the same return type as the return type of `func`.
     """
-
-    values.FILE_CODEQL_RES_RETURN_STMTS = os.path.join(
+    res_file_name = os.path.join(
         values.DIR_RUNTIME_REPAIR, "codeql-res-return-stmts.csv"
     )
 
-    replace_dict = {
-        definitions.HOLDER_FUNC: '"' + func + '"',
+    parameters = {
+        definitions.PARAM_FUNC: func,
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_RETURN_STMTS,
-        values.FILE_CODEQL_RES_RETURN_STMTS,
-        replace_dict,
-    )
+    return definitions.FNAME_CODEQL_RETURN_STMTS, res_file_name, parameters
 
 
-def parse_return_stmts_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_RETURN_STMTS):
+def parse_return_stmts_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     return_stmts = []
 
-    with open(values.FILE_CODEQL_RES_RETURN_STMTS) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             return_stmts.append(row[3])
@@ -231,31 +404,26 @@ def parse_return_stmts_query_result():
     return return_stmts
 
 
-def run_labels_query(func: str):
+def labels_query(func: str) -> QueryRequest:
     """
-    Run a codeql query to get all labels in `func`.
+    Query to get all labels in `func`.
     """
+    res_file_name = os.path.join(values.DIR_RUNTIME_REPAIR, "codeql-res-labels.csv")
 
-    values.FILE_CODEQL_RES_LABELS = os.path.join(
-        values.DIR_RUNTIME_REPAIR, "codeql-res-labels.csv"
-    )
-
-    replace_dict = {
-        definitions.HOLDER_FUNC: '"' + func + '"',
+    parameters = {
+        definitions.PARAM_FUNC: func,
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_LABELS, values.FILE_CODEQL_RES_LABELS, replace_dict
-    )
+    return definitions.FNAME_CODEQL_LABELS, res_file_name, parameters
 
 
-def parse_labels_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_LABELS):
+def parse_labels_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     labels = []
 
-    with open(values.FILE_CODEQL_RES_LABELS) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             labels.append(row[3])
@@ -265,35 +433,28 @@ def parse_labels_query_result():
     return labels
 
 
-def run_loc_after_query(func: str, start_line: int, end_line: int):
+def loc_after_query(func: str, start_line: int, end_line: int) -> QueryRequest:
     """
-    Run a codeql query to get all lines after the start line and end line.
+    Query to get all lines after the start line and end line.
     "After" means this line is on any potential program path.
     """
+    res_file_name = os.path.join(values.DIR_RUNTIME_REPAIR, "codeql-res-loc-after.csv")
 
-    values.FILE_CODEQL_RES_LOC_AFTER = os.path.join(
-        values.DIR_RUNTIME_REPAIR, "codeql-res-loc-after.csv"
-    )
-
-    replace_dict = {
-        definitions.HOLDER_FUNC: '"' + func + '"',
-        definitions.HOLDER_START_LINE: str(start_line),
-        definitions.HOLDER_END_LINE: str(end_line),
+    parameters = {
+        definitions.PARAM_FUNC: func,
+        definitions.PARAM_START_LINE: str(start_line),
+        definitions.PARAM_END_LINE: str(end_line),
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_LOC_AFTER,
-        values.FILE_CODEQL_RES_LOC_AFTER,
-        replace_dict,
-    )
+    return definitions.FNAME_CODEQL_LOC_AFTER, res_file_name, parameters
 
 
-def parse_loc_after_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_LOC_AFTER):
+def parse_loc_after_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     all_locs = []
-    with open(values.FILE_CODEQL_RES_LOC_AFTER) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             loc_entry = row[3]
@@ -305,35 +466,30 @@ def parse_loc_after_query_result():
     return all_locs
 
 
-def run_loc_between_query(func: str, start_line: int, end_line: int):
+def loc_between_query(func: str, start_line: int, end_line: int) -> QueryRequest:
     """
-    Run a codeql query to get all lines between start and end line.
+    Query to get all lines between start and end line.
     "Between" means this line is on any potential program path.
     """
-
-    values.FILE_CODEQL_RES_LOC_BETWEEN = os.path.join(
+    res_file_name = os.path.join(
         values.DIR_RUNTIME_REPAIR, "codeql-res-loc-betweens.csv"
     )
 
-    replace_dict = {
-        definitions.HOLDER_FUNC: '"' + func + '"',
-        definitions.HOLDER_START_LINE: str(start_line),
-        definitions.HOLDER_END_LINE: str(end_line),
+    parameters = {
+        definitions.PARAM_FUNC: func,
+        definitions.PARAM_START_LINE: str(start_line),
+        definitions.PARAM_END_LINE: str(end_line),
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_LOC_BETWEEN,
-        values.FILE_CODEQL_RES_LOC_BETWEEN,
-        replace_dict,
-    )
+    return definitions.FNAME_CODEQL_LOC_BETWEEN, res_file_name, parameters
 
 
-def parse_loc_between_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_LOC_BETWEEN):
+def parse_loc_between_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     all_locs = []
-    with open(values.FILE_CODEQL_RES_LOC_BETWEEN) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             loc_entry = row[3]
@@ -345,36 +501,32 @@ def parse_loc_between_query_result():
     return all_locs
 
 
-def run_consts_query(file: str, func: str, fix_loc: int):
+def consts_query(file: str, func: str, fix_loc: int) -> QueryRequest:
     """
-    Run a codeql query to get constants in `func`.
+    Query to get constants in `func`.
     """
-    values.FILE_CODEQL_RES_CONSTS = os.path.join(
-        values.DIR_RUNTIME_REPAIR, "codeql-res-consts.csv"
+    res_file_name = os.path.join(
+        values.DIR_RUNTIME_REPAIR, f"codeql-res-consts-L{fix_loc}.csv"
     )
 
     file_base_name = os.path.basename(file)
 
-    replace_dict = {
-        definitions.HOLDER_FILE: '"' + file_base_name + '"',
-        definitions.HOLDER_FUNC: '"' + func + '"',
-        definitions.HOLDER_FIX_LINE: str(fix_loc),
+    parameters = {
+        definitions.PARAM_FILE: file_base_name,
+        definitions.PARAM_FUNC: func,
+        definitions.PARAM_FIX_LINE: str(fix_loc),
     }
 
-    run_query_helper(
-        definitions.FNAME_CODEQL_CONSTS,
-        values.FILE_CODEQL_RES_CONSTS,
-        replace_dict,
-    )
+    return definitions.FNAME_CODEQL_CONSTS, res_file_name, parameters
 
 
-def parse_consts_query_result():
-    if not os.path.isfile(values.FILE_CODEQL_RES_CONSTS):
+def parse_consts_query_result(res_file_name: str):
+    if not os.path.isfile(res_file_name):
         utilities.error_exit("Codeql query result not found.")
 
     all_consts = []
 
-    with open(values.FILE_CODEQL_RES_CONSTS) as f:
+    with open(res_file_name) as f:
         csvreader = csv.reader(f)
         for row in csvreader:
             consts_entry = row[3]
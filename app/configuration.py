@@ -25,6 +25,23 @@ def read_args():
         help="Pre-analysis or repair stage.",
     )
 
+    ### only for pre stage
+    parser.add_argument(
+        "--concurrent-pre",
+        default=False,
+        action="store_true",
+        help="[Pre] Build the codeql database from a copy of the source tree, at the "
+        "same time as Infer analyzes the original tree; the CPUs are split between them.",
+    )
+
+    parser.add_argument(
+        "--compilation-database",
+        default=False,
+        action="store_true",
+        help="[Pre] Build the program only once, recording the compile commands with "
+        "bear (3.x); codeql and Infer then work from the recorded commands.",
+    )
+
     ### only for repair stage
     parser.add_argument(
         "--budget", default=10, type=int, help="[Repair] Total time budget."
@@ -74,10 +91,75 @@ def read_args():
         help="Adjustment factor for small changes",
     )
 
+    parser.add_argument(
+        "--generation-engine",
+        default="random",
+        choices=["random", "best-first"],
+        help="[Repair] How patches are generated from the grammar. random: sample "
+        "according to the probabilities; best-first: enumerate patches from the most "
+        "probable one, without duplicates.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="[Repair] Number of workers evaluating patches in parallel. "
+        "Each worker uses its own copy of the source tree.",
+    )
+
+    parser.add_argument(
+        "--disable-summary-cache",
+        default=False,
+        action="store_true",
+        help="[Repair] Always run Infer on patched files, even if the same patched "
+        "file has been analyzed before (in this or a previous repair run).",
+    )
+
+    parser.add_argument(
+        "--disable-codeql-cache",
+        default=False,
+        action="store_true",
+        help="[Repair] Always run codeql queries, even if they have been run with the "
+        "same parameters on the same database in a previous repair run.",
+    )
+
+    parser.add_argument(
+        "--codeql-clear-cache",
+        default=False,
+        action="store_true",
+        help="[Repair] Clear the compilation cache of codeql queries before each run, "
+        "so that timings include compiling them (for benchmarking).",
+    )
+
+    parser.add_argument(
+        "--location-mode",
+        default="sequential",
+        choices=["sequential", "parallel", "adaptive"],
+        help="[Repair] How fix locations are repaired. sequential: one after another, "
+        "each with an equal share of the budget; parallel: all at the same time in "
+        "separate processes, each with the whole budget; adaptive: interleaved in "
+        "time slices, giving more time to locations with higher rewards.",
+    )
+
+    parser.add_argument(
+        "--time-slice",
+        default=60,
+        type=float,
+        help="[Repair] Length (in seconds) of one time slice in adaptive location mode.",
+    )
+
     parsed_args = parser.parse_args()
+    if parsed_args.workers < 1:
+        parser.error("--workers should be at least 1")
+    if parsed_args.time_slice <= 0:
+        parser.error("--time-slice should be positive")
+
     values.FILE_CONFIGURATION = parsed_args.config_file
     values.DEBUG = parsed_args.debug
     values.TOOL_STAGE = parsed_args.stage
+    values.CONCURRENT_PRE = parsed_args.concurrent_pre
+    values.USE_COMPILATION_DATABASE = parsed_args.compilation_database
     values.REPAIR_BUDGET = parsed_args.budget
     values.GENERATOR_MAX_DEPTH = parsed_args.max_depth
     values.ADJ_FACTOR_BIG = parsed_args.adj_factor_big
@@ -85,6 +167,13 @@ def read_args():
     values.LEARN_PROBABILITIES = not parsed_args.disable_learn_prob
     values.VALIDATE_GLOBAL = parsed_args.enable_validation
     values.IS_RESET_PROB = not parsed_args.disable_reset
+    values.GENERATION_ENGINE = parsed_args.generation_engine
+    values.NUM_WORKERS = parsed_args.workers
+    values.USE_SUMMARY_CACHE = not parsed_args.disable_summary_cache
+    values.USE_CODEQL_CACHE = not parsed_args.disable_codeql_cache
+    values.CODEQL_CLEAR_CACHE = parsed_args.codeql_clear_cache
+    values.LOCATION_MODE = parsed_args.location_mode
+    values.SCHEDULER_SLICE_LENGTH = parsed_args.time_slice
 
 
 def read_conf_file():
@@ -17,12 +17,18 @@ FNAME_CODEQL_LOC_AFTER = "loc_after.ql"
 FNAME_CODEQL_LOC_BETWEEN = "loc_between.ql"
 FNAME_CODEQL_CONSTS = "consts.ql"
 
-HOLDER_FILE = "HOLDER_FILE"
-HOLDER_FUNC = "HOLDER_FUNC"
-HOLDER_FILE = "HOLDER_FILE"
-HOLDER_START_LINE = "HOLDER_START_LINE"
-HOLDER_END_LINE = "HOLDER_END_LINE"
-HOLDER_FIX_LINE = "HOLDER_FIX_LINE"
+# queries read their parameters from this data extension
+FNAME_CODEQL_PARAMETERS = os.path.join("ext", "parameters.model.yml")
+CODEQL_QUERY_PACK = "efffix/codeql-cpp-queries"
+CODEQL_PARAMETER_PREDICATE = "queryParameter"
+
+# names of query parameters
+PARAM_QUERY = "query"
+PARAM_FILE = "file"
+PARAM_FUNC = "func"
+PARAM_START_LINE = "start_line"
+PARAM_END_LINE = "end_line"
+PARAM_FIX_LINE = "fix_line"
 
 
 # ----------- Supported bug types from Infer ------------
@@ -81,16 +87,15 @@ DURATION_TOTAL = "total-run-time"
 DURATION_PREANALYSIS = "pre-analysis"
 DURATION_CONFIG_PROG = "config"
 DURATION_INFER_DETECTION = "infer-detect"
+DURATION_RECORD_COMPILE_COMMANDS = "record-compile-commands"
 DURATION_CODEQL_CAPTURE = "codeql-build-db"
 
 # analysis in repair
 DURATION_ANALYSIS = "analysis"
 DURATION_LOCALIZATION = "localize"
-DURATION_CODEQL_STMT_BOUNDARY = "codeql-get-stmt-boundary"
-DURATION_CODEQL_EXTRACT_VAR = "codeql-get-ingredients-variables"
-DURATION_CODEQL_RETURN_STMTS = "codeql-get-return-stmts"
-DURATION_CODEQL_LABELS = "codeql-get-labels"
-DURATION_CODEQL_CONSTS = "codeql-get-consts"
+# codeql queries are run in batches
+DURATION_CODEQL_FUNC_QUERIES = "codeql-function-queries"
+DURATION_CODEQL_LOC_QUERIES = "codeql-location-queries"
 
 # repair
 DURATION_REPAIR = "total-repair"
@@ -1,14 +1,14 @@
 import hashlib
-import json
 import os
 import shutil
+from collections import Counter
 from enum import Enum
 from pprint import pformat
 
 from app import definitions, emitter, utilities, values
 from app.equivalence.smt import SmtFormula
 from app.parsing.parse_report import PulseBug
-from app.parsing.parse_summary import PulseDisjunctParser
+from app.parsing.parse_summary import PulseDisjunctParser, iter_summary_disjuncts
 from app.result import result
 
 
@@ -578,6 +578,19 @@ class PatchSignature:
 
         self.signatures = updated_signatures
 
+    def get_bucket_key(self) -> frozenset:
+        """
+        Cheap invariant of `is_equal`: the multiset of (label, allocated, deallocated)
+        of the disjuncts. Disjuncts of a signature are merged whenever they are equal,
+        so two equal signatures match disjunct for disjunct, and have the same key.
+        Formulas are not part of the key, as equivalent formulas can differ in form.
+        """
+        return frozenset(
+            Counter(
+                (sig.label, sig.allocated, sig.deallocated) for sig in self.signatures
+            ).items()
+        )
+
     def is_equal(self, other):
         if not isinstance(other, PatchSignature):
             return False
@@ -604,7 +617,9 @@ class PatchSignature:
 class Cluster:
     def __init__(self, cluster_name: str, sig: PatchSignature, all_patches_dir: str):
         self.cluster_name: str = cluster_name
-        self.sig: PatchSignature = sig
+        # None in a cluster sent from another process; see __getstate__
+        self.sig: PatchSignature | None = sig
+        self.sig_text: str | None = None
         # (patch_file_path, patch_size)
         self.patches: list[tuple[str, int]] = []
         # keep track whether this cluster is locally good
@@ -629,6 +644,7 @@ class Cluster:
     def compute_rewards_and_local_goodness(self):
         assert values.TARGET_BUG is not None
         assert values.TARGET_BUG_SIG is not None
+        assert self.sig is not None, "Signature of a cluster from another process"
 
         this_sig_list: list[DisjunctSignature] = self.sig.signatures
         target_sig_list: list[DisjunctSignature] = values.TARGET_BUG_SIG.signatures
@@ -662,6 +678,23 @@ class Cluster:
     def get_num_patches(self):
         return len(self.patches)
 
+    def __getstate__(self):
+        """
+        Formulas in the signature belong to the pysmt environment of the process
+        that created them, so only the textual form of the signature is kept when
+        a cluster is sent to another process.
+        """
+        state = self.__dict__.copy()
+        state["sig"] = None
+        state["sig_text"] = self.get_sig_text()
+        return state
+
+    def get_sig_text(self) -> str:
+        if self.sig is None:
+            assert self.sig_text is not None
+            return self.sig_text
+        return str(self.sig)
+
     def __str__(self):
         ret = self.cluster_name + " : "
         if self.is_locally_good:
@@ -670,7 +703,7 @@ class Cluster:
             ret += "BAD, "
         ret += f"pe_incre: {self.pe_increment}" + ", "
         ret += f"ppie_incre: {self.ppie_increment}" + ", "
-        ret += str(self.sig) + " =>\n[\n"
+        ret += self.get_sig_text() + " =>\n[\n"
         for path, size in self.patches:
             if self.is_locally_good:
                 ret += "\tPlausible Patch: " + path + " (size:" + str(size) + "),\n"
@@ -693,6 +726,9 @@ class ClusterManager:
         # instead of using a dict, we use a list of tuples
         # [ ..., (PatchSignature, [patch_file_paths]), ... ]
         self.clusters: list[Cluster] = []
+        # indices of clusters, by the bucket key of their signatures; only clusters
+        # in the same bucket can have equal signatures
+        self.cluster_buckets: dict[frozenset, list[int]] = dict()
         # a special cluster for non-compilable patches( List[str] )
         self.noncompilable_cluster = []
 
@@ -701,12 +737,9 @@ class ClusterManager:
         """
         Helper method.
         """
-        with open(infer_summary_file_path) as f:
-            infer_summary_json = json.load(f)
-
         patch_signature = PatchSignature()
 
-        for disjunct_json in infer_summary_json:
+        for disjunct_json in iter_summary_disjuncts(infer_summary_file_path):
             parser = PulseDisjunctParser(disjunct_json)
             (
                 label_text,
@@ -727,8 +760,8 @@ class ClusterManager:
 
     def add_new_noncompilable_patch(self, patch_file_path):
         noncomp_dir = os.path.join(self.patch_dir, "non-compilable")
-        if not os.path.isdir(noncomp_dir):
-            os.makedirs(noncomp_dir)
+        # other processes may be creating it at the same time
+        os.makedirs(noncomp_dir, exist_ok=True)
         shutil.move(patch_file_path, noncomp_dir)
         new_file_path = os.path.join(noncomp_dir, os.path.basename(patch_file_path))
         self.noncompilable_cluster.append(new_file_path)
@@ -746,9 +779,13 @@ class ClusterManager:
         )
         utilities.global_timer.pause(definitions.DURATION_PATCH_SIGN_GEN)
         # put patch signature into one of the clusters
+        bucket_key = patch_signature.get_bucket_key()
+        bucket = self.cluster_buckets.setdefault(bucket_key, [])
         matched_cluster_idx = -1
-        for idx, cluster in enumerate(self.clusters):
-            if cluster.sig.is_equal(patch_signature):
+        for idx in bucket:
+            cluster_sig = self.clusters[idx].sig
+            assert cluster_sig is not None, "Adding to clusters from another process"
+            if cluster_sig.is_equal(patch_signature):
                 matched_cluster_idx = idx
                 break
 
@@ -766,6 +803,7 @@ class ClusterManager:
             # when creating a new cluster, compute how probability should be updated
             new_cluster.compute_rewards_and_local_goodness()
             # done; add this cluster to our collection
+            bucket.append(len(self.clusters))
             self.clusters.append(new_cluster)
             final_cluster = new_cluster
         else:
@@ -0,0 +1,196 @@
+"""
+Projection of logical variables out of the conjunctive linear integer formulas
+Pulse produces, without going through a solver.
+Equalities are used to substitute variables away, and remaining variables are
+eliminated from inequalities with Fourier-Motzkin. Only steps that are exact over
+integers are taken; anything else is left to the caller (e.g. to `qelim`).
+"""
+
+from pysmt.shortcuts import FALSE, TRUE, And, Not
+
+from app.equivalence import smt
+
+# a constraint is (map from symbol to coefficient, constant, kind), meaning
+# sum(coefficient * symbol) + constant <= 0 / = 0 / != 0
+LE = "le"
+EQ = "eq"
+NE = "ne"
+
+# give up when Fourier-Motzkin produces more constraints than this
+MAX_CONSTRAINTS = 200
+
+
+def to_constraint(atom) -> tuple[dict, int, str] | None:
+    """
+    :return: the constraint of a linear atom (possibly negated), or None if it is not one.
+    """
+    is_negated = atom.is_not()
+    if is_negated:
+        atom = atom.arg(0)
+    is_int_equality = atom.is_equals() and atom.arg(0).get_type().is_int_type()
+    if not (atom.is_le() or atom.is_lt() or is_int_equality):
+        return None
+    try:
+        lhs_coefficients, lhs_constant = smt.SmtFormula.get_linear_form(atom.arg(0))
+        rhs_coefficients, rhs_constant = smt.SmtFormula.get_linear_form(atom.arg(1))
+    except ValueError:
+        return None
+
+    # lhs - rhs
+    coefficients = dict(lhs_coefficients)
+    for symbol, coefficient in rhs_coefficients.items():
+        coefficients[symbol] = coefficients.get(symbol, 0) - coefficient
+    constant = lhs_constant - rhs_constant
+    coefficients = {s: c for s, c in coefficients.items() if c != 0}
+
+    if is_int_equality:
+        return coefficients, constant, NE if is_negated else EQ
+    if atom.is_lt():
+        # lhs - rhs + 1 <= 0
+        constant += 1
+    if is_negated:
+        # not (e <= 0) iff -e + 1 <= 0
+        coefficients = {s: -c for s, c in coefficients.items()}
+        constant = -constant + 1
+    return coefficients, constant, LE
+
+
+def to_formula(constraint: tuple[dict, int, str]):
+    coefficients, constant, kind = constraint
+    atom = smt.SmtFormula.build_linear_atom(coefficients, constant, kind != LE)
+    return Not(atom) if kind == NE else atom
+
+
+def substitute(constraint: tuple[dict, int, str], symbol, equality: tuple[dict, int]):
+    """
+    Replace `symbol` in a constraint, using an equality whose coefficient of
+    `symbol` is 1 or -1.
+    """
+    coefficients, constant, kind = constraint
+    factor = coefficients.get(symbol, 0)
+    if factor == 0:
+        return constraint
+    eq_coefficients, eq_constant = equality
+    # symbol = -(rest of equality) / (its coefficient), which is 1 or -1
+    scale = -factor * eq_coefficients[symbol]
+    new_coefficients = dict(coefficients)
+    del new_coefficients[symbol]
+    for other, coefficient in eq_coefficients.items():
+        if other == symbol:
+            continue
+        new_coefficients[other] = new_coefficients.get(other, 0) + scale * coefficient
+    new_coefficients = {s: c for s, c in new_coefficients.items() if c != 0}
+    return new_coefficients, constant + scale * eq_constant, kind
+
+
+def eliminate_by_equality(constraints: list, symbol) -> list | None:
+    """
+    :return: constraints with `symbol` substituted away using an equality, or None
+             if there is no equality that can be used exactly.
+    """
+    for idx, (coefficients, constant, kind) in enumerate(constraints):
+        if kind == EQ and abs(coefficients.get(symbol, 0)) == 1:
+            equality = (coefficients, constant)
+            rest = constraints[:idx] + constraints[idx + 1 :]
+            return [substitute(c, symbol, equality) for c in rest]
+    return None
+
+
+def eliminate_by_fourier_motzkin(constraints: list, symbol) -> list | None:
+    """
+    :return: constraints with `symbol` eliminated by combining its lower and upper
+             bounds, or None if this is not exact over integers.
+    """
+    lower_bounds = []
+    upper_bounds = []
+    rest = []
+    for constraint in constraints:
+        coefficients, constant, kind = constraint
+        coefficient = coefficients.get(symbol, 0)
+        if coefficient == 0:
+            rest.append(constraint)
+        elif kind != LE:
+            # (dis)equalities that cannot be substituted away
+            return None
+        elif coefficient > 0:
+            upper_bounds.append(constraint)
+        else:
+            lower_bounds.append(constraint)
+
+    for lower_coefficients, lower_constant, _ in lower_bounds:
+        a = -lower_coefficients[symbol]
+        for upper_coefficients, upper_constant, _ in upper_bounds:
+            b = upper_coefficients[symbol]
+            # the real shadow is the integer shadow only if one of them is unit
+            if a != 1 and b != 1:
+                return None
+            # b * lower + a * upper, in which symbol cancels out
+            combined = dict()
+            for other in set(lower_coefficients) | set(upper_coefficients):
+                if other == symbol:
+                    continue
+                coefficient = b * lower_coefficients.get(
+                    other, 0
+                ) + a * upper_coefficients.get(other, 0)
+                if coefficient != 0:
+                    combined[other] = coefficient
+            rest.append((combined, b * lower_constant + a * upper_constant, LE))
+    if len(rest) > MAX_CONSTRAINTS:
+        return None
+    return rest
+
+
+def project(formula, symbols: list):
+    """
+    Eliminate existentially quantified `symbols` from a conjunction of linear atoms.
+    Conjuncts without these symbols are kept as they are.
+    :return: the projected formula, or None if the formula is outside the supported
+             fragment, or the projection cannot be done exactly.
+    """
+    to_eliminate = set(symbols)
+    conjuncts = formula.args() if formula.is_and() else [formula]
+    constraints = []
+    kept = []
+    pending = list(conjuncts)
+    while pending:
+        conjunct = pending.pop()
+        if conjunct.is_and():
+            pending.extend(conjunct.args())
+            continue
+        if conjunct.is_true():
+            continue
+        if conjunct.is_false():
+            return FALSE()
+        if not (conjunct.get_free_variables() & to_eliminate):
+            kept.append(conjunct)
+            continue
+        constraint = to_constraint(conjunct)
+        if constraint is None:
+            return None
+        constraints.append(constraint)
+
+    remaining = [s for s in symbols if any(s in c[0] for c in constraints)]
+    while remaining:
+        # substitution first, since it does not grow the constraints
+        for symbol in remaining:
+            eliminated = eliminate_by_equality(constraints, symbol)
+            if eliminated is not None:
+                break
+        else:
+            # the symbol with the fewest combinations of bounds
+            def num_combinations(symbol) -> int:
+                num_lower = len([c for c in constraints if c[0].get(symbol, 0) < 0])
+                num_upper = len([c for c in constraints if c[0].get(symbol, 0) > 0])
+                return num_lower * num_upper
+
+            symbol = min(remaining, key=num_combinations)
+            eliminated = eliminate_by_fourier_motzkin(constraints, symbol)
+            if eliminated is None:
+                return None
+        constraints = eliminated
+        remaining = [s for s in remaining if any(s in c[0] for c in constraints)]
+
+    conjuncts = kept + [to_formula(c) for c in constraints]
+    if not conjuncts:
+        return TRUE()
+    return And(conjuncts)
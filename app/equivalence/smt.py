@@ -1,9 +1,15 @@
+import math
+import os
 import re
+import zlib
+from collections import OrderedDict
 from enum import Enum
 from pprint import pformat
 
-from pysmt.exceptions import ConvertExpressionError
+import numpy as np
+from pysmt.exceptions import ConvertExpressionError, PysmtException
 from pysmt.shortcuts import (
+    FALSE,
     GE,
     LE,
     LT,
@@ -17,6 +23,7 @@ from pysmt.shortcuts import (
     NotEquals,
     Or,
     Plus,
+    Solver,
     Symbol,
     Times,
     get_free_variables,
@@ -26,6 +33,8 @@ from pysmt.shortcuts import (
 )
 from pysmt.typing import INT
 
+from app import emitter, values
+from app.equivalence import projection
 from app.utilities import error_exit
 
 
@@ -54,6 +63,42 @@ class RawClause:
         self.arg_one = arg_one
         self.arg_two = arg_two
 
+    def get_symbol_names(self) -> list[str]:
+        """
+        Names of the symbols in this clause, in order of appearance.
+        """
+        if self.node_type == NodeType.Symbol:
+            return [self.arg_one]
+        res = []
+        for arg in [self.arg_one, self.arg_two]:
+            if isinstance(arg, RawClause):
+                res.extend(arg.get_symbol_names())
+        return res
+
+    def rename_symbols(self, renaming: dict[str, str]) -> "RawClause":
+        """
+        :return: a copy of this clause, with symbols renamed according to `renaming`.
+        """
+        if self.node_type == NodeType.Symbol:
+            return RawClause(
+                NodeType.Symbol, renaming.get(self.arg_one, self.arg_one), None
+            )
+        args = [
+            arg.rename_symbols(renaming) if isinstance(arg, RawClause) else arg
+            for arg in [self.arg_one, self.arg_two]
+        ]
+        return RawClause(self.node_type, args[0], args[1])
+
+    def orient(self) -> "RawClause":
+        """
+        :return: this clause, with the two sides of (in)equalities in a fixed order.
+        """
+        if self.node_type in [NodeType.Equal, NodeType.NotEqual] and str(
+            self.arg_one
+        ) > str(self.arg_two):
+            return RawClause(self.node_type, self.arg_two, self.arg_one)
+        return self
+
     def is_about_return_value(self) -> bool:
         str_repr = self.__str__()
         return "return" in str_repr and "return->" not in str_repr
@@ -206,6 +251,44 @@ class RawClause:
 
         return res_list
 
+    @staticmethod
+    def canonicalize_clause_lists(
+        clause_lists: list[list["RawClause"]],
+    ) -> list[list["RawClause"]]:
+        """
+        Bring lists of clauses (over the same logical variables) to a canonical form:
+        (in)equalities are oriented, clauses are sorted and deduplicated, and logical
+        variables are renamed in order of their first appearance.
+        The form does not depend on the order of atoms or the numbering of logical
+        variables in the summary (up to ties in the sort order).
+        """
+        lvar_pattern = re.compile("^[av][0-9]+$")
+
+        def masked(clause: RawClause) -> str:
+            # clause string, without the numbering of logical variables
+            return re.sub(r"\b([av])[0-9]+\b", r"\1_", str(clause))
+
+        sorted_lists = []
+        for clause_list in clause_lists:
+            oriented = {str(c): c for c in (c.orient() for c in clause_list)}
+            sorted_lists.append(
+                sorted(oriented.values(), key=lambda c: (masked(c), str(c)))
+            )
+
+        renaming: dict[str, str] = dict()
+        num_renamed = {"a": 0, "v": 0}
+        for clause_list in sorted_lists:
+            for clause in clause_list:
+                for name in clause.get_symbol_names():
+                    if lvar_pattern.match(name) and name not in renaming:
+                        num_renamed[name[0]] += 1
+                        renaming[name] = name[0] + str(num_renamed[name[0]])
+
+        return [
+            [clause.rename_symbols(renaming) for clause in clause_list]
+            for clause_list in sorted_lists
+        ]
+
     @staticmethod
     def is_avar_plus_one(term):
         """
@@ -320,7 +403,47 @@ class RawClause:
         return RawClause(NodeType.TrueFormula, None, None)
 
 
+class SmtQueryCache:
+    """
+    Results of solver queries, keyed on the query kind and the formulas.
+    pysmt formulas are hash-consed, so equal formulas are the same object and
+    keys are cheap to hash and compare.
+    Bounded in size; the least recently used entries are dropped first.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple, bool] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: tuple) -> bool | None:
+        """
+        :return: the cached result, or None if there is none.
+        """
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return result
+
+    def store(self, key: tuple, result: bool):
+        self.entries[key] = result
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
 class SmtFormula:
+    query_cache = SmtQueryCache(values.SMT_QUERY_CACHE_SIZE)
+    # fingerprints of formulas, and the values of variables they are computed with
+    fingerprints: dict = dict()
+    fingerprint_assignments: dict[str, np.ndarray] = dict()
+    # persistent solvers, one per kind of query, and the process they belong to
+    solvers: dict[str, Solver] = dict()
+    solvers_pid: int | None = None
+
     def __init__(self):
         pass
 
@@ -344,6 +467,297 @@ class SmtFormula:
         conjunction = simplify(conjunction)
         return conjunction
 
+    @staticmethod
+    def get_linear_form(term) -> tuple[dict, int]:
+        """
+        Write an integer term as sum(coefficient * symbol) + constant.
+        :return: (map from symbol to coefficient, constant).
+        :raises ValueError: if the term is not linear.
+        """
+        if term.is_int_constant():
+            return dict(), term.constant_value()
+        if term.is_symbol():
+            return {term: 1}, 0
+        if term.is_plus() or term.is_minus():
+            coefficients: dict = dict()
+            constant = 0
+            for idx, arg in enumerate(term.args()):
+                sign = -1 if term.is_minus() and idx > 0 else 1
+                arg_coefficients, arg_constant = SmtFormula.get_linear_form(arg)
+                for symbol, coefficient in arg_coefficients.items():
+                    coefficients[symbol] = (
+                        coefficients.get(symbol, 0) + sign * coefficient
+                    )
+                constant += sign * arg_constant
+            return coefficients, constant
+        if term.is_times():
+            coefficients, constant = dict(), 1
+            for arg in term.args():
+                arg_coefficients, arg_constant = SmtFormula.get_linear_form(arg)
+                if arg_coefficients and coefficients:
+                    raise ValueError("Not linear")
+                if arg_coefficients:
+                    coefficients = {
+                        symbol: coefficient * constant
+                        for symbol, coefficient in arg_coefficients.items()
+                    }
+                    constant *= arg_constant
+                else:
+                    coefficients = {
+                        symbol: coefficient * arg_constant
+                        for symbol, coefficient in coefficients.items()
+                    }
+                    constant *= arg_constant
+            return coefficients, constant
+        raise ValueError(f"Not a linear term: {term}")
+
+    @staticmethod
+    def build_linear_atom(coefficients: dict, constant: int, is_equality: bool):
+        """
+        Canonical form of `sum(coefficient * symbol) + constant <= 0` (or `= 0`):
+        coefficients are divided by their gcd, symbols are sorted by name, and an
+        equality has a positive first coefficient.
+        """
+        coefficients = {s: c for s, c in coefficients.items() if c != 0}
+        if not coefficients:
+            holds = constant == 0 if is_equality else constant <= 0
+            return TRUE() if holds else FALSE()
+
+        divisor = math.gcd(*coefficients.values())
+        symbols = sorted(coefficients, key=lambda s: s.symbol_name())
+        if is_equality:
+            if constant % divisor != 0:
+                return FALSE()
+            if coefficients[symbols[0]] < 0:
+                divisor = -divisor
+            constant //= divisor
+        else:
+            # over integers, e + c <= 0 iff e/d + ceil(c/d) <= 0
+            constant = -(-constant // divisor)
+
+        terms = []
+        for symbol in symbols:
+            coefficient = coefficients[symbol] // divisor
+            terms.append(
+                symbol if coefficient == 1 else Times(Int(coefficient), symbol)
+            )
+        lhs = terms[0] if len(terms) == 1 else Plus(terms)
+        if is_equality:
+            return Equals(lhs, Int(-constant))
+        return LE(lhs, Int(-constant))
+
+    @staticmethod
+    def canonicalize(formula):
+        """
+        Bring a formula to a canonical form, so that formulas that only differ in
+        the order of conjuncts/disjuncts, the sides of (in)equalities, or the
+        arrangement of linear terms become the same (hash-consed) formula.
+        Linear atoms are normalized, and constants are folded. Parts that are not
+        understood are kept as they are.
+        """
+        if formula.is_and() or formula.is_or():
+            absorbing = FALSE() if formula.is_and() else TRUE()
+            args = set()
+            for arg in formula.args():
+                arg = SmtFormula.canonicalize(arg)
+                if arg is absorbing:
+                    return absorbing
+                if arg.node_type() == formula.node_type():
+                    args.update(arg.args())
+                elif not arg.is_bool_constant():
+                    args.add(arg)
+            if not args:
+                return TRUE() if formula.is_and() else FALSE()
+            if len(args) == 1:
+                return args.pop()
+            sorted_args = sorted(args, key=lambda a: a.node_id())
+            return And(sorted_args) if formula.is_and() else Or(sorted_args)
+
+        if formula.is_not():
+            arg = SmtFormula.canonicalize(formula.arg(0))
+            if arg.is_bool_constant():
+                return FALSE() if arg.is_true() else TRUE()
+            if arg.is_not():
+                return arg.arg(0)
+            if arg.is_le() and arg.arg(1).is_int_constant():
+                # not (e <= c) iff -e + c + 1 <= 0
+                try:
+                    coefficients, _ = SmtFormula.get_linear_form(arg.arg(0))
+                except ValueError:
+                    return Not(arg)
+                return SmtFormula.build_linear_atom(
+                    {s: -c for s, c in coefficients.items()},
+                    arg.arg(1).constant_value() + 1,
+                    False,
+                )
+            return Not(arg)
+
+        is_int_equality = (
+            formula.is_equals() and formula.arg(0).get_type().is_int_type()
+        )
+        if formula.is_le() or formula.is_lt() or is_int_equality:
+            try:
+                lhs_coefficients, lhs_constant = SmtFormula.get_linear_form(
+                    formula.arg(0)
+                )
+                rhs_coefficients, rhs_constant = SmtFormula.get_linear_form(
+                    formula.arg(1)
+                )
+            except ValueError:
+                return formula
+            # lhs - rhs (+ 1 for strict) <= 0, or lhs - rhs = 0
+            coefficients = dict(lhs_coefficients)
+            for symbol, coefficient in rhs_coefficients.items():
+                coefficients[symbol] = coefficients.get(symbol, 0) - coefficient
+            constant = lhs_constant - rhs_constant + (1 if formula.is_lt() else 0)
+            return SmtFormula.build_linear_atom(coefficients, constant, is_int_equality)
+
+        if formula.is_iff():
+            args = sorted(
+                [SmtFormula.canonicalize(arg) for arg in formula.args()],
+                key=lambda a: a.node_id(),
+            )
+            return Iff(args[0], args[1])
+
+        return formula
+
+    @staticmethod
+    def get_fingerprint_assignment(name: str) -> np.ndarray:
+        """
+        Values of a variable in the assignments used for fingerprints. They only
+        depend on the name, so that fingerprints of different formulas (also from
+        different processes) are computed at the same points.
+        Half of the values are small, so that equalities among variables and with
+        small constants are often hit.
+        """
+        if name not in SmtFormula.fingerprint_assignments:
+            rng = np.random.default_rng(zlib.crc32(name.encode()))
+            num_small = values.SMT_FINGERPRINT_SAMPLES // 2
+            num_large = values.SMT_FINGERPRINT_SAMPLES - num_small
+            SmtFormula.fingerprint_assignments[name] = np.concatenate(
+                [rng.integers(-3, 4, num_small), rng.integers(-64, 65, num_large)]
+            ).astype(float)
+        return SmtFormula.fingerprint_assignments[name]
+
+    @staticmethod
+    def evaluate_on_assignments(formula, memo: dict) -> np.ndarray:
+        """
+        Value of a formula (or term) under all fingerprint assignments at once.
+        Integers are evaluated as floats, which are exact in the range we allow.
+        :raises ValueError: if the formula is not supported, or values get too large.
+        """
+        if formula in memo:
+            return memo[formula]
+        args = [SmtFormula.evaluate_on_assignments(arg, memo) for arg in formula.args()]
+        if formula.is_symbol():
+            res = SmtFormula.get_fingerprint_assignment(formula.symbol_name())
+            if formula.symbol_type().is_bool_type():
+                res = res > 0
+        elif formula.is_bool_constant() or formula.is_int_constant():
+            res = np.full(values.SMT_FINGERPRINT_SAMPLES, formula.constant_value())
+        elif formula.is_and():
+            res = np.logical_and.reduce(args)
+        elif formula.is_or():
+            res = np.logical_or.reduce(args)
+        elif formula.is_not():
+            res = ~args[0]
+        elif formula.is_implies():
+            res = ~args[0] | args[1]
+        elif formula.is_iff() or formula.is_equals():
+            res = args[0] == args[1]
+        elif formula.is_le():
+            res = args[0] <= args[1]
+        elif formula.is_lt():
+            res = args[0] < args[1]
+        elif formula.is_ite():
+            res = np.where(args[0], args[1], args[2])
+        elif formula.is_plus():
+            res = np.sum(args, axis=0)
+        elif formula.is_minus():
+            res = args[0] - args[1]
+        elif formula.is_times():
+            res = np.prod(args, axis=0)
+        else:
+            raise ValueError(f"Cannot evaluate {formula.node_type()}")
+        if res.dtype != bool:
+            res = res.astype(float)
+            if np.abs(res).max(initial=0) > 2**52:
+                raise ValueError("Value too large to be exact")
+        memo[formula] = res
+        return res
+
+    @staticmethod
+    def get_fingerprint(formula) -> int | None:
+        """
+        Truth values of a formula under a fixed set of pseudo-random assignments to
+        its free variables, as bits. Formulas with different fingerprints are not
+        equivalent.
+        :return: the fingerprint, or None if the formula cannot be evaluated.
+        """
+        if formula not in SmtFormula.fingerprints:
+            try:
+                truth_values = SmtFormula.evaluate_on_assignments(formula, dict())
+                if truth_values.dtype != bool:
+                    raise ValueError("Not a formula")
+                fingerprint = int.from_bytes(np.packbits(truth_values).tobytes())
+            except (ValueError, OverflowError):
+                fingerprint = None
+            SmtFormula.fingerprints[formula] = fingerprint
+        return SmtFormula.fingerprints[formula]
+
+    @staticmethod
+    def get_solver(kind: str) -> Solver:
+        """
+        The persistent solver for a kind of query; created on first use.
+        Solvers are not shared with forked processes, which create their own.
+        """
+        if SmtFormula.solvers_pid != os.getpid():
+            SmtFormula.solvers = dict()
+            SmtFormula.solvers_pid = os.getpid()
+        if kind not in SmtFormula.solvers:
+            SmtFormula.solvers[kind] = Solver(
+                name="cvc4", logic="QF_LIA", generate_models=False, incremental=True
+            )
+        return SmtFormula.solvers[kind]
+
+    @staticmethod
+    def drop_solver(kind: str):
+        """
+        Discards the persistent solver of a kind, so that the next query creates
+        a fresh one.
+        """
+        solver = SmtFormula.solvers.pop(kind, None)
+        if solver is None:
+            return
+        try:
+            solver.exit()
+        except AttributeError:
+            # the backend of a failed solver may already be gone
+            pass
+
+    @staticmethod
+    def is_unsat(kind: str, formula) -> bool:
+        """
+        Check satisfiability with the persistent solver of `kind`. The formula is
+        asserted in a scope of its own, so the solver is left as it was, while
+        declarations and learned state are kept for later queries.
+        If the solver fails, e.g. on a non-linear formula, it is discarded, since
+        its scopes can no longer be trusted, and the query is answered by a one-shot
+        solver instead.
+        """
+        try:
+            solver = SmtFormula.get_solver(kind)
+            solver.push()
+            try:
+                solver.add_assertion(formula)
+                return not solver.solve()
+            finally:
+                solver.pop()
+        except PysmtException as e:
+            emitter.warning(f"Persistent {kind} solver failed, solving once: {e!r}")
+            SmtFormula.drop_solver(kind)
+            return is_unsat(formula, solver_name="cvc4")
+
     @staticmethod
     def check_equivalence(f_one, f_two):
         """
@@ -351,7 +765,22 @@ class SmtFormula:
         :param f_one, f_two: terms in pysmt.
         :returns: True if equivalent; False otherwise.
         """
-        return is_unsat(Not(Iff(f_one, f_two)), solver_name="cvc4")
+        if f_one is f_two:
+            # formulas are hash-consed and canonicalized; same formula
+            return True
+        fp_one = SmtFormula.get_fingerprint(f_one)
+        fp_two = SmtFormula.get_fingerprint(f_two)
+        if fp_one is not None and fp_two is not None and fp_one != fp_two:
+            # they differ under some assignment
+            return False
+
+        # equivalence is symmetric
+        key = ("equivalence", frozenset((f_one, f_two)))
+        result = SmtFormula.query_cache.lookup(key)
+        if result is None:
+            result = SmtFormula.is_unsat("validity", Not(Iff(f_one, f_two)))
+            SmtFormula.query_cache.store(key, result)
+        return result
 
     @staticmethod
     def check_implication(f_one, f_two):
@@ -360,7 +789,20 @@ class SmtFormula:
         :param f_one, f_two: terms in pysmt.
         :returns: True if f_one implies f_two; False otherwise.
         """
-        return is_unsat(And(f_one, Not(f_two)), solver_name="cvc4")
+        if f_one is f_two:
+            return True
+        fp_one = SmtFormula.get_fingerprint(f_one)
+        fp_two = SmtFormula.get_fingerprint(f_two)
+        if fp_one is not None and fp_two is not None and fp_one & ~fp_two:
+            # under some assignment, f_one holds but f_two does not
+            return False
+
+        key = ("implication", f_one, f_two)
+        result = SmtFormula.query_cache.lookup(key)
+        if result is None:
+            result = SmtFormula.is_unsat("implication", And(f_one, Not(f_two)))
+            SmtFormula.query_cache.store(key, result)
+        return result
 
     @staticmethod
     def check_strictly_smaller(f_one, f_two):
@@ -436,6 +878,17 @@ class FormulaCollection:
             self.all_clause_list
         )
 
+    def canonicalize_clauses(self):
+        """
+        Bring the three lists of clauses to a canonical form together, since they
+        share logical variables.
+        """
+        self.path_clause_list, self.all_clause_list, self.return_clause_list = (
+            RawClause.canonicalize_clause_lists(
+                [self.path_clause_list, self.all_clause_list, self.return_clause_list]
+            )
+        )
+
     def build_smt_representation(self):
         """
         Given the clause list representation, populate the smt representation.
@@ -457,18 +910,20 @@ class FormulaCollection:
         self.all_smt = SmtFormula.build_conjunction(all_smt_conjuncts)
         self.return_smt = SmtFormula.build_conjunction(return_smt_conjuncts)
 
-    def add_aliasing_info_to_smt(self, aliasing_info: list[set[str]]):
+    def add_aliasing_info_to_smt(self, alias_representatives: dict[str, str]):
         """
         Add aliasing information to the smt representation.
+        :param alias_representatives: map from aliased pvar to the representative
+                                      of its alias class.
         """
         self.path_smt = FormulaCollection.add_aliasing_info_to_one(
-            self.path_smt, aliasing_info
+            self.path_smt, alias_representatives
         )
         self.all_smt = FormulaCollection.add_aliasing_info_to_one(
-            self.all_smt, aliasing_info
+            self.all_smt, alias_representatives
         )
         self.return_smt = FormulaCollection.add_aliasing_info_to_one(
-            self.return_smt, aliasing_info
+            self.return_smt, alias_representatives
         )
 
     def eliminate_avar_lvars_in_smt(self):
@@ -491,27 +946,41 @@ class FormulaCollection:
             )
         )
 
+    def compute_fingerprints(self):
+        """
+        Compute fingerprints of the smt representation, for cheap comparisons later.
+        """
+        for formula in [self.path_smt, self.all_smt, self.return_smt]:
+            SmtFormula.get_fingerprint(formula)
+
     @staticmethod
-    def add_aliasing_info_to_one(formula, aliasing_info):
+    def add_aliasing_info_to_one(formula, alias_representatives: dict[str, str]):
         """
-        Given a set of aliasing information, build equality constraints over pairs of them,
-        and add such constraints to the given formula.
+        Rewrite aliased names in the formula to their representatives. For each alias
+        class the formula talks about, add one equality per other member with the
+        representative, so that the aliases stay visible when comparing formulas.
         """
-        new_formula = formula
+        if not alias_representatives:
+            return formula
         symbols = get_free_variables(formula)
-        symbol_names = [s.symbol_name() for s in symbols]
-        for name in symbol_names:
-            for aliased_set in aliasing_info:
-                for aliased_name in aliased_set:
-                    if name == aliased_name:
-                        # we have a name, that falls into this set
-                        aliased_list = list(aliased_set)
-                        for a_one, a_two in zip(aliased_list[:-1], aliased_list[1:]):
-                            new_equality = Equals(
-                                Symbol(a_one, INT), Symbol(a_two, INT)
-                            )
-                            new_formula = And(new_formula, new_equality)
-        return new_formula
+        representatives = set()
+        substitution = dict()
+        for symbol in symbols:
+            name = symbol.symbol_name()
+            representative = alias_representatives.get(name, name)
+            representatives.add(representative)
+            if representative != name:
+                substitution[symbol] = Symbol(representative, INT)
+        new_formula = formula.substitute(substitution) if substitution else formula
+
+        equalities = [
+            Equals(Symbol(member, INT), Symbol(representative, INT))
+            for member, representative in sorted(alias_representatives.items())
+            if representative in representatives
+        ]
+        if not equalities:
+            return new_formula
+        return And([new_formula] + equalities)
 
     @staticmethod
     def eliminate_restricted_and_left_over_logical_vars(formula):
@@ -524,8 +993,9 @@ class FormulaCollection:
         is not present in the program (e.g. constant or intermediate computation result),
         or we ignored parsing about its attribute before.
 
-        This method eliminates restricted variables and leftover varaibles in the current formula,
-        by doing quantifier elimination on them.
+        This method eliminates restricted variables and leftover varaibles in the current formula.
+        Formulas in the linear fragment Pulse produces are projected natively; others
+        go through quantifier elimination.
 
         :param formula: the input formula to be considered.
         :param lvar_to_pvar_set: mapping from logical variable to set of program variables.
@@ -550,8 +1020,13 @@ class FormulaCollection:
             new_constraint = GE(restricted_var, Int(0))
             new_formula = And(new_formula, new_constraint)
 
-        # Added all the extra conjuncts; now eliminate using quantifier elimination
+        # Added all the extra conjuncts; now eliminate them
         quatifiers = restricted_vars + left_over_lvars
+        projected_formula = projection.project(new_formula, quatifiers)
+        if projected_formula is not None:
+            return SmtFormula.canonicalize(simplify(projected_formula))
+
+        # outside what can be projected natively; use quantifier elimination
         new_formula = Exists(quatifiers, new_formula)
         try:
             new_formula = qelim(new_formula)
@@ -562,7 +1037,7 @@ class FormulaCollection:
             # so too bad, have to just return some default value
             new_formula = SmtFormula.get_true_formula()
 
-        return simplify(new_formula)
+        return SmtFormula.canonicalize(simplify(new_formula))
 
     def __str__(self):
         ret = "\nPath formula :\n\t"
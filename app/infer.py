@@ -2,10 +2,12 @@
 Handles all the calls to Infer.
 """
 
+import hashlib
 import os
 import shutil
+import tempfile
 
-from app import utilities, values
+from app import emitter, utilities, values
 from app.parsing import parse_report
 
 
@@ -34,7 +36,7 @@ def build_common_infer_cmd():
     """
     Helper for constructing various Infer commands.
     """
-    cmd = values.INFER_PATH + " --pulse-only --jobs 16 "
+    cmd = values.INFER_PATH + " --pulse-only --jobs " + str(values.INFER_JOBS) + " "
     if values.CONF_PULSE_ARGS:
         cmd += values.CONF_PULSE_ARGS
     cmd_list = cmd.split(" ")
@@ -44,15 +46,24 @@ def build_common_infer_cmd():
 def infer_whole_program():
     """
     Run Infer on the entire program to get bug reports.
+    With a compilation database, the recorded compile commands are analyzed instead
+    of building the program again.
     """
     os.chdir(values.CONF_DIR_SRC_BUILD)
 
-    # first clean the build
-    utilities.execute_command(values.CONF_COMMAND_CLEAN)
-    # next clean possible Infer output from previous runs
+    # clean possible Infer output from previous runs
     utilities.remove_dir_if_exists(values.DIR_INFER_OUT_WHOLE)
 
     cmd_list = build_common_infer_cmd()
+    if values.USE_COMPILATION_DATABASE:
+        cmd_list += ["-o", values.DIR_INFER_OUT_WHOLE]
+        cmd_list += ["--compilation-database", values.FILE_COMPILE_COMMANDS]
+        utilities.execute_command(" ".join(cmd_list))
+        return
+
+    # first clean the build
+    utilities.execute_command(values.CONF_COMMAND_CLEAN)
+
     cmd_list += ["-o", values.DIR_INFER_OUT_WHOLE, "--"]
     cmd = " ".join(cmd_list)
     cmd += " "
@@ -101,12 +112,119 @@ def infer_validation_whole_program():
     return report_json_path
 
 
-def infer_target_function():
+# digest of what summaries depend on besides the fix file; fixed for the whole
+# repair stage, so computed on first use in each process
+summary_cache_context: bytes | None = None
+
+
+def get_summary_cache_context() -> bytes:
+    """
+    Digest of everything a summary depends on besides the fix file: the Infer
+    binary and arguments, the repair build command, the target function, and the
+    whole-program analysis it builds upon.
+    """
+    global summary_cache_context
+    if summary_cache_context is None:
+        hasher = hashlib.sha256()
+        key_parts = build_common_infer_cmd() + [
+            values.CONF_COMMAND_BUILD_REPAIR,
+            values.CONF_BUG_FILE,
+            values.CONF_BUG_PROC,
+        ]
+        for part in key_parts:
+            hasher.update(b"\0" + part.encode())
+        whole_report = os.path.join(values.DIR_INFER_OUT_WHOLE, "report.json")
+        if os.path.isfile(whole_report):
+            with open(whole_report, "rb") as f:
+                hasher.update(b"\0" + hashlib.sha256(f.read()).digest())
+        summary_cache_context = hasher.digest()
+    return summary_cache_context
+
+
+def get_summary_cache_key() -> str:
+    """
+    Key of the summary cache entry for the current content of the fix file.
+    """
+    hasher = hashlib.sha256()
+    with open(values.FIX_FILE_PATH_ORIG, "rb") as f:
+        hasher.update(f.read())
+    hasher.update(b"\0" + get_summary_cache_context())
+    return hasher.hexdigest()
+
+
+# cache keys for which Infer produced no summary in this run; not persisted, as
+# Infer may have failed for reasons that do not hold in later runs
+keys_without_summary: set[str] = set()
+
+
+def lookup_summary_cache(
+    cache_key: str, summary_file_path: str
+) -> tuple[bool, str | None]:
+    """
+    :return: (whether there is an entry, path to the summary copied from the entry).
+             The path is None if no summary was produced earlier in this run.
+    """
+    cached_path = os.path.join(values.DIR_SUMMARY_CACHE, cache_key + ".json")
+    if os.path.isfile(cached_path):
+        shutil.copyfile(cached_path, summary_file_path)
+        return True, summary_file_path
+    if cache_key in keys_without_summary:
+        return True, None
+    return False, None
+
+
+def store_summary_cache(cache_key: str, summary_file_path: str | None):
+    """
+    Store a new entry; `summary_file_path` is None if no summary was produced,
+    which is only remembered for the current run.
+    Entries are written atomically, since several processes may share the cache.
+    """
+    if summary_file_path is None:
+        keys_without_summary.add(cache_key)
+        return
+    os.makedirs(values.DIR_SUMMARY_CACHE, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=values.DIR_SUMMARY_CACHE, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(summary_file_path, tmp_path)
+    entry_path = os.path.join(values.DIR_SUMMARY_CACHE, cache_key + ".json")
+    os.replace(tmp_path, entry_path)
+
+
+def infer_target_function(summary_file_path: str | None = None):
     """
     Run Infer on ONE target function to get summary post report.
+    Summaries are cached by the content of the fix file, so Infer is not run
+    again on a patched file that has been seen before.
+    :param summary_file_path: where the summary file should be moved to;
+                              defaults to a fixed name in the runtime directory.
     :return: path to the generated summary file (json); None if a summary
              file is not produced.
     """
+    if summary_file_path is None:
+        summary_file_path = os.path.join(
+            values.DIR_RUNTIME_REPAIR, values.SUMMARY_FILE_NAME
+        )
+    if os.path.isfile(summary_file_path):
+        os.remove(summary_file_path)
+
+    cache_key = None
+    if values.USE_SUMMARY_CACHE:
+        cache_key = get_summary_cache_key()
+        is_hit, cached_summary = lookup_summary_cache(cache_key, summary_file_path)
+        if is_hit:
+            emitter.information("[Infer] Reusing cached summary for the patched file")
+            return cached_summary
+
+    new_path = run_infer_target_function(summary_file_path)
+    if cache_key is not None:
+        store_summary_cache(cache_key, new_path)
+    return new_path
+
+
+def run_infer_target_function(summary_file_path: str) -> str | None:
+    """
+    Helper for actually running Infer on the target function.
+    """
     os.chdir(values.CONF_DIR_SRC_BUILD)
 
     # if first time running single function analysis, copy over results
@@ -135,10 +253,6 @@ def infer_target_function():
     if not os.path.exists(old_path):
         return None
 
-    new_path = os.path.join(values.DIR_RUNTIME_REPAIR, values.SUMMARY_FILE_NAME)
-    if os.path.isfile(new_path):
-        os.remove(new_path)
+    shutil.move(old_path, summary_file_path)
 
-    shutil.move(old_path, new_path)
-
-    return new_path
+    return summary_file_path
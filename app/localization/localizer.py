@@ -1,10 +1,9 @@
-import json
 import math
 
 from app import codeql, definitions, emitter, values
 from app.equivalence.cluster import DisjunctLabel
 from app.parsing.parse_report import PulseBug
-from app.parsing.parse_summary import PulseDisjunctParser
+from app.parsing.parse_summary import PulseDisjunctParser, iter_summary_disjuncts
 
 
 def ochiai(
@@ -60,20 +59,40 @@ def ochiai(
     return sorted_list
 
 
-def localize(
-    summary_json_file: str, target_bug: PulseBug, top_k: int = 10
-) -> list[int]:
+def cfg_filter_query(target_bug: PulseBug) -> codeql.QueryRequest | None:
+    """
+    :return: the codeql query for the lines a fix location can be at, depending on
+             the bug type; None if locations are not filtered for this bug type.
+    """
     func = target_bug.procedure
     start_line = target_bug.start_line
     end_line = target_bug.orig_line
     bug_type = target_bug.type
 
-    with open(summary_json_file) as f:
-        summary_post_json = json.load(f)
+    if bug_type == definitions.BUG_TYPE_LEAK:
+        # to fix leak, location has to be after the last-access point
+        return codeql.loc_after_query(func, start_line, end_line)
+    elif bug_type == definitions.BUG_TYPE_NULLPTR:
+        # to fix npe, location has to be before where the npe happens
+        return codeql.loc_between_query(func, start_line, end_line)
+    return None
+
+
+def localize(
+    summary_json_file: str,
+    target_bug: PulseBug,
+    cfg_filter_res_file: str | None,
+    top_k: int = 10,
+) -> list[int]:
+    """
+    :param cfg_filter_res_file: result file of the query from `cfg_filter_query`,
+                                which should have been run already.
+    """
+    bug_type = target_bug.type
 
     all_traces = []
 
-    for _, disjunct in enumerate(summary_post_json):
+    for disjunct in iter_summary_disjuncts(summary_json_file):
         parser = PulseDisjunctParser(disjunct)
         label_text, bug_start_line, bug_end_line, trace = (
             parser.parse_disjunct_trace_only()
@@ -89,13 +108,13 @@ def localize(
     loc_allowed = set()
     if bug_type == definitions.BUG_TYPE_LEAK:
         # to fix leak, location has to be after the last-access point
-        codeql.run_loc_after_query(func, start_line, end_line)
-        loc_after_both = codeql.parse_loc_after_query_result()
+        assert cfg_filter_res_file is not None
+        loc_after_both = codeql.parse_loc_after_query_result(cfg_filter_res_file)
         loc_allowed = set(loc_after_both)
     elif bug_type == definitions.BUG_TYPE_NULLPTR:
         # to fix npe, location has to be before where the npe happens
-        codeql.run_loc_between_query(func, start_line, end_line)
-        loc_between = codeql.parse_loc_between_query_result()
+        assert cfg_filter_res_file is not None
+        loc_between = codeql.parse_loc_between_query_result(cfg_filter_res_file)
         loc_allowed = set(loc_between)
 
     emitter.information(
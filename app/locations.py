@@ -0,0 +1,193 @@
+"""
+Repair several fix locations at the same time.
+Each location is repaired in a process of its own, with its own Generator,
+ClusterManager and copy of the source tree. Results are merged back into
+this process afterwards, so that validation sees them as usual.
+"""
+
+import multiprocessing as mp
+import signal
+import traceback
+from multiprocessing.connection import wait
+
+from app import definitions, emitter, repair, utilities, values, workers
+from app.equivalence.cluster import ClusterManager
+from app.equivalence.smt import SmtFormula
+from app.repairgen import patch_utils
+from app.result import result
+
+# timer keys that are accumulated during the repair loop of a location
+REPAIR_LOOP_DURATIONS = [
+    definitions.DURATION_PATCH_GEN,
+    definitions.DURATION_PROB_UPDATE,
+    definitions.DURATION_PATCH_SIGN_GEN,
+    definitions.DURATION_FOOTPRINT_GEN,
+    definitions.DURATION_PATCH_CLUSTER,
+]
+
+
+def get_location_tree_name(fix_loc_line: int) -> str:
+    return f"loc-{fix_loc_line}"
+
+
+def repair_in_process(
+    fix_loc_line: int,
+    ingredients: tuple[int, list[str], list[str], list[str]],
+    return_stmts: list[str],
+    labels: list[str],
+    time_budget: float,
+    conn,
+):
+    """
+    Entry of the process repairing one location.
+    Sends back everything the parent needs to continue as if the repair
+    happened in the parent, or the traceback if something went wrong.
+    """
+    # the parent terminates us on its way out; no need to go through its handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        workers.switch_to_tree(get_location_tree_name(fix_loc_line))
+        patch_utils.patch_name_prefix = f"L{fix_loc_line}-"
+        elapsed_before = dict(utilities.global_timer.elapsed_record)
+        query_cache = SmtFormula.query_cache
+        query_cache_stats_before = (query_cache.hits, query_cache.misses)
+
+        pool = None
+        if values.NUM_WORKERS > 1:
+            pool = workers.PatchEvaluationPool(
+                values.NUM_WORKERS, get_location_tree_name(fix_loc_line)
+            )
+        cluster_manager = repair.repair(
+            fix_loc_line, return_stmts, labels, time_budget, pool, ingredients
+        )
+        if pool is not None:
+            pool.close()
+
+        elapsed_in_repair = {
+            key: utilities.global_timer.elapsed_record[key] - elapsed_before.get(key, 0)
+            for key in REPAIR_LOOP_DURATIONS
+            if key in utilities.global_timer.elapsed_record
+        }
+        conn.send(
+            (
+                fix_loc_line,
+                cluster_manager,
+                result,
+                values.USED_PROD_RULES,
+                values.PLAUSIBLE_PROD_RULES,
+                values.STAGNATED_PROD_RULES,
+                elapsed_in_repair,
+                repair.total_search_space_size,
+                (
+                    query_cache.hits - query_cache_stats_before[0],
+                    query_cache.misses - query_cache_stats_before[1],
+                ),
+            )
+        )
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+
+
+def merge_location(
+    fix_loc_line: int,
+    child_result,
+    used_prod_rules: dict[str, int],
+    plausible_prod_rules: dict[str, int],
+    stagnated_prod_rules: list[str],
+    elapsed_in_repair: dict[str, float],
+    search_space_size: int,
+    query_cache_stats: tuple[int, int],
+):
+    """
+    Merge what a location process has recorded into the globals of this process.
+    """
+    result.merge_location_result(child_result, fix_loc_line)
+    for ours, theirs in [
+        (values.USED_PROD_RULES, used_prod_rules),
+        (values.PLAUSIBLE_PROD_RULES, plausible_prod_rules),
+    ]:
+        for rule_signature, count in theirs.items():
+            ours[rule_signature] = ours.get(rule_signature, 0) + count
+    for rule_signature in stagnated_prod_rules:
+        if rule_signature not in values.STAGNATED_PROD_RULES:
+            values.STAGNATED_PROD_RULES.append(rule_signature)
+    for key, elapsed in elapsed_in_repair.items():
+        utilities.global_timer.accumulate(key, elapsed)
+    repair.total_search_space_size += search_space_size
+    SmtFormula.query_cache.hits += query_cache_stats[0]
+    SmtFormula.query_cache.misses += query_cache_stats[1]
+
+
+def repair_in_parallel(
+    fix_loc_lines: list[int], return_stmts: list[str], labels: list[str]
+) -> list[ClusterManager]:
+    """
+    Repair all fix locations at the same time.
+    CodeQL queries for patch ingredients are run here, in one batch; only the
+    repair loops run concurrently. Each of them gets all the remaining time.
+    :return: cluster managers, in the order of `fix_loc_lines`.
+    """
+    all_ingredients = repair.collect_patch_ingredients(fix_loc_lines)
+
+    emitter.sub_title(f"Preparing source trees for {len(fix_loc_lines)} locations")
+    for fix_loc_line in fix_loc_lines:
+        workers.prepare_tree(get_location_tree_name(fix_loc_line))
+
+    time_budget = utilities.global_timer.get_total_remaining_time()
+
+    # fork, so that children inherit configurations and the parsed target bug
+    ctx = mp.get_context("fork")
+    processes = []
+    conn_to_loc = dict()
+    for fix_loc_line in fix_loc_lines:
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(
+            target=repair_in_process,
+            args=(
+                fix_loc_line,
+                all_ingredients[fix_loc_line],
+                return_stmts,
+                labels,
+                time_budget,
+                send_conn,
+            ),
+        )
+        process.start()
+        # keep only the child's copy open, so that we see EOF if it dies
+        send_conn.close()
+        processes.append(process)
+        conn_to_loc[recv_conn] = fix_loc_line
+
+    loc_to_cluster_manager: dict[int, ClusterManager] = dict()
+    failures = []
+    try:
+        while conn_to_loc:
+            for conn in wait(list(conn_to_loc.keys())):
+                fix_loc_line = conn_to_loc.pop(conn)
+                try:
+                    received = conn.recv()
+                except EOFError:
+                    received = "Process exited without sending back its results."
+                conn.close()
+                if isinstance(received, str):
+                    emitter.error(f"Loc {fix_loc_line}: Repair failed")
+                    failures.append((fix_loc_line, received))
+                    continue
+                _, cluster_manager, *to_merge = received
+                merge_location(fix_loc_line, *to_merge)
+                loc_to_cluster_manager[fix_loc_line] = cluster_manager
+                emitter.information(f"Loc {fix_loc_line}: Results merged")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    if failures:
+        utilities.error_exit(
+            *[f"Loc {loc} failed with:\n{reason}" for loc, reason in failures]
+        )
+
+    return [loc_to_cluster_manager[fix_loc_line] for fix_loc_line in fix_loc_lines]
@@ -9,11 +9,14 @@ from app import (
     configuration,
     definitions,
     emitter,
+    locations,
     logger,
     repair,
+    scheduler,
     utilities,
     validation,
     values,
+    workers,
 )
 from app.result import result
 
@@ -23,6 +26,10 @@ stop_event = mp.Event()
 def create_init_directories_and_files():
     # paths used in both stages
     values.DIR_CODEQL_DB = os.path.join(values.DIR_RUNTIME_PRE, "codeql-db")
+    values.DIR_CODEQL_CACHE = os.path.join(values.DIR_RUNTIME_PRE, "codeql-cache")
+    values.FILE_COMPILE_COMMANDS = os.path.join(
+        values.DIR_RUNTIME_PRE, "compile_commands.json"
+    )
     values.DIR_INFER_OUT_WHOLE = os.path.join(values.DIR_RUNTIME_PRE, "infer-out-whole")
 
     values.DIR_INFER_OUT_SINGLE = os.path.join(
@@ -34,6 +41,8 @@ def create_init_directories_and_files():
     values.INFER_CHANGED_FILES = os.path.join(
         values.DIR_RUNTIME_REPAIR, "changed-files"
     )
+    values.DIR_WORKERS = os.path.join(values.DIR_RUNTIME_REPAIR, "workers")
+    values.DIR_SUMMARY_CACHE = os.path.join(values.DIR_RUNTIME_REPAIR, "summary-cache")
     values.DIR_ALL_PATCHES = os.path.join(values.DIR_RUNTIME_REPAIR, "all-patches")
     values.DIR_FINAL_PATCHES = os.path.join(values.DIR_RUNTIME_REPAIR, "final-patches")
 
@@ -42,8 +51,10 @@ def create_init_directories_and_files():
         os.makedirs(values.DIR_RUNTIME_PRE)
 
     else:  # repair stage
-        utilities.remove_dir_if_exists(values.DIR_RUNTIME_REPAIR)
-        os.makedirs(values.DIR_RUNTIME_REPAIR)
+        # summaries cached by previous repair runs stay valid; keep them
+        utilities.remove_dir_contents_except(
+            values.DIR_RUNTIME_REPAIR, [values.DIR_SUMMARY_CACHE]
+        )
 
         # backup the fix file
         values.FIX_FILE_PATH_ORIG = os.path.join(
@@ -127,14 +138,38 @@ def run_repair():
     utilities.global_timer.stop(definitions.DURATION_ANALYSIS)
 
     utilities.global_timer.start(definitions.DURATION_REPAIR)
-    all_remaining_time = utilities.global_timer.get_total_remaining_time()
-    time_for_each_loc = all_remaining_time / len(fix_loc_lines)
-    all_cluster_managers = []
-    for fix_loc_line in fix_loc_lines:
-        cluster_manager = repair.repair(
-            fix_loc_line, return_stmts, labels, time_for_each_loc
+    if values.LOCATION_MODE == "parallel":
+        all_cluster_managers = locations.repair_in_parallel(
+            fix_loc_lines, return_stmts, labels
         )
-        all_cluster_managers.append(cluster_manager)
+    else:
+        pool = None
+        if values.NUM_WORKERS > 1:
+            emitter.sub_title(
+                f"Preparing {values.NUM_WORKERS} workers for patch evaluation"
+            )
+            pool = workers.PatchEvaluationPool(values.NUM_WORKERS, "pool")
+        if values.LOCATION_MODE == "adaptive":
+            all_cluster_managers = scheduler.repair_adaptively(
+                fix_loc_lines, return_stmts, labels, pool
+            )
+        else:
+            all_ingredients = repair.collect_patch_ingredients(fix_loc_lines)
+            all_remaining_time = utilities.global_timer.get_total_remaining_time()
+            time_for_each_loc = all_remaining_time / len(fix_loc_lines)
+            all_cluster_managers = []
+            for fix_loc_line in fix_loc_lines:
+                cluster_manager = repair.repair(
+                    fix_loc_line,
+                    return_stmts,
+                    labels,
+                    time_for_each_loc,
+                    pool,
+                    all_ingredients[fix_loc_line],
+                )
+                all_cluster_managers.append(cluster_manager)
+        if pool is not None:
+            pool.close()
     repair.print_repair_stats(all_cluster_managers)
     utilities.global_timer.stop(definitions.DURATION_REPAIR)
 
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from collections import defaultdict
 from pprint import pformat
 
@@ -95,40 +97,66 @@ class ParsedHeapEdges:
                     return True
         return False
 
-    def __get_all_cycles_dfs(self, start, end):
-        fringe = [(start, [])]
-        while fringe:
-            node, path = fringe.pop()
-            if path and node == end:
-                yield path
-                continue
-            if node not in self.edges:
-                # no edge starting from this node
+    def get_strongly_connected_components(self) -> dict[str, int]:
+        """
+        Tarjan's algorithm, without recursion since heaps can be deep.
+        :return: map from each node to the index of its strongly connected component.
+        """
+        index: dict[str, int] = dict()
+        lowlink: dict[str, int] = dict()
+        stack: list[str] = []
+        on_stack: set[str] = set()
+        component_of: dict[str, int] = dict()
+        num_components = 0
+
+        def visit(node):
+            index[node] = lowlink[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            work.append((node, iter(self.get_children(node))))
+
+        for root in self.nodes:
+            if root in index:
                 continue
-            for child, _ in self.edges[node]:
-                if child in path:
-                    continue
-                fringe.append((child, path + [child]))
+            work: list = []
+            visit(root)
+            while work:
+                node, children = work[-1]
+                for child, _ in children:
+                    if child not in index:
+                        visit(child)
+                        break
+                    if child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    # all children done
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        # node is the root of a component; pop the whole component
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component_of[member] = num_components
+                            if member == node:
+                                break
+                        num_components += 1
+        return component_of
 
     def get_all_cycles(self):
         """
-        Get all cycles in the heap graph.
-        Store all edges appeared in a cycle to self.edges_in_cycle
+        Find all edges that appear in a cycle in the heap graph, and store them to
+        self.edges_in_cycle.
+        These are exactly the edges within a strongly connected component.
         """
-        all_cycles = []
-        for node in self.nodes:
-            for path in self.__get_all_cycles_dfs(node, node):
-                all_cycles.append([node] + path)
-
+        component_of = self.get_strongly_connected_components()
         edges_in_cycle = set()
-        for cycle in all_cycles:
-            # a cycle is in the form ['v30', 'v32', 'v23', 'v31', 'v30']
-            for parent, child in zip(cycle, cycle[1:]):
-                for child2, link_name in self.edges[parent]:
-                    # lets get link name from this data structure
-                    if child2 == child:
-                        edges_in_cycle.add((parent, link_name, child))
-                        break
+        for parent, children in self.edges.items():
+            for child, link_name in children:
+                if component_of[parent] == component_of[child]:
+                    edges_in_cycle.add((parent, link_name, child))
 
         self.edges_in_cycle = edges_in_cycle
 
@@ -153,6 +181,11 @@ class ParsedVariableMap:
         self.lvar_to_pvar_set: dict[str, set[str]] = dict()
         # map from lvar to pvar, where all the lvars are root variables (has corresponding stack var)
         self.root_lvar_to_pvar: dict[str, str] = dict()
+        # union-find over pvars; pvars are aliased if they map to the same lvar.
+        # The representative of each alias class is its largest pvar name.
+        self.alias_parent: dict[str, str] = dict()
+        # map from lvar to the representative of its alias class
+        self.lvar_to_representative: dict[str, str] = dict()
 
     def add_root_pvar(self, pvar: str, lvar: str):
         real_pvar_name = "&(" + pvar + ")"
@@ -191,54 +224,155 @@ class ParsedVariableMap:
                     new_frontier[child] = new_name
             frontier_lvar_to_pvar = new_frontier
 
+    def find_alias_representative(self, pvar: str) -> str:
+        """
+        :return: representative of the alias class of pvar.
+        """
+        root = pvar
+        while self.alias_parent[root] != root:
+            root = self.alias_parent[root]
+        # path compression
+        while self.alias_parent[pvar] != root:
+            self.alias_parent[pvar], pvar = root, self.alias_parent[pvar]
+        return root
+
+    def union_aliases(self, pvar_one: str, pvar_two: str):
+        """
+        Merge the alias classes of two pvars; the larger name becomes the representative.
+        """
+        root_one = self.find_alias_representative(pvar_one)
+        root_two = self.find_alias_representative(pvar_two)
+        if root_one < root_two:
+            self.alias_parent[root_one] = root_two
+        elif root_two < root_one:
+            self.alias_parent[root_two] = root_one
+
     def construct_lvar_to_pvar_set(self):
         """
         With pvar-to-lvar mapping set, construct mapping for the other direction.
         Will construct a map with entry type (lvar => {pvar1, pvar2, ...}).
+        Also builds the alias classes of pvars.
         """
         if self.lvar_to_pvar_set:  # computed before, skip
             return self.lvar_to_pvar_set
 
         map_ltop: dict[str, set[str]] = dict()
-
-        for pvar in self.pvar_to_lvar:
-            lvar = self.pvar_to_lvar[pvar]
+        for pvar, lvar in self.pvar_to_lvar.items():
+            self.alias_parent[pvar] = pvar
             if lvar not in map_ltop:
                 map_ltop[lvar] = {pvar}
             else:
+                # any member already in the set is in the same class
+                self.union_aliases(pvar, next(iter(map_ltop[lvar])))
                 map_ltop[lvar].add(pvar)
 
-        for lvar in map_ltop:
-            map_ltop[lvar] = set(sorted(map_ltop[lvar], reverse=True))
+        for lvar, pvar_set in map_ltop.items():
+            some_pvar = next(iter(pvar_set))
+            self.lvar_to_representative[lvar] = self.find_alias_representative(
+                some_pvar
+            )
 
         self.lvar_to_pvar_set = map_ltop
         return self.lvar_to_pvar_set
 
-    def get_aliasing_info(self) -> list[set[str]]:
+    def get_alias_representatives(self) -> dict[str, str]:
         """
-        Return the list of sets of program variables that are aliased.
+        :return: map from each aliased pvar to the representative of its class.
+                 Representatives themselves, and pvars without aliases, are not included.
         """
-        return list(self.lvar_to_pvar_set.values())
+        return {
+            pvar: self.find_alias_representative(pvar)
+            for pvar in self.alias_parent
+            if self.find_alias_representative(pvar) != pvar
+        }
 
     def get_first_pvar_for_lvar(self, lvar):
         """
         For a logical variable, return its corresponding program variable name.
-        When multiple pvars are possbile, pick the first one after sorting.
-        """
-        if lvar not in self.lvar_to_pvar_set:
-            return ""
-        pvar_set = self.lvar_to_pvar_set[lvar]
-        pvar_list = sorted(list(pvar_set), reverse=True)
-        if not pvar_list:
-            return ""
-        else:
-            return pvar_list[0]
+        When multiple pvars are possbile, pick the representative of their alias class.
+        """
+        return self.lvar_to_representative.get(lvar, "")
 
     def __str__(self):
         return pformat(self.lvar_to_pvar_set)
 
 
+def iter_summary_disjuncts(summary_file_path: str, chunk_size: int = 1 << 16):
+    """
+    Read the disjuncts in a summary file (a JSON array) one at a time, so that only
+    one of them is kept in memory, and it can be parsed before the rest is read.
+    :return: generator of the JSON of each disjunct.
+    """
+    decoder = json.JSONDecoder()
+    with open(summary_file_path) as f:
+        buffer = ""
+        is_eof = False
+        read_size = chunk_size
+
+        def read_more():
+            nonlocal buffer, is_eof, read_size
+            chunk = f.read(read_size)
+            if not chunk:
+                is_eof = True
+            buffer += chunk
+
+        def next_char() -> str:
+            """
+            Drop whitespace at the front of the buffer, and peek at the next character.
+            """
+            nonlocal buffer
+            while True:
+                buffer = buffer.lstrip()
+                if buffer or is_eof:
+                    return buffer[:1]
+                read_more()
+
+        if next_char() != "[":
+            raise ValueError(f"Summary file {summary_file_path} is not a JSON array.")
+        buffer = buffer[1:]
+        if next_char() == "]":
+            return
+
+        while True:
+            try:
+                disjunct, end = decoder.raw_decode(buffer)
+                # arrays, objects and strings end with a closing character; other
+                # values (e.g. "1" of "1.5") may continue, unless a separator follows
+                is_complete = (
+                    is_eof
+                    or isinstance(disjunct, (dict, list, str))
+                    or buffer[end:].lstrip()[:1] in (",", "]")
+                )
+            except json.JSONDecodeError:
+                if is_eof:
+                    raise
+                is_complete = False
+            if not is_complete:
+                # read a bigger chunk each time, so that a large disjunct is not
+                # decoded again too many times
+                read_more()
+                read_size *= 2
+                continue
+            read_size = chunk_size
+            buffer = buffer[end:]
+            yield disjunct
+
+            separator = next_char()
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(
+                    f"Summary file {summary_file_path} is not a valid JSON array."
+                )
+            buffer = buffer[1:]
+            next_char()
+
+
 class PulseDisjunctParser:
+    # results of parsing disjunct contents seen before (in this or earlier
+    # patches), by `get_content_key`; labels are not included
+    content_cache: dict[str, tuple] = dict()
+
     def __init__(self, disjunct_json):
         self.disjunct_json = disjunct_json
         # internal data structure of parser
@@ -302,22 +436,55 @@ class PulseDisjunctParser:
         post = content["post"]
         formula = content["path_condition"]
 
+        content_key = PulseDisjunctParser.get_content_key(post, formula)
+        if content_key in PulseDisjunctParser.content_cache:
+            cached = PulseDisjunctParser.content_cache[content_key]
+            return (label_text, start_line, end_line, *cached)
+
         res = self.parse_disjunct_state(post)
         if res == -1:
             # bad state encoutered when parsing
+            PulseDisjunctParser.content_cache[content_key] = default_res[3:]
             return default_res
 
         self.parse_disjunct_formula(formula)
 
-        return (
-            label_text,
-            start_line,
-            end_line,
+        parsed_content = (
             self.allocated_sets,
             self.deallocated_sets,
             self.formulas.all_smt,
             self.formulas.return_smt,
         )
+        PulseDisjunctParser.content_cache[content_key] = parsed_content
+        return (label_text, start_line, end_line, *parsed_content)
+
+    @staticmethod
+    def get_content_key(post, formula) -> str:
+        """
+        Hash of the parts of a disjunct's content that parsing depends on.
+        Of the attributes, only what `parse_state_attr_entry` looks at is kept, so
+        that locations recorded in them (which shift when a patch adds lines) do
+        not make otherwise identical disjuncts different.
+        """
+        normalized_attrs = []
+        for attr_entry in post["attrs"]:
+            normalized_attributes = []
+            for attribute in attr_entry[1]:
+                if attribute[0] == "AddressOfStackVariable":
+                    normalized_attributes.append(attribute[:2])
+                elif attribute[0] == "Invalid":
+                    invalid_info = attribute[1:]
+                    invalid_reason = None
+                    if len(invalid_info) >= 1 and len(invalid_info[0]) >= 1:
+                        invalid_reason = invalid_info[0][0]
+                    normalized_attributes.append([attribute[0], invalid_reason])
+                else:
+                    normalized_attributes.append([attribute[0]])
+            normalized_attrs.append([attr_entry[0], normalized_attributes])
+
+        normalized = [post["heap"], post["stack"], normalized_attrs, formula]
+        content_str = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(content_str.encode()).hexdigest()
 
     def parse_disjunct_state(self, state) -> int:
         """
@@ -375,10 +542,7 @@ class PulseDisjunctParser:
                 # for some reason, this lvar's mapping information is missing
                 # in the summary post file
                 continue
-            curr_res = list()
-            for pvar in variable_map.lvar_to_pvar_set[lvar]:
-                curr_res.append(pvar)
-            res.add(frozenset(curr_res))
+            res.add(frozenset(variable_map.lvar_to_pvar_set[lvar]))
         return res
 
     def parse_state_heap_entry(self, heap_entry):
@@ -464,16 +628,22 @@ class PulseDisjunctParser:
         # (5) move clauses related to return value into a separate list
         self.formulas.separate_clause_for_return_value()
 
+        # (5.1) canonical order of clauses and numbering of logical variables
+        self.formulas.canonicalize_clauses()
+
         # (6) from the clause list representation, get smt representation
         self.formulas.build_smt_representation()
 
         # (6) Add aliasing info into the smt representation
-        pvar_aliased_sets = self.parsed_variable_map.get_aliasing_info()
-        self.formulas.add_aliasing_info_to_smt(pvar_aliased_sets)
+        alias_representatives = self.parsed_variable_map.get_alias_representatives()
+        self.formulas.add_aliasing_info_to_smt(alias_representatives)
 
         # (7) eliminate a-vars and leftover lvars
         self.formulas.eliminate_avar_lvars_in_smt()
 
+        # (8) fingerprints for telling formulas apart cheaply
+        self.formulas.compute_fingerprints()
+
     def parse_both_linear_eqs(self, linear_eqs):
         """
         Linear equation format: variable=linear_arith.
@@ -2,34 +2,30 @@
 Main repair loop.
 """
 
+import os
 import signal
 import time
 
 from app import codeql, definitions, emitter, infer, utilities, values
 from app.equivalence.cluster import Cluster, ClusterManager
+from app.equivalence.smt import SmtFormula
 from app.repairgen import patch_utils
 from app.repairgen.generator import Generator
+from app.repairgen.grammar import Production
 from app.result import result
+from app.workers import PatchEvaluationPool
 
 # use this to record the entire search space size
-# TODO: this calculation is inaccurate, so should be ignored for now
 total_search_space_size = 0
 
 
-def gen_patch_and_classify(
-    fix_loc_line: int,
-    fix_loc_end_line: int,
-    generator: Generator,
-    cluster_manager: ClusterManager,
-) -> int:
+def generate_patch_instruction(
+    fix_loc_line: int, generator: Generator
+) -> tuple[str | None, list[Production]]:
     """
-    Generate one patch and classify it into a cluster.
-    :return: 0 if successful, 1 if failed
+    Generate one new patch instruction from the generator.
+    :return: (patch instruction, productions used); instruction is None if failed.
     """
-    # restore a copy from the backupfile
-    patch_utils.restore_file_to_unpatched_state()
-
-    # (1) generate a patch candidate
     utilities.global_timer.start(definitions.DURATION_PATCH_GEN)
 
     # gen_random can stuck forever due to some reason.
@@ -37,7 +33,7 @@ def gen_patch_and_classify(
     signal.alarm(30)
     try:
         is_random = not values.LEARN_PROBABILITIES
-        patch_instruction, used_prods = generator.gen_random(is_random)
+        patch_instruction, used_prods = generator.generate(is_random)
     except Exception as e:
         emitter.information(
             f"Stuck on one grammar generation. end repair loop for one location. Exception: {e}"
@@ -51,24 +47,26 @@ def gen_patch_and_classify(
             )
             time_elapsed = utilities.global_timer.get_elapsed_from_overall_start()
             result.new_probability_update(fix_loc_line, time_elapsed, grammar_state)
-        return 1
+        return None, []
     finally:
         signal.alarm(0)
 
     utilities.global_timer.pause(definitions.DURATION_PATCH_GEN)
+    return patch_instruction, used_prods
 
-    if patch_instruction is None:
-        return 1
-
-    patch_file_path = patch_utils.weave_patch_instruction(
-        patch_instruction, fix_loc_line, fix_loc_end_line
-    )
-
-    # (2) get the summary of new patch, and put it to suitable cluster
-    utilities.global_timer.start(definitions.DURATION_FOOTPRINT_GEN)
-    infer_summary_file = infer.infer_target_function()
-    utilities.global_timer.pause(definitions.DURATION_FOOTPRINT_GEN)
 
+def classify_patch(
+    fix_loc_line: int,
+    patch_file_path: str,
+    used_prods: list[Production],
+    infer_summary_file: str | None,
+    generator: Generator,
+    cluster_manager: ClusterManager,
+):
+    """
+    Put an analyzed patch into a cluster, and update the grammar probabilities
+    based on the cluster it falls into.
+    """
     utilities.global_timer.start(definitions.DURATION_PATCH_CLUSTER)
     if infer_summary_file is None:
         # summary file was not produced - assume the patch could not be compiled
@@ -149,129 +147,387 @@ def gen_patch_and_classify(
             cluster_manager.add_new_noncompilable_patch(patch_file_path)
 
     utilities.global_timer.pause(definitions.DURATION_PATCH_CLUSTER)
+
+
+def gen_patch_and_classify(
+    fix_loc_line: int,
+    fix_loc_end_line: int,
+    generator: Generator,
+    cluster_manager: ClusterManager,
+) -> int:
+    """
+    Generate one patch and classify it into a cluster.
+    :return: 0 if successful, 1 if failed
+    """
+    # (1) generate a patch candidate
+    patch_instruction, used_prods = generate_patch_instruction(fix_loc_line, generator)
+    if patch_instruction is None:
+        return 1
+
+    patch_file_path = patch_utils.weave_patch_instruction(
+        patch_instruction, fix_loc_line, fix_loc_end_line
+    )
+
+    # (2) get the summary of new patch, and put it to suitable cluster
+    utilities.global_timer.start(definitions.DURATION_FOOTPRINT_GEN)
+    infer_summary_file = infer.infer_target_function()
+    utilities.global_timer.pause(definitions.DURATION_FOOTPRINT_GEN)
+
+    classify_patch(
+        fix_loc_line,
+        patch_file_path,
+        used_prods,
+        infer_summary_file,
+        generator,
+        cluster_manager,
+    )
     return 0
 
 
-def repair(
+def gen_patches_and_classify_with_workers(
     fix_loc_line: int,
-    return_stmts: list[str],
-    labels: list[str],
+    fix_loc_end_line: int,
+    generator: Generator,
+    cluster_manager: ClusterManager,
+    search_space_size: int,
+    time_start: float,
     time_budget: float,
+    pool: PatchEvaluationPool,
 ):
-    global total_search_space_size
+    """
+    Main repair loop when patches are evaluated by a pool of workers.
+    Patch generation, clustering and probability updates stay in this process;
+    only weaving and running Infer are done by the workers.
+    """
+    # patch file path => productions used for generating it
+    in_flight: dict[str, list[Production]] = dict()
 
-    assert values.TARGET_BUG is not None
+    while True:
+        time_left = time_budget - (time.perf_counter() - time_start)
+        if time_left <= 0:
+            emitter.information(
+                f"Loc {fix_loc_line}: Ending repair loop since time budget is exceeded"
+            )
+            break
+        num_seen = cluster_manager.get_total_num_patches() + len(in_flight)
+        is_exhausted = num_seen >= search_space_size or generator.is_exhausted()
+        if is_exhausted and not in_flight:
+            emitter.information(
+                f"Loc {fix_loc_line}: Ending repair loop since search space is exhausted"
+            )
+            break
 
-    time_start = time.perf_counter()
+        # keep all workers busy
+        while (
+            len(in_flight) < pool.num_workers
+            and num_seen < search_space_size
+            and not generator.is_exhausted()
+        ):
+            patch_instruction, used_prods = generate_patch_instruction(
+                fix_loc_line, generator
+            )
+            if patch_instruction is None:
+                emitter.warning("did not generate a new patch")
+                break
+            patch_file_path = patch_utils.get_new_patch_file_name()
+            pool.submit(
+                patch_instruction, fix_loc_line, fix_loc_end_line, patch_file_path
+            )
+            in_flight[patch_file_path] = used_prods
+            num_seen += 1
 
-    emitter.title(f"Repairing Program at location: {fix_loc_line}")
+        if not in_flight:
+            continue
 
-    # (3) Compute various things for patch ingredients
-    emitter.sub_title(f"Loc {fix_loc_line}: Getting patch ingredients at fix location")
+        evaluated = pool.get_result(timeout=time_left)
+        if evaluated is None:
+            continue
+        classify_evaluated_patch(
+            fix_loc_line, evaluated, in_flight, generator, cluster_manager
+        )
 
-    utilities.global_timer.start(definitions.DURATION_CODEQL_STMT_BOUNDARY)
-    emitter.information(
-        f"Loc {fix_loc_line}: [Codeql] Running statement boundary query"
-    )
-    codeql.run_stmt_boundary_query(values.TARGET_BUG.file, fix_loc_line)
-    fix_loc_end_line = codeql.parse_stmt_boudary_query_result()
-    emitter.highlight("Statement at fix location ends at line " + str(fix_loc_end_line))
-    utilities.global_timer.stop(definitions.DURATION_CODEQL_STMT_BOUNDARY)
+    # patches still being analyzed have already cost the time; do not waste them,
+    # but do not wait past the overall time budget either
+    while in_flight:
+        drain_timeout = min(
+            values.WORKER_DRAIN_TIMEOUT,
+            utilities.global_timer.get_total_remaining_time(),
+        )
+        evaluated = None
+        if drain_timeout > 0:
+            evaluated = pool.get_result(timeout=drain_timeout)
+        if evaluated is None:
+            # out of time, or a worker died with its patch and nothing will come back
+            emitter.warning(
+                f"Loc {fix_loc_line}: Discarding {len(in_flight)} patches that"
+                " were not evaluated in time"
+            )
+            in_flight.clear()
+            break
+        classify_evaluated_patch(
+            fix_loc_line, evaluated, in_flight, generator, cluster_manager
+        )
 
-    utilities.global_timer.start(definitions.DURATION_CODEQL_EXTRACT_VAR)
-    emitter.information(
-        f"Loc {fix_loc_line}: [Codeql] Running patch ingredient (variable) query"
+
+def classify_evaluated_patch(
+    fix_loc_line: int,
+    evaluated: tuple[str, str | None, float],
+    in_flight: dict[str, list[Production]],
+    generator: Generator,
+    cluster_manager: ClusterManager,
+):
+    """
+    Helper for classifying a patch that comes back from a worker.
+    """
+    patch_file_path, infer_summary_file, footprint_time = evaluated
+    if patch_file_path not in in_flight:
+        # came back after it was given up on; the time budget has moved on
+        if infer_summary_file is not None and os.path.isfile(infer_summary_file):
+            os.remove(infer_summary_file)
+        return
+    used_prods = in_flight.pop(patch_file_path)
+    utilities.global_timer.accumulate(
+        definitions.DURATION_FOOTPRINT_GEN, footprint_time
     )
-    codeql.run_extract_var_query(
-        values.TARGET_BUG.file,
-        values.TARGET_BUG.procedure,
-        values.TARGET_BUG.start_line,
+    classify_patch(
         fix_loc_line,
+        patch_file_path,
+        used_prods,
+        infer_summary_file,
+        generator,
+        cluster_manager,
     )
-    pointer_vars, non_pointer_vars = codeql.parse_extract_var_query_result()
-    emitter.highlight(f"Loc {fix_loc_line}: Pointer variables: " + str(pointer_vars))
-    emitter.highlight(
-        f"Loc {fix_loc_line}: Non-pointer variables: " + str(non_pointer_vars)
-    )
-    result.pointer_vars(fix_loc_line, pointer_vars)
-    result.non_pointer_vars(fix_loc_line, non_pointer_vars)
-    utilities.global_timer.stop(definitions.DURATION_CODEQL_EXTRACT_VAR)
+    if infer_summary_file is not None and os.path.isfile(infer_summary_file):
+        os.remove(infer_summary_file)
 
-    utilities.global_timer.start(definitions.DURATION_CODEQL_CONSTS)
+
+def collect_patch_ingredients(
+    fix_loc_lines: list[int],
+) -> dict[int, tuple[int, list[str], list[str], list[str]]]:
+    """
+    Run the CodeQL queries for patch ingredients at all fix locations, in one batch.
+    :return: map from fix location to (end line of the statement at fix location,
+             pointer variables, non-pointer variables, constants)
+    """
+    assert values.TARGET_BUG is not None
+
+    emitter.sub_title("Getting patch ingredients at fix locations")
+
+    utilities.global_timer.start(definitions.DURATION_CODEQL_LOC_QUERIES)
     emitter.information(
-        f"Loc {fix_loc_line}: [Codeql] Running patch ingredient (constants) query"
+        f"[Codeql] Running statement boundary and patch ingredient (variable, constants)"
+        f" queries for {len(fix_loc_lines)} locations"
     )
-    codeql.run_consts_query(
-        values.TARGET_BUG.file, values.TARGET_BUG.procedure, fix_loc_line
+    loc_to_queries = dict()
+    for fix_loc_line in fix_loc_lines:
+        loc_to_queries[fix_loc_line] = (
+            codeql.stmt_boundary_query(values.TARGET_BUG.file, fix_loc_line),
+            codeql.extract_var_query(
+                values.TARGET_BUG.file,
+                values.TARGET_BUG.procedure,
+                values.TARGET_BUG.start_line,
+                fix_loc_line,
+            ),
+            codeql.consts_query(
+                values.TARGET_BUG.file, values.TARGET_BUG.procedure, fix_loc_line
+            ),
+        )
+    codeql.run_query_batch(
+        [query for queries in loc_to_queries.values() for query in queries]
     )
-    consts = codeql.parse_consts_query_result()
-    emitter.highlight(f"Loc {fix_loc_line}: Constants: " + str(consts))
-    result.constants(fix_loc_line, consts)
-    utilities.global_timer.stop(definitions.DURATION_CODEQL_CONSTS)
+    utilities.global_timer.stop(definitions.DURATION_CODEQL_LOC_QUERIES)
 
-    ################ start doing real repair ##################
+    all_ingredients = dict()
+    for fix_loc_line, queries in loc_to_queries.items():
+        boundary_query, extract_var_query, consts_query = queries
 
-    emitter.sub_title(
-        f"Loc {fix_loc_line}: Initializing Patch Generator and Cluster Manager"
-    )
-    generator = Generator(
-        pointer_vars,
-        non_pointer_vars,
-        return_stmts,
-        labels,
-        consts,
-        values.GENERATOR_MAX_DEPTH,
-    )
-    generator.build_grammar()
-    search_space_size = generator.estimate_size()
+        fix_loc_end_line = codeql.parse_stmt_boudary_query_result(boundary_query[1])
+        emitter.highlight(
+            f"Loc {fix_loc_line}: Statement at fix location ends at line "
+            + str(fix_loc_end_line)
+        )
 
-    cluster_manager = ClusterManager(values.DIR_ALL_PATCHES, "L" + str(fix_loc_line))
+        pointer_vars, non_pointer_vars = codeql.parse_extract_var_query_result(
+            extract_var_query[1]
+        )
+        emitter.highlight(
+            f"Loc {fix_loc_line}: Pointer variables: " + str(pointer_vars)
+        )
+        emitter.highlight(
+            f"Loc {fix_loc_line}: Non-pointer variables: " + str(non_pointer_vars)
+        )
+        result.pointer_vars(fix_loc_line, pointer_vars)
+        result.non_pointer_vars(fix_loc_line, non_pointer_vars)
+
+        consts = codeql.parse_consts_query_result(consts_query[1])
+        emitter.highlight(f"Loc {fix_loc_line}: Constants: " + str(consts))
+        result.constants(fix_loc_line, consts)
+
+        all_ingredients[fix_loc_line] = (
+            fix_loc_end_line,
+            pointer_vars,
+            non_pointer_vars,
+            consts,
+        )
 
-    emitter.sub_title(f"Loc {fix_loc_line}: Entering the main repair loop")
+    return all_ingredients
 
-    emitter.information(
-        f"Loc {fix_loc_line}: Total search space size: {search_space_size}"
-    )
 
-    total_search_space_size += search_space_size
+class LocationRepair:
+    """
+    State of repairing one fix location.
+    The repair loop can be run several times, each time with a new time budget,
+    so that repairs at different locations can be interleaved.
+    """
 
-    if time.perf_counter() - time_start >= time_budget:
-        utilities.error_exit(
-            "Time budget for this location exceeded before entering the main repair loop. Try increasing the time limit."
+    def __init__(
+        self,
+        fix_loc_line: int,
+        return_stmts: list[str],
+        labels: list[str],
+        ingredients: tuple[int, list[str], list[str], list[str]] | None = None,
+    ):
+        """
+        :param ingredients: ingredients at this location from `collect_patch_ingredients`,
+                            if already collected.
+        """
+        global total_search_space_size
+
+        self.fix_loc_line = fix_loc_line
+
+        emitter.title(f"Repairing Program at location: {fix_loc_line}")
+
+        # (3) Compute various things for patch ingredients
+        if ingredients is None:
+            ingredients = collect_patch_ingredients([fix_loc_line])[fix_loc_line]
+        fix_loc_end_line, pointer_vars, non_pointer_vars, consts = ingredients
+        self.fix_loc_end_line = fix_loc_end_line
+
+        ################ start doing real repair ##################
+
+        emitter.sub_title(
+            f"Loc {fix_loc_line}: Initializing Patch Generator and Cluster Manager"
         )
+        self.generator = Generator(
+            pointer_vars,
+            non_pointer_vars,
+            return_stmts,
+            labels,
+            consts,
+            values.GENERATOR_MAX_DEPTH,
+        )
+        self.generator.build_grammar()
+        self.search_space_size = self.generator.estimate_size()
 
-    # send the initial grammar state to result
-    grammar_state = generator.grammar.get_grammar_state()
-    time_elapsed = utilities.global_timer.get_elapsed_from_overall_start()
-    result.new_probability_update(fix_loc_line, time_elapsed, grammar_state)
+        self.cluster_manager = ClusterManager(
+            values.DIR_ALL_PATCHES, "L" + str(fix_loc_line)
+        )
 
-    while True:
-        if time.perf_counter() - time_start >= time_budget:
-            emitter.information(
-                f"Loc {fix_loc_line}: Ending repair loop since time budget is exceeded"
+        emitter.information(
+            f"Loc {fix_loc_line}: Total search space size: {self.search_space_size}"
+        )
+
+        total_search_space_size += self.search_space_size
+
+        # send the initial grammar state to result
+        grammar_state = self.generator.grammar.get_grammar_state()
+        time_elapsed = utilities.global_timer.get_elapsed_from_overall_start()
+        result.new_probability_update(fix_loc_line, time_elapsed, grammar_state)
+
+    def is_exhausted(self) -> bool:
+        if self.generator.is_exhausted():
+            return True
+        return self.cluster_manager.get_total_num_patches() >= self.search_space_size
+
+    def run(self, time_budget: float, pool: PatchEvaluationPool | None = None):
+        """
+        Run the repair loop until the time budget is used up, or the search
+        space is exhausted.
+        :param pool: if given, patches are evaluated in parallel by the workers in it.
+        """
+        fix_loc_line = self.fix_loc_line
+        time_start = time.perf_counter()
+
+        emitter.sub_title(f"Loc {fix_loc_line}: Entering the main repair loop")
+
+        if pool is not None:
+            gen_patches_and_classify_with_workers(
+                fix_loc_line,
+                self.fix_loc_end_line,
+                self.generator,
+                self.cluster_manager,
+                self.search_space_size,
+                time_start,
+                time_budget,
+                pool,
             )
-            break
-        if cluster_manager.get_total_num_patches() == search_space_size:
-            emitter.information(
-                f"Loc {fix_loc_line}: Ending repair loop since search space is exhausted"
+            return
+
+        while True:
+            if time.perf_counter() - time_start >= time_budget:
+                emitter.information(
+                    f"Loc {fix_loc_line}: Ending repair loop since time budget is exceeded"
+                )
+                break
+            if self.is_exhausted():
+                emitter.information(
+                    f"Loc {fix_loc_line}: Ending repair loop since search space is exhausted"
+                )
+                break
+            ret = gen_patch_and_classify(
+                fix_loc_line,
+                self.fix_loc_end_line,
+                self.generator,
+                self.cluster_manager,
             )
-            break
-        ret = gen_patch_and_classify(
-            fix_loc_line, fix_loc_end_line, generator, cluster_manager
-        )
-        if ret != 0:
-            emitter.warning("did not generate a new patch")
+            if ret != 0:
+                emitter.warning("did not generate a new patch")
+
+    def finish(self) -> ClusterManager:
+        """
+        Record the results of this location, once no more repair will happen.
+        """
+        fix_loc_line = self.fix_loc_line
+        cluster_manager = self.cluster_manager
 
-    emitter.sub_title(f"Loc {fix_loc_line}: Repair loop finished")
+        emitter.sub_title(f"Loc {fix_loc_line}: Repair loop finished")
 
-    result.num_clusters(fix_loc_line, cluster_manager.get_num_clusters())
-    result.num_total_patches(fix_loc_line, cluster_manager.get_total_num_patches())
-    good_cluster_names = [
-        c.cluster_name for c in cluster_manager.clusters if c.is_locally_good
-    ]
-    result.locally_plausible_cluster_names(fix_loc_line, good_cluster_names)
+        result.num_clusters(fix_loc_line, cluster_manager.get_num_clusters())
+        result.num_total_patches(fix_loc_line, cluster_manager.get_total_num_patches())
+        good_cluster_names = [
+            c.cluster_name for c in cluster_manager.clusters if c.is_locally_good
+        ]
+        result.locally_plausible_cluster_names(fix_loc_line, good_cluster_names)
 
-    return cluster_manager
+        return cluster_manager
+
+
+def repair(
+    fix_loc_line: int,
+    return_stmts: list[str],
+    labels: list[str],
+    time_budget: float,
+    pool: PatchEvaluationPool | None = None,
+    ingredients: tuple[int, list[str], list[str], list[str]] | None = None,
+):
+    """
+    Repair at one fix location, within the given time budget.
+    :param pool: if given, patches are evaluated in parallel by the workers in it.
+    :param ingredients: ingredients at this location from `collect_patch_ingredients`,
+                        if already collected.
+    """
+    time_start = time.perf_counter()
+
+    location = LocationRepair(fix_loc_line, return_stmts, labels, ingredients)
+
+    time_left = time_budget - (time.perf_counter() - time_start)
+    if time_left <= 0:
+        utilities.error_exit(
+            "Time budget for this location exceeded before entering the main repair loop. Try increasing the time limit."
+        )
+
+    location.run(time_left, pool)
+    return location.finish()
 
 
 def print_repair_stats(cluster_managers: list[ClusterManager]):
@@ -304,6 +560,11 @@ def print_repair_stats(cluster_managers: list[ClusterManager]):
         definitions.DURATION_PATCH_CLUSTER, num_total_patches
     )
 
+    query_cache = SmtFormula.query_cache
+    emitter.information(
+        f"SMT query cache: {query_cache.hits} hits, {query_cache.misses} misses"
+    )
+
     # patch stats
     average_patches_per_cluster = num_total_patches / num_total_clusters
 
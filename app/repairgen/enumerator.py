@@ -0,0 +1,127 @@
+"""
+Enumerate sentences of a CFG in descending order of probability.
+"""
+
+import heapq
+import itertools
+import math
+
+from app.repairgen.grammar import CFG, Production
+
+
+class BestFirstEnumerator:
+    """
+    Lazily enumerates sentences of a grammar, most probable first.
+
+    A priority queue holds partial derivations, ordered by the probability of the
+    productions used so far. Since expanding a derivation can only make it less
+    probable, a complete derivation popped from the queue is the most probable one
+    left. The leftmost non-terminal is always expanded first, which makes each
+    derivation unique.
+
+    Expansion follows the same rules as `CFG.gen_random`: a non-terminal with
+    remaining depth 0 can only use productions without non-terminals, and a
+    production cannot be used again below itself.
+    """
+
+    def __init__(self, grammar: CFG, depth: int):
+        assert grammar.starting_nonterminal is not None
+
+        self.grammar = grammar
+        # sentences returned so far; never return one twice
+        self.emitted: set[str] = set()
+        # -log(probability) of each production, per symbol id
+        self.costs: list[dict[Production, float]] = [dict() for _ in grammar.symbols]
+        self.grammar_version = -1
+        self.update_costs()
+
+        # tie-breaker, so that entries with equal costs are never compared further
+        self.counter = itertools.count()
+        # entry: [cost, tie-breaker, sentence so far, pending symbols, used productions]
+        # pending symbols are either terminals (str), or non-terminals with their
+        # remaining depth and black list bits: (symbol id, depth, black list)
+        start_id = grammar.symbol_ids[grammar.starting_nonterminal]
+        start = (start_id, depth - 1, 0)
+        self.frontier: list[list] = [[0.0, next(self.counter), "", (start,), ()]]
+
+    def update_costs(self):
+        for symbol, prod_list in self.grammar.sym_to_prods.items():
+            probabilities = prod_list.get_normalized_probabilities()
+            self.costs[self.grammar.symbol_ids[symbol]] = {
+                prod: -math.log(p) if p > 0 else math.inf
+                for prod, p in probabilities.items()
+            }
+        self.grammar_version = self.grammar.version
+
+    def rerank(self):
+        """
+        Probabilities in the grammar have changed; recompute the cost of every
+        pending derivation, and restore the heap order.
+        """
+        self.update_costs()
+        for entry in self.frontier:
+            entry[0] = sum(self.costs[sym_id][prod] for sym_id, prod in entry[4])
+        heapq.heapify(self.frontier)
+
+    def expand(self, entry: list):
+        """
+        Expand the leftmost non-terminal of a partial derivation, and push all the
+        results back to the frontier.
+        """
+        cost, _, sentence, pending, used = entry
+        (sym_id, depth, black_list), rest = pending[0], pending[1:]
+        is_nonterminal_id = self.grammar.is_nonterminal_id
+        for prod in self.grammar.get_allowed_productions(sym_id, depth, black_list):
+            child_black_list = black_list | prod.recursion_bit
+            new_pending = tuple(
+                (i, depth - 1, child_black_list) if is_nonterminal_id[i] else s
+                for s, i in zip(prod.rule, prod.symbol_ids)
+            )
+            new_sentence, new_pending = self.consume_terminals(
+                sentence, new_pending + rest
+            )
+            heapq.heappush(
+                self.frontier,
+                [
+                    cost + self.costs[sym_id][prod],
+                    next(self.counter),
+                    new_sentence,
+                    new_pending,
+                    used + ((sym_id, prod),),
+                ],
+            )
+
+    @staticmethod
+    def consume_terminals(sentence: str, pending: tuple) -> tuple[str, tuple]:
+        """
+        Move terminals at the front of pending symbols to the sentence.
+        """
+        idx = 0
+        while idx < len(pending) and isinstance(pending[idx], str):
+            sentence += pending[idx] + " "
+            idx += 1
+        return sentence, pending[idx:]
+
+    def next(self) -> tuple[str | None, list[Production]]:
+        """
+        :return: the most probable sentence not returned before, and the productions
+                 used (in the same order as `CFG.gen_random`); None if exhausted.
+        """
+        if self.grammar_version != self.grammar.version:
+            self.rerank()
+
+        while self.frontier:
+            entry = heapq.heappop(self.frontier)
+            sentence, pending, used = entry[2], entry[3], entry[4]
+            if pending:
+                self.expand(entry)
+                continue
+            if sentence in self.emitted:
+                continue
+            self.emitted.add(sentence)
+            return sentence, [prod for _, prod in used]
+
+        return None, []
+
+    def is_exhausted(self) -> bool:
+        return not self.frontier
@@ -1,3 +1,7 @@
+import random
+
+from app import values
+from app.repairgen.enumerator import BestFirstEnumerator
 from app.repairgen.grammar import CFG, Production
 
 
@@ -14,6 +18,10 @@ class Generator:
         self.generated_instrs = set()
         # max allowed depth for unrolling the grammar
         self.depth = depth
+        # derivations not generated yet; set up once the size is known
+        self.unused_derivations: RankPool | None = None
+        # only used by the best-first generation engine
+        self.enumerator: BestFirstEnumerator | None = None
 
     def gather_exit_stmts(self):
         """
@@ -127,22 +135,123 @@ class Generator:
         g.finalize_grammar(self.depth)
 
         self.grammar = g
+        if values.GENERATION_ENGINE == "best-first":
+            self.enumerator = BestFirstEnumerator(g, self.depth)
+
+    def generate(self, is_random) -> tuple[str | None, list[Production]]:
+        """
+        Generate a new sentence with the configured generation engine.
+        :return: None as the sentence if nothing new can be generated.
+        """
+        if self.enumerator is not None:
+            patch_instruction, used_prods = self.enumerator.next()
+            if patch_instruction is not None:
+                self.generated_instrs.add(patch_instruction)
+            return patch_instruction, used_prods
+        return self.gen_random(is_random)
 
     def gen_random(self, is_random) -> tuple[str | None, list[Production]]:
         """
         Generate a random sentence based on current grammar and grammar state.
         Make sure no duplicates are produced from one generator.
+        If `is_random`, derivations are drawn uniformly without replacement.
+        Otherwise they are sampled from the learned probabilities; if that keeps
+        hitting derivations drawn before, a uniform draw from the rest is used.
         """
-        patch_instruction, used_prods = self.grammar.gen_random(self.depth, is_random)
-        while patch_instruction in self.generated_instrs:
-            patch_instruction, used_prods = self.grammar.gen_random(
-                self.depth, is_random
-            )
-        self.generated_instrs.add(patch_instruction)
-        return patch_instruction, used_prods
+        if self.unused_derivations is None:
+            self.estimate_size()
+        assert self.unused_derivations is not None
+
+        num_rejected = 0
+        while not self.unused_derivations.is_empty():
+            if is_random or num_rejected >= values.MAX_GENERATION_REJECTIONS:
+                rank = self.unused_derivations.draw()
+                patch_instruction, used_prods = self.grammar.unrank(rank, self.depth)
+            else:
+                patch_instruction, used_prods = self.grammar.gen_random(
+                    self.depth, is_random
+                )
+                if patch_instruction is None or not self.unused_derivations.remove(
+                    self.grammar.rank(used_prods, self.depth)
+                ):
+                    num_rejected += 1
+                    continue
+            # different derivations may still spell out the same sentence
+            if patch_instruction in self.generated_instrs:
+                continue
+            self.generated_instrs.add(patch_instruction)
+            return patch_instruction, used_prods
+
+        return None, []
+
+    def is_exhausted(self) -> bool:
+        """
+        Whether it is known that no new sentences can be generated.
+        """
+        if self.enumerator is not None:
+            return self.enumerator.is_exhausted()
+        return (
+            self.unused_derivations is not None and self.unused_derivations.is_empty()
+        )
 
     def estimate_size(self):
+        """
+        :return: exact number of derivations of the grammar.
+        """
         starting_sym = self.grammar.starting_nonterminal
-        self.grammar.fill_prod_cache_for_base_cases()
+        self.grammar.fill_prod_cache(self.depth)
         size = self.grammar.estimate_size(starting_sym, self.depth)
+        if self.unused_derivations is None:
+            self.unused_derivations = RankPool(size)
         return size
+
+
+class RankPool:
+    """
+    The ranks 0..size-1 of derivations that have not been drawn yet.
+    Works as a lazy Fisher-Yates shuffle: only moved positions are stored, so
+    that the space is proportional to the number of draws, not to `size`.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.num_drawn = 0
+        # position => rank, and its inverse; absent entries map to themselves
+        self.rank_at: dict[int, int] = dict()
+        self.position_of: dict[int, int] = dict()
+
+    def is_empty(self) -> bool:
+        return self.num_drawn >= self.size
+
+    def swap_to_drawn(self, position: int) -> int:
+        """
+        Move the rank at `position` to the end of the drawn part.
+        :return: the moved rank.
+        """
+        front = self.num_drawn
+        rank = self.rank_at.get(position, position)
+        front_rank = self.rank_at.get(front, front)
+        self.rank_at[position] = front_rank
+        self.position_of[front_rank] = position
+        self.rank_at[front] = rank
+        self.position_of[rank] = front
+        self.num_drawn += 1
+        return rank
+
+    def draw(self) -> int:
+        """
+        Draw a rank uniformly at random from those not drawn yet.
+        """
+        assert not self.is_empty()
+        return self.swap_to_drawn(random.randint(self.num_drawn, self.size - 1))
+
+    def remove(self, rank: int) -> bool:
+        """
+        Mark `rank` as drawn.
+        :return: False if it had been drawn before.
+        """
+        position = self.position_of.get(rank, rank)
+        if position < self.num_drawn:
+            return False
+        self.swap_to_drawn(position)
+        return True
@@ -1,54 +1,81 @@
 import random
 from collections import defaultdict
 
+import numpy as np
+
 from app import emitter, values
 from app.equivalence.cluster import RewardType
-from app.repairgen import patch_utils
 
 
 class Production:
     """
     Represent RHS of a production rule.
+    Productions are compared by their string; the string and its hash are
+    computed once. Fields other than `rule` are filled in by `CFG.compile`.
     """
 
+    __slots__ = (
+        "rule",
+        "rule_str",
+        "hash_value",
+        "prod_id",
+        "symbol_ids",
+        "nonterminal_ids",
+        "is_terminal_only",
+        "recursion_bit",
+    )
+
     def __init__(self, rule_str: str):
         self.rule: list[str] = rule_str.split()
+        self.rule_str: str = " ".join(self.rule)
+        self.hash_value: int = hash(self.rule_str)
+        # same for all productions with the same string
+        self.prod_id: int = -1
+        self.symbol_ids: tuple[int, ...] = ()
+        # ids of the non-terminals in the rule, in order
+        self.nonterminal_ids: tuple[int, ...] = ()
+        self.is_terminal_only: bool = False
+        # bit of this production in black lists; 0 if it is never black listed
+        self.recursion_bit: int = 0
 
     def get_symbol_list(self):
         return self.rule
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, Production):
             return False
-        this_str = " ".join(self.rule)
-        other_str = " ".join(other.rule)
-        return this_str == other_str
+        return self.rule_str == other.rule_str
 
     def __hash__(self):
-        return hash(" ".join(self.rule))
+        return self.hash_value
 
     def __str__(self):
-        ret = " ".join(self.rule)
-        return ret
+        return self.rule_str
 
 
 class ProductionList:
     """
     Represent a list of RHS productions of a symbol.
+    Probabilities and weights are kept in arrays, indexed by the position of each
+    production in `productions`. Probabilities are the same at every depth.
     """
 
     def __init__(self):
-        # map from production to a map from recur_depth to probability
-        # the two floats are (pe, ppie), where the final probability is the average of the two
-        # invariant: sum of all probabilities at each recur_depth is 1
-        self.productions: dict[Production, dict[int, tuple[float, float]]] = (
-            defaultdict()
-        )
-        # map from production to the probability weights for pe and ppie
-        # note that the weights are global, not per depth
-        self.prod_weights: dict[Production, tuple[int, int]] = defaultdict(
-            lambda: (1, 1)
-        )
+        self.productions: list[Production] = []
+        # map from production to its index in the arrays below
+        self.prod_index: dict[Production, int] = dict()
+        # the two probabilities of each production are (pe, ppie), and the final
+        # probability is proportional to their product
+        # invariant: each of pe and ppie sums up to 1
+        self.pe: np.ndarray = np.zeros(0)
+        self.ppie: np.ndarray = np.zeros(0)
+        # prefix sums of pe * ppie, for sampling
+        self.cumulative: np.ndarray = np.zeros(0)
+        # probability weights for pe and ppie
+        self.weight_pe: np.ndarray = np.ones(0, dtype=np.int64)
+        self.weight_ppie: np.ndarray = np.ones(0, dtype=np.int64)
         # whether is relevant to path/effect
         self.relevant_to_path = True
         self.relevant_to_effect = True
@@ -64,12 +91,19 @@ class ProductionList:
         relevant_to_path,
         relevant_to_effect,
     ):
-        self.productions[prod] = defaultdict()
+        if prod not in self.prod_index:
+            self.prod_index[prod] = len(self.productions)
+            self.productions.append(prod)
+            self.num_prods += 1
         self.prod_cache[prod] = defaultdict()
-        self.num_prods += 1
         self.relevant_to_path = relevant_to_path
         self.relevant_to_effect = relevant_to_effect
 
+    def set_probabilities(self, pe: np.ndarray, ppie: np.ndarray):
+        self.pe = pe
+        self.ppie = ppie
+        self.cumulative = np.cumsum(pe * ppie)
+
     def init_baseline_probabilities(self, total_depth: int):
         """
         Populate this list of productions with initial probabilties, which is just
@@ -78,33 +112,35 @@ class ProductionList:
         equal_probability = 0.0
         if self.num_prods > 0:
             equal_probability = 1.0 / self.num_prods
-        for prod in self.productions:
-            for i in range(total_depth + 1):
-                self.productions[prod][i] = (equal_probability, equal_probability)
+        self.set_probabilities(
+            np.full(self.num_prods, equal_probability),
+            np.full(self.num_prods, equal_probability),
+        )
 
     def update_probabilities_based_on_cache(self):
         """
         Assuming prod_cache is in place, use it to update probabilities.
+        Since probabilities do not depend on depth, the counts at the largest
+        depth are used.
         """
-        # first, get the total number of sentences at each depth
-        total_sentences_at_depth = defaultdict(int)
-        for prod in self.prod_cache:
-            for depth in self.prod_cache[prod]:
-                raw_count = self.prod_cache[prod][depth]
-                if raw_count != -1:  # exclude unmodified cells
-                    total_sentences_at_depth[depth] += raw_count
-
-        # then, update probabilities
-        for prod in self.prod_cache:
-            for depth in self.prod_cache[prod]:
-                if total_sentences_at_depth[depth] == 0:
-                    # at this depth, no sentences can be derived from any rule
-                    # => just equally distribute them
-                    p = 1.0 / self.num_prods
-                    self.productions[prod][depth] = (p, p)
-                else:
-                    p = self.prod_cache[prod][depth] / total_sentences_at_depth[depth]
-                    self.productions[prod][depth] = (p, p)
+        if self.num_prods == 0:
+            return
+        max_depth = max(
+            max(self.prod_cache[prod], default=0) for prod in self.productions
+        )
+        counts = np.array(
+            [self.prod_cache[prod].get(max_depth, -1) for prod in self.productions],
+            dtype=float,
+        )
+        # exclude unmodified cells
+        counts[counts == -1] = 0
+        total_sentences = counts.sum()
+        if total_sentences == 0:
+            # no sentences can be derived from any rule => just equally distribute them
+            probabilities = np.full(self.num_prods, 1.0 / self.num_prods)
+        else:
+            probabilities = counts / total_sentences
+        self.set_probabilities(probabilities, probabilities.copy())
 
     def set_default_cache_value(self, total_depth: int):
         """
@@ -138,168 +174,114 @@ class ProductionList:
         for depth in self.prod_cache[prod]:
             self.prod_cache[prod][depth] = new_count
 
-    def update_probabilities(
-        self,
-        prods_to_update: list[Production],
-        pe_increment: RewardType,
-        ppie_increment: RewardType,
-    ):
+    @staticmethod
+    def redistribute(
+        old: np.ndarray,
+        to_update: np.ndarray,
+        increment: RewardType,
+        big_increment_fraction: float,
+        small_increment_fraction: float,
+        is_relevant: bool,
+    ) -> np.ndarray:
         """
-        Update probabilities directly.
+        Move probability mass to the productions in mask `to_update`, and scale the
+        others down so that the sum stays the same.
+        :return: new probabilities.
         """
-        big_increment_fraction_pe = values.ADJ_FACTOR_SMALL
-        small_increment_fraction_pe = values.ADJ_FACTOR_SMALL
-
-        big_increment_fraction_ppie = values.ADJ_FACTOR_BIG
-        small_increment_fraction_ppie = values.ADJ_FACTOR_SMALL
-
-        prods_to_update = [prod for prod in prods_to_update if prod in self.productions]
-        prods_unchanged = [
-            prod for prod in self.productions if prod not in prods_to_update
-        ]
-
-        old_values_for_to_update = [
-            self.productions[prod][0] for prod in prods_to_update
-        ]
-        old_values_for_unchanged = [
-            self.productions[prod][0] for prod in prods_unchanged
-        ]
-
-        old_pe_for_to_update = [pe for pe, _ in old_values_for_to_update]
-        old_ppie_for_to_update = [ppie for _, ppie in old_values_for_to_update]
-        old_pe_for_unchanged = [pe for pe, _ in old_values_for_unchanged]
-        old_ppie_for_unchanged = [ppie for _, ppie in old_values_for_unchanged]
+        new = old.copy()
+        unchanged = ~to_update
 
         # calculate new values for those that are to be updated (rewarded)
-        new_pe_for_to_update = old_pe_for_to_update
-        sum_old_pe_for_to_update = sum(old_pe_for_to_update)
-        if self.relevant_to_effect:
-            if pe_increment == RewardType.BIG:
-                total_extra_to_distribute = (
-                    1 - sum_old_pe_for_to_update
-                ) * big_increment_fraction_pe
-            elif pe_increment == RewardType.SMALL:
-                total_extra_to_distribute = (
-                    1 - sum_old_pe_for_to_update
-                ) * small_increment_fraction_pe
+        sum_old_for_to_update = old[to_update].sum()
+        if is_relevant:
+            if increment == RewardType.BIG:
+                fraction = big_increment_fraction
+            elif increment == RewardType.SMALL:
+                fraction = small_increment_fraction
             else:  # no
-                total_extra_to_distribute = 0
-            if sum_old_pe_for_to_update == 0:
+                fraction = 0
+            total_extra_to_distribute = (1 - sum_old_for_to_update) * fraction
+            if sum_old_for_to_update == 0:
                 # avoid div-by-zero
                 # since old sum is already zero, we dont need to distribute new
                 # things proportional to their old values
-                new_pe_for_to_update = [
-                    pe + (1 / len(old_pe_for_to_update)) * total_extra_to_distribute
-                    for pe in old_pe_for_to_update
-                ]
-            else:
-                new_pe_for_to_update = [
-                    pe + (pe / sum_old_pe_for_to_update) * total_extra_to_distribute
-                    for pe in old_pe_for_to_update
-                ]
-
-        new_ppie_for_to_update = old_ppie_for_to_update
-        sum_old_ppie_for_to_update = sum(old_ppie_for_to_update)
-        if self.relevant_to_path:
-            if ppie_increment == RewardType.BIG:
-                total_extra_to_distribute = (
-                    1 - sum_old_ppie_for_to_update
-                ) * big_increment_fraction_ppie
-            elif ppie_increment == RewardType.SMALL:
-                total_extra_to_distribute = (
-                    1 - sum_old_ppie_for_to_update
-                ) * small_increment_fraction_ppie
-            else:  # no
-                total_extra_to_distribute = 0
-            if sum_old_ppie_for_to_update == 0:
-                # avoid div-by-zero
-                # since old sum is already zero, we dont need to distribute new
-                # things proportional to their old values
-                new_ppie_for_to_update = [
-                    ppie + (1 / len(old_ppie_for_to_update)) * total_extra_to_distribute
-                    for ppie in old_ppie_for_to_update
-                ]
+                new[to_update] += total_extra_to_distribute / np.count_nonzero(
+                    to_update
+                )
             else:
-                new_ppie_for_to_update = [
-                    ppie
-                    + (ppie / sum_old_ppie_for_to_update) * total_extra_to_distribute
-                    for ppie in old_ppie_for_to_update
-                ]
+                new[to_update] += (
+                    old[to_update] / sum_old_for_to_update * total_extra_to_distribute
+                )
 
         # calculate new values for those that did not get a reward
-        sum_old_pe_for_unchanged = sum(old_pe_for_unchanged)
-        sum_new_pe_for_to_update = sum(new_pe_for_to_update)
-        if sum_old_pe_for_unchanged == 0:
-            # they were already zero; cant be decreased further
-            new_pe_for_unchanged = old_pe_for_unchanged
-        else:
-            new_pe_for_unchanged = [
-                (1 - sum_new_pe_for_to_update) * (pe / sum_old_pe_for_unchanged)
-                for pe in old_pe_for_unchanged
-            ]
+        sum_old_for_unchanged = old[unchanged].sum()
+        # if they were already zero, they cant be decreased further
+        if sum_old_for_unchanged != 0:
+            new[unchanged] = (1 - new[to_update].sum()) * (
+                old[unchanged] / sum_old_for_unchanged
+            )
+        return new
 
-        sum_old_ppie_for_unchanged = sum(old_ppie_for_unchanged)
-        sum_new_ppie_for_to_update = sum(new_ppie_for_to_update)
-        if sum_old_ppie_for_unchanged == 0:
-            # they were already zero; cant be decreased further
-            new_ppie_for_unchanged = old_ppie_for_unchanged
-        else:
-            new_ppie_for_unchanged = [
-                (1 - sum_new_ppie_for_to_update) * (ppie / sum_old_ppie_for_unchanged)
-                for ppie in old_ppie_for_unchanged
-            ]
+    def update_probabilities(
+        self,
+        prods_to_update: list[Production],
+        pe_increment: RewardType,
+        ppie_increment: RewardType,
+    ):
+        """
+        Update probabilities directly.
+        """
+        to_update = np.zeros(self.num_prods, dtype=bool)
+        for prod in prods_to_update:
+            if prod in self.prod_index:
+                to_update[self.prod_index[prod]] = True
+        if not to_update.any():
+            return
+
+        old_pe, old_ppie = self.pe, self.ppie
+        new_pe = self.redistribute(
+            old_pe,
+            to_update,
+            pe_increment,
+            values.ADJ_FACTOR_SMALL,
+            values.ADJ_FACTOR_SMALL,
+            self.relevant_to_effect,
+        )
+        new_ppie = self.redistribute(
+            old_ppie,
+            to_update,
+            ppie_increment,
+            values.ADJ_FACTOR_BIG,
+            values.ADJ_FACTOR_SMALL,
+            self.relevant_to_path,
+        )
+        self.set_probabilities(new_pe, new_ppie)
 
-        # update the probabilities
-        for i, prod in enumerate(prods_to_update):
-            new_pe = new_pe_for_to_update[i]
-            new_ppie = new_ppie_for_to_update[i]
-            # debugging
-            old_pe, old_ppie = self.productions[prod][0]
+        # debugging; rewarded ones first
+        for idx in np.concatenate(
+            [np.flatnonzero(to_update), np.flatnonzero(~to_update)]
+        ):
             emitter.information(
                 "Prod probability update: "
-                + str(prod)
+                + str(self.productions[idx])
                 + " : "
                 + "pe: "
-                + format(old_pe, ".3f")
+                + format(old_pe[idx], ".3f")
                 + "=>"
-                + format(new_pe, ".3f")
+                + format(new_pe[idx], ".3f")
                 + " ; "
                 + "ppie: "
-                + format(old_ppie, ".3f")
+                + format(old_ppie[idx], ".3f")
                 + "=>"
-                + format(new_ppie, ".3f")
+                + format(new_ppie[idx], ".3f")
             )
-            for depth in self.productions[prod]:
-                self.productions[prod][depth] = (new_pe, new_ppie)
-
-        for i, prod in enumerate(prods_unchanged):
-            new_pe = new_pe_for_unchanged[i]
-            new_ppie = new_ppie_for_unchanged[i]
-            # debugging
-            old_pe, old_ppie = self.productions[prod][0]
-            emitter.information(
-                "Prod probability update: "
-                + str(prod)
-                + " : "
-                + "pe: "
-                + format(old_pe, ".3f")
-                + "=>"
-                + format(new_pe, ".3f")
-                + " ; "
-                + "ppie: "
-                + format(old_ppie, ".3f")
-                + "=>"
-                + format(new_ppie, ".3f")
-            )
-            for depth in self.productions[prod]:
-                self.productions[prod][depth] = (new_pe, new_ppie)
 
     def init_prod_weights(self):
         """
-        For the product weights dict to have all entries, do the initialization here.
+        Reset the product weights of all productions.
         """
-        for prod in self.productions:
-            self.prod_weights[prod] = (1, 1)
+        self.weight_pe = np.ones(self.num_prods, dtype=np.int64)
+        self.weight_ppie = np.ones(self.num_prods, dtype=np.int64)
 
     def update_prod_weights(
         self, prods_to_update: list[Production], weight_incre_pe: int, weight_incre_ppie
@@ -307,70 +289,57 @@ class ProductionList:
         """
         Update the weights for the given productions.
         """
-        for prod in prods_to_update:
-            # note: use this to check, because self.prod_weights is not initialized
-            if prod not in self.prod_weights:
-                continue
-            (weight_pe, weight_ppie) = self.prod_weights[prod]
-            new_weight_pe = weight_pe
-            new_weight_ppie = weight_ppie
-
-            if self.relevant_to_effect:
-                new_weight_pe = weight_pe + weight_incre_pe
-            if self.relevant_to_path:
-                new_weight_ppie = weight_ppie + weight_incre_ppie
-            self.prod_weights[prod] = (new_weight_pe, new_weight_ppie)
+        indices = [
+            self.prod_index[prod] for prod in prods_to_update if prod in self.prod_index
+        ]
+        if self.relevant_to_effect:
+            np.add.at(self.weight_pe, indices, weight_incre_pe)
+        if self.relevant_to_path:
+            np.add.at(self.weight_ppie, indices, weight_incre_ppie)
 
     def update_probabilities_based_on_weights(self):
         """
         Assuming weights have been updated, use it to re-calibrate the probabilities.
         """
-        all_weight_pairs = self.prod_weights.values()
-        total_weight_pe = sum([pair[0] for pair in all_weight_pairs])
-        total_weight_ppie = sum([pair[1] for pair in all_weight_pairs])
-
-        for prod in self.prod_weights:
-            (weight_pe, weight_ppie) = self.prod_weights[prod]
-            p_pe = weight_pe / total_weight_pe
-            p_ppie = weight_ppie / total_weight_ppie
-
-            for depth in self.productions[prod]:
-                self.productions[prod][depth] = (p_pe, p_ppie)
+        if self.num_prods == 0:
+            return
+        self.set_probabilities(
+            self.weight_pe / self.weight_pe.sum(),
+            self.weight_ppie / self.weight_ppie.sum(),
+        )
 
     def get_productions_only(self) -> list[Production]:
-        return list(self.productions.keys())
+        return list(self.productions)
 
-    def get_shuffled_productions_only(
-        self, at_depth: int, is_random: bool
-    ) -> list[Production]:
+    def sample_index(self, cumulative: np.ndarray, is_random: bool) -> int:
         """
-        Get the list of productions, but in order shuffled according to the probability
-        at current depth.
+        Choose an index at random; uniformly if `is_random`, otherwise according
+        to the probabilities whose prefix sums are `cumulative`.
         """
-        prod_list = list(self.productions.keys())
-        if not prod_list:
-            return []
-        random.shuffle(prod_list)
-        if is_random:
-            selected_index = random.randint(0, len(prod_list) - 1)
-            return [prod_list[selected_index]]
-        else:
-            probability_pairs = [self.productions[prod][at_depth] for prod in prod_list]
-            probability_products = [pe * ppie for (pe, ppie) in probability_pairs]
-            total_probability = sum(probability_products)
-            prefix_sums = [probability_products[0]]
-            for i in range(1, len(probability_products) - 1):
-                prefix_sums.append(prefix_sums[i - 1] + probability_products[i])
-            prefix_sums.append(total_probability)
+        num_choices = len(cumulative)
+        total_probability = cumulative[-1]
+        if is_random or total_probability <= 0:
+            return random.randrange(num_choices)
 
-            random_value = random.uniform(0, total_probability)
+        random_value = random.uniform(0, total_probability)
+        # index of the first element in prefix sums greater than random value
+        selected_index = int(np.searchsorted(cumulative, random_value, "right"))
+        if selected_index == num_choices:
+            # random value is the total; take the last one with non-zero probability
+            selected_index = int(np.searchsorted(cumulative, total_probability))
+        return selected_index
 
-            # get index of the first element in prefix sums greater than random value
-            upper_bound = min(n for n in prefix_sums if n > random_value)
-            selected_index = prefix_sums.index(upper_bound)
-            selection = prod_list[selected_index]
-
-            return [selection]
+    def choose_among(self, indices: np.ndarray, is_random: bool) -> int:
+        """
+        Choose one of the productions at `indices` at random, with probabilities
+        (which are the same at every depth) renormalized among them.
+        :return: position of the chosen one in `indices`.
+        """
+        if len(indices) == self.num_prods:
+            # all productions, in order; prefix sums are already there
+            return self.sample_index(self.cumulative, is_random)
+        cumulative = np.cumsum(self.pe[indices] * self.ppie[indices])
+        return self.sample_index(cumulative, is_random)
 
     def print_prod_cache(self):
         """
@@ -391,33 +360,36 @@ class ProductionList:
         For debugging.
         """
         s = "Production list: \n"
-        for prod in self.productions:
+        for idx, prod in enumerate(self.productions):
             s += str(prod) + ": "
-            for depth in self.productions[prod]:
-                s += "<" + str(depth) + ","
-                s += str(self.productions[prod][depth]) + ">"
-                s += " ; "
+            s += str((float(self.pe[idx]), float(self.ppie[idx])))
             s += "\n"
         print(s)
 
+    def get_scaled_probabilities(self) -> np.ndarray:
+        """
+        Probability of choosing each production, as used when sampling.
+        """
+        probability_products = self.pe * self.ppie
+        total_probability = probability_products.sum()
+        if total_probability == 0:
+            return np.full(self.num_prods, 1.0 / self.num_prods)
+        return probability_products / total_probability
+
+    def get_normalized_probabilities(self) -> dict[Production, float]:
+        """
+        Same as `get_scaled_probabilities`, for each production.
+        """
+        return dict(zip(self.productions, self.get_scaled_probabilities().tolist()))
+
     def to_string_with_probabilities(self) -> list[tuple[str, float, float, float]]:
-        res = []
-        prod_list = list(self.productions.keys())
-        probability_pairs = [self.productions[prod][0] for prod in prod_list]
-        probability_products = [pe * ppie for (pe, ppie) in probability_pairs]
-        total_probability = sum(probability_products)
-        scaled_product_probabilities = [
-            p / total_probability for p in probability_products
+        scaled_product_probabilities = self.get_scaled_probabilities().tolist()
+        pe_list = self.pe.tolist()
+        ppie_list = self.ppie.tolist()
+        return [
+            (str(prod), pe_list[idx], ppie_list[idx], scaled_product_probabilities[idx])
+            for idx, prod in enumerate(self.productions)
         ]
-        pe_list = [pair[0] for pair in probability_pairs]
-        ppie_list = [pair[1] for pair in probability_pairs]
-        for idx, prod in enumerate(prod_list):
-            prod_str = str(prod)
-            pe = pe_list[idx]
-            ppie = ppie_list[idx]
-            scaled_product = scaled_product_probabilities[idx]
-            res.append((prod_str, pe, ppie, scaled_product))
-        return res
 
 
 class CFG:
@@ -427,6 +399,28 @@ class CFG:
         self.non_terminals: list[str] = []
         self.starting_nonterminal: str | None = None
 
+        # same as non_terminals, for fast lookup
+        self.non_terminal_set: set[str] = set()
+
+        # bumped whenever probabilities change, so that users can refresh their view
+        self.version = 0
+
+        # compiled representation; see `compile`
+        self.symbol_ids: dict[str, int] = dict()
+        self.symbols: list[str] = []
+        # indexed by symbol id
+        self.is_nonterminal_id: list[bool] = []
+        self.prods_of_symbol: list[list[Production]] = []
+        self.terminal_only_prods_of_symbol: list[list[Production]] = []
+        self.prod_lists: list[ProductionList | None] = []
+        # number of derivations for each (symbol id, depth, black list bits)
+        self.count_cache: dict[tuple[int, int, int], int] = dict()
+        # productions that can derive a sentence, for each (symbol id, depth,
+        # black list bits), with their indices in the production list of the symbol
+        self.feasible_cache: dict[
+            tuple[int, int, int], tuple[list[Production], np.ndarray]
+        ] = dict()
+
         # TODO: is this really useful?
         # cache the result for each [non-terminal][recur_depth] pair
         self.symbol_cache: dict[str, dict[int, str]] = dict()
@@ -460,7 +454,7 @@ class CFG:
         """
         Add a single production rule, where `rhs` is just one production.
         """
-        self.non_terminals.append(lhs)
+        self.specify_nonterminal(lhs)
         prod = Production(rhs)
         self.sym_to_prods[lhs].add_new_production(
             prod, relevant_to_path, relevant_to_effect
@@ -473,7 +467,9 @@ class CFG:
         self.terminals.append(symbol)
 
     def specify_nonterminal(self, symbol):
-        self.non_terminals.append(symbol)
+        if symbol not in self.non_terminal_set:
+            self.non_terminal_set.add(symbol)
+            self.non_terminals.append(symbol)
 
     def specify_starting_nonterminal(self, symbol):
         self.starting_nonterminal = symbol
@@ -486,189 +482,293 @@ class CFG:
             prod_list.init_baseline_probabilities(depth)
             prod_list.init_prod_weights()
             prod_list.set_default_cache_value(depth)
+        self.compile()
+
+    def intern_symbol(self, symbol: str) -> int:
+        if symbol not in self.symbol_ids:
+            self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            self.is_nonterminal_id.append(self.is_nonterminal(symbol))
+            self.prods_of_symbol.append([])
+            self.terminal_only_prods_of_symbol.append([])
+            self.prod_lists.append(None)
+        return self.symbol_ids[symbol]
+
+    def compile(self):
+        """
+        Build integer-coded tables of the grammar, which are used for generation
+        and counting: symbols are interned to ids, and each production records
+        its symbol ids, whether it is terminal-only, and its black list bit.
+        """
+        prod_ids: dict[str, int] = dict()
+        for symbol, prod_list in list(self.sym_to_prods.items()):
+            sym_id = self.intern_symbol(symbol)
+            self.prod_lists[sym_id] = prod_list
+            for prod in prod_list.get_productions_only():
+                prod.prod_id = prod_ids.setdefault(prod.rule_str, len(prod_ids))
+                prod.symbol_ids = tuple(self.intern_symbol(s) for s in prod.rule)
+                prod.nonterminal_ids = tuple(
+                    i for i in prod.symbol_ids if self.is_nonterminal_id[i]
+                )
+                prod.is_terminal_only = not prod.nonterminal_ids
+                self.prods_of_symbol[sym_id].append(prod)
+                if prod.is_terminal_only:
+                    self.terminal_only_prods_of_symbol[sym_id].append(prod)
+        self.compute_recursive_productions()
+        self.count_cache = dict()
+        self.feasible_cache = dict()
 
-    def find_terminals_in_symbol_prods(
-        self, symbol: str, at_depth: int, is_random: bool
-    ) -> tuple[str, Production] | None:
+    def gen_random(
+        self, recur_depth: int, is_random: bool
+    ) -> tuple[str | None, list[Production]]:
         """
-        Given a symbol SYM, find all sentences that can be constructed without
-        unrolling any more non-terminals (in SYM's productions).
-        :return: a tuple of (generated string, used production).
-                 The production with highest probability is preferred.
+        Generate a random sentence from the grammar, in a single top-down pass.
+        Only productions that can still derive a sentence within the remaining
+        depth are drawn, so there is no backtracking.
+        :return: (str, List[Production]) - the generated sentence, and the list of
+                 productions used; (None, []) if no sentence can be derived.
         """
-        prod_list: ProductionList = self.sym_to_prods[symbol]
+        assert self.starting_nonterminal is not None
 
-        for production in prod_list.get_shuffled_productions_only(at_depth, is_random):
-            # productions are already iterated with a rank - the first one should be returned
-            curr_str = ""
-            this_prod_has_nonterminal = False
-            for sym in production.get_symbol_list():
-                if self.is_nonterminal(sym):
-                    this_prod_has_nonterminal = True
-                    break
-                else:
-                    curr_str += sym + " "
-            if not this_prod_has_nonterminal:
-                return (curr_str, production)
+        start_id = self.symbol_ids[self.starting_nonterminal]
+        if not self.is_derivable(start_id, recur_depth - 1, 0):
+            # This can happen when there is no identifier or pointers as patch ingredients
+            return None, []
 
-        return None
+        sentence = ""
+        used_prods = []
+        # pending symbols, in reverse order: terminals (str), or
+        # non-terminals with their depth and black list
+        stack: list = [(start_id, recur_depth - 1, 0)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                sentence += item + " "
+                continue
+            sym_id, depth, black_list = item
+            prods, indices = self.get_feasible_productions(sym_id, depth, black_list)
+            prod_list = self.prod_lists[sym_id]
+            assert prod_list is not None
+            prod = prods[prod_list.choose_among(indices, is_random)]
+            used_prods.append(prod)
+
+            child_black_list = black_list | prod.recursion_bit
+            stack.extend(
+                (i, depth - 1, child_black_list) if self.is_nonterminal_id[i] else sym
+                for sym, i in zip(reversed(prod.rule), reversed(prod.symbol_ids))
+            )
 
-    def gen_random_helper(
-        self,
-        symbol: str,
-        recur_depth: int,
-        remaining_prods_this_lvl: list[Production],
-        black_list: list[Production],
-        is_random: bool,
-    ) -> tuple[str | None, list[Production]]:
+        return sentence, used_prods
+
+    def compute_recursive_productions(self):
         """
-        Generate a random sentence from the grammar, starting with the give symbol.
-        :recur_depth: coins left when we are in the `remaining_prods_this_lvl`.
-        :return: (str, List[Production]) - the generated sentence, and the list of productions used
+        Find productions that can appear again below themselves in a derivation,
+        and give each of them a bit for black lists.
+        Only these are affected by the black list used during generation, since
+        a production appears at most once on a path anyway.
         """
-        # catch corner case, where a non-terminal does not have any productions when initialized
-        # This can happen when there is no identifier or pointers as patch ingredients
-        if not remaining_prods_this_lvl:
-            return None, []
+        # symbol id => non-terminals that can be reached from it (in one or more steps)
+        reachable: list[set[int]] = [
+            {i for prod in prods for i in prod.nonterminal_ids}
+            for prods in self.prods_of_symbol
+        ]
+        changed = True
+        while changed:
+            changed = False
+            for sym_id, sym_reachable in enumerate(reachable):
+                new_reachable = set(sym_reachable)
+                for i in sym_reachable:
+                    new_reachable |= reachable[i]
+                if new_reachable != sym_reachable:
+                    reachable[sym_id] = new_reachable
+                    changed = True
+
+        # productions are compared by their string, so equal productions of
+        # different symbols also block each other
+        owners: dict[int, set[int]] = defaultdict(set)
+        for sym_id, prods in enumerate(self.prods_of_symbol):
+            for prod in prods:
+                owners[prod.prod_id].add(sym_id)
+
+        recursion_bits: dict[int, int] = dict()
+        for prods in self.prods_of_symbol:
+            for prod in prods:
+                below = set()
+                for i in prod.nonterminal_ids:
+                    below |= {i} | reachable[i]
+                if owners[prod.prod_id] & below:
+                    recursion_bits.setdefault(prod.prod_id, 1 << len(recursion_bits))
+        for prods in self.prods_of_symbol:
+            for prod in prods:
+                prod.recursion_bit = recursion_bits.get(prod.prod_id, 0)
+
+    def get_allowed_productions(
+        self, sym_id: int, depth: int, black_list: int
+    ) -> list[Production]:
+        """
+        Productions that a symbol can be expanded with, at remaining `depth`,
+        below the productions in `black_list`. These are the rules
+        of generation: a production cannot be used again below itself, and at
+        depth 0 only productions without non-terminals can be used.
+        """
+        if depth == 0:
+            return self.terminal_only_prods_of_symbol[sym_id]
+        if black_list == 0:
+            return self.prods_of_symbol[sym_id]
+        return [
+            prod
+            for prod in self.prods_of_symbol[sym_id]
+            if not prod.recursion_bit & black_list
+        ]
 
-        if recur_depth == 0:
-            # do not have budget anymore - try to find a terminal
-            found_terminal = self.find_terminals_in_symbol_prods(
-                symbol, recur_depth, is_random
+    def count_derivations(self, sym_id: int, depth: int, black_list: int) -> int:
+        """
+        Exact number of derivations from a symbol, at remaining `depth`, below
+        the productions in `black_list`.
+        """
+        key = (sym_id, depth, black_list)
+        if key not in self.count_cache:
+            self.count_cache[key] = sum(
+                self.count_prod_derivations(prod, depth, black_list)
+                for prod in self.get_allowed_productions(sym_id, depth, black_list)
             )
-            if found_terminal is None:
-                # reach this symbol with 0 depth, but no sentences can be constructed
-                return None, []
-
-            string, prod = found_terminal
-            # got some sentence
-            return string, [prod]
-
-        curr_prod = remaining_prods_this_lvl[0]
-        black_list.append(curr_prod)
-        sentence_res = ""
-        prod_list_res = [curr_prod]
-
-        for sym in curr_prod.get_symbol_list():
-            if self.is_nonterminal(sym):
-                sym_prod_list: ProductionList = self.sym_to_prods[sym]
-                # go to next (deeper) level
-                shuffled_prods = sym_prod_list.get_shuffled_productions_only(
-                    recur_depth - 1, is_random
-                )
-                # remove all black listed productions
-                for prod in black_list:
-                    if prod in shuffled_prods:
-                        shuffled_prods.remove(prod)
-
-                # random.shuffle(sym_prods)
-                subsentence, used_prods = self.gen_random_helper(
-                    sym, recur_depth - 1, shuffled_prods, black_list.copy(), is_random
-                )
-                while subsentence is None and len(shuffled_prods) > 1:
-                    # walking this subtree with this production failed
-                    shuffled_prods = shuffled_prods[1:]
-                    subsentence, used_prods = self.gen_random_helper(
-                        sym,
-                        recur_depth - 1,
-                        shuffled_prods,
-                        black_list.copy(),
-                        is_random,
-                    )
-
-                if subsentence is None:
-                    # tried all productions with this sym at this depth, but none worked
-                    return None, []
-                else:
-                    sentence_res += subsentence
-                    prod_list_res = prod_list_res + used_prods
-            else:  # terminal symbol
-                sentence_res += sym + " "
-
-        return sentence_res, prod_list_res
+        return self.count_cache[key]
+
+    def count_prod_derivations(
+        self, prod: Production, depth: int, black_list: int
+    ) -> int:
+        """
+        Same as `count_derivations`, but for one (allowed) production of the symbol.
+        """
+        child_black_list = black_list | prod.recursion_bit
+        count = 1
+        for i in prod.nonterminal_ids:
+            count *= self.count_derivations(i, depth - 1, child_black_list)
+            if count == 0:
+                break
+        return count
+
+    def get_feasible_productions(
+        self, sym_id: int, depth: int, black_list: int
+    ) -> tuple[list[Production], np.ndarray]:
+        """
+        Allowed productions of a symbol that can derive a sentence, at remaining
+        `depth`, below the productions in `black_list`.
+        :return: the productions, and their indices in the production list.
+        """
+        key = (sym_id, depth, black_list)
+        if key not in self.feasible_cache:
+            prod_list = self.prod_lists[sym_id]
+            assert prod_list is not None
+            prods = [
+                prod
+                for prod in self.get_allowed_productions(sym_id, depth, black_list)
+                if self.is_prod_derivable(prod, depth, black_list)
+            ]
+            indices = np.array(
+                [prod_list.prod_index[prod] for prod in prods], dtype=np.intp
+            )
+            self.feasible_cache[key] = (prods, indices)
+        return self.feasible_cache[key]
 
-    def gen_random(
-        self, recur_depth: int, is_random: bool
-    ) -> tuple[str | None, list[Production]]:
-        assert self.starting_nonterminal is not None
+    def is_derivable(self, sym_id: int, depth: int, black_list: int) -> bool:
+        return len(self.get_feasible_productions(sym_id, depth, black_list)[0]) > 0
 
-        starting_prod_list: ProductionList = self.sym_to_prods[
-            self.starting_nonterminal
-        ]
-        shuffled_starting_prods = starting_prod_list.get_shuffled_productions_only(
-            recur_depth - 1, is_random
-        )
-        return self.gen_random_helper(
-            self.starting_nonterminal,
-            recur_depth - 1,
-            shuffled_starting_prods,
-            [],
-            is_random,
+    def is_prod_derivable(self, prod: Production, depth: int, black_list: int) -> bool:
+        child_black_list = black_list | prod.recursion_bit
+        return all(
+            self.is_derivable(i, depth - 1, child_black_list)
+            for i in prod.nonterminal_ids
         )
 
     def estimate_size(self, symbol, recur_depth):
         """
-        NOTE: this function is currently not accurate.
-        Estimate the size (i.e. number of sentences) that can be generated from each
-        production for the symbol.
-        While estimating for each production, return count for the symbol
-        (which is the sum of each production).
-        """
-        # Cache for the base cases have been pre-filled.
-
-        prod_list: ProductionList = self.sym_to_prods[symbol]
-        overall_count = 0
-
-        for prod in prod_list.get_productions_only():
-            # for each rhs production, estimate the size, update cache,
-            # and sum the numbers together as the result for lhs
-            # use one coin to go from lhs to rhs
-            depth_left = recur_depth - 1
-            # first try to query cache for this one
-            cached_res = prod_list.query_prod_cache(prod, depth_left)
-            if cached_res != -1:
-                # updated before
-                overall_count += cached_res
+        Number of sentences that can be generated from the symbol, when generation
+        starts with `recur_depth` (as in `gen_random`).
+        This is the exact number of derivations. It is the number of distinct
+        sentences, unless patch ingredients happen to spell out the same text
+        (e.g. an exit statement identical to a generated return).
+        """
+        return self.count_derivations(self.symbol_ids[symbol], recur_depth - 1, 0)
+
+    def unrank(self, rank: int, recur_depth: int) -> tuple[str, list[Production]]:
+        """
+        Directly construct the `rank`-th derivation of the starting symbol, in
+        the order used by `count_derivations`.
+        :return: (sentence, productions used), same as `gen_random`.
+        """
+        assert self.starting_nonterminal is not None
+        assert 0 <= rank < self.estimate_size(self.starting_nonterminal, recur_depth)
+
+        sentence = ""
+        used_prods = []
+        # pending symbols, in reverse order: terminals (str), or
+        # non-terminals with their depth, black list and rank
+        start_id = self.symbol_ids[self.starting_nonterminal]
+        stack: list = [(start_id, recur_depth - 1, 0, rank)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                sentence += item + " "
                 continue
+            sym_id, depth, black_list, rank = item
+            for prod in self.get_allowed_productions(sym_id, depth, black_list):
+                count = self.count_prod_derivations(prod, depth, black_list)
+                if rank < count:
+                    break
+                rank -= count
+            used_prods.append(prod)
+
+            # split the rank among the children; leftmost child is the most significant
+            child_black_list = black_list | prod.recursion_bit
+            children = []
+            for sym, i in zip(reversed(prod.rule), reversed(prod.symbol_ids)):
+                if not self.is_nonterminal_id[i]:
+                    children.append(sym)
+                    continue
+                count = self.count_derivations(i, depth - 1, child_black_list)
+                rank, child_rank = divmod(rank, count)
+                children.append((i, depth - 1, child_black_list, child_rank))
+            stack.extend(children)
+
+        return sentence, used_prods
 
-            # this prod-depth was not cached
-            prod_res_count = 0
-            for sym in prod.get_symbol_list():
-                if self.is_terminal(sym):
-                    prod_res_count = patch_utils.concat_one_to_all_estimate_size(
-                        prod_res_count
-                    )
-                elif self.is_nonterminal(sym):
-                    child_res_count = self.estimate_size(sym, depth_left)
-                    if child_res_count > 0:
-                        prod_res_count = patch_utils.concat_two_lists_estimate_size(
-                            prod_res_count, child_res_count
-                        )
-                    else:
-                        # no count for this child symbol
-                        #  => this prod cannot become a sentence, with current depth_left
-                        prod_res_count = 0
-                        break
-            # finished processing one Production => cache this result
-            prod_list.update_single_prod_cache(prod, depth_left, prod_res_count)
-            overall_count += prod_res_count
-
-        return overall_count
-
-    def fill_prod_cache_for_base_cases(self):
-        """
-        If a Production is just one terminal symbol, its cache should be 1 for all depths.
-        Else, its cache for depth 0 should be 0.
+    def rank(self, used_prods: list[Production], recur_depth: int) -> int:
         """
-        for symbol in self.sym_to_prods:
-            prod_list: ProductionList = self.sym_to_prods[symbol]
+        Inverse of `unrank`: the rank of the derivation that used `used_prods`.
+        """
+        assert self.starting_nonterminal is not None
+        prods_iter = iter(used_prods)
+        start_id = self.symbol_ids[self.starting_nonterminal]
+        return self.rank_helper(start_id, recur_depth - 1, 0, prods_iter)
+
+    def rank_helper(self, sym_id: int, depth: int, black_list: int, prods_iter) -> int:
+        used_prod = next(prods_iter)
+        offset = 0
+        for prod in self.get_allowed_productions(sym_id, depth, black_list):
+            if prod == used_prod:
+                break
+            offset += self.count_prod_derivations(prod, depth, black_list)
+
+        child_black_list = black_list | used_prod.recursion_bit
+        rank = 0
+        for i in used_prod.nonterminal_ids:
+            count = self.count_derivations(i, depth - 1, child_black_list)
+            child_rank = self.rank_helper(i, depth - 1, child_black_list, prods_iter)
+            rank = rank * count + child_rank
+        return offset + rank
+
+    def fill_prod_cache(self, depth: int):
+        """
+        Fill the production cache with exact counts, for each depth.
+        """
+        for prod_list in self.sym_to_prods.values():
             for prod in prod_list.get_productions_only():
-                sym_list = prod.get_symbol_list()
-                if len(sym_list) == 1 and self.is_terminal(sym_list[0]):
-                    # Found it. Update cache for all depths
-                    prod_list.update_single_prod_cache_all_depth(prod, 1)
-                else:
-                    prod_list.update_single_prod_cache(prod, 0, 0)
+                for d in range(depth + 1):
+                    count = 0
+                    if d > 0 or prod.is_terminal_only:
+                        count = self.count_prod_derivations(prod, d, 0)
+                    prod_list.update_single_prod_cache(prod, d, count)
 
     def print_all_prod_cache(self):
         for symbol in self.sym_to_prods:
@@ -688,6 +788,7 @@ class CFG:
         """
         for prod_list in self.sym_to_prods.values():
             prod_list.update_probabilities_based_on_cache()
+        self.version += 1
 
     def cache_results(self, symbol, recur_depth, result):
         if symbol not in self.symbol_cache:
@@ -695,16 +796,17 @@ class CFG:
         self.symbol_cache[symbol][recur_depth] = result
 
     def is_nonterminal(self, symbol):
-        return symbol in self.non_terminals
+        return symbol in self.non_terminal_set
 
     def is_terminal(self, symbol):
-        return symbol not in self.non_terminals
+        return symbol not in self.non_terminal_set
 
     def reset_probabilities(self, depth):
         for prod_list in self.sym_to_prods.values():
             prod_list.init_baseline_probabilities(depth)
             prod_list.init_prod_weights()
             prod_list.set_default_cache_value(depth)
+        self.version += 1
 
         # return a state of the current grammar (w. probabilities updated)
         grammar_state = self.get_grammar_state()
@@ -719,13 +821,17 @@ class CFG:
         """
         For each production in prods, update its probabilities.
         """
+        prods_to_update_set = set(prods_to_update)
         for prod_list in self.sym_to_prods.values():
             prod_list_prods = prod_list.get_productions_only()
-            common_prods = [prod for prod in prod_list_prods if prod in prods_to_update]
+            common_prods = [
+                prod for prod in prod_list_prods if prod in prods_to_update_set
+            ]
             if not common_prods:
                 continue
             # has common ones; this prod list should be updated
             prod_list.update_probabilities(common_prods, pe_increment, ppie_increment)
+        self.version += 1
 
         # return a state of the current grammar (w. probabilities updated)
         grammar_state = self.get_grammar_state()
@@ -763,9 +869,12 @@ class CFG:
         """
         For each production in prods, update its weights.
         """
+        prods_to_update_set = set(prods_to_update)
         for prod_list in self.sym_to_prods.values():
             prod_list_prods = prod_list.get_productions_only()
-            common_prods = [prod for prod in prod_list_prods if prod in prods_to_update]
+            common_prods = [
+                prod for prod in prod_list_prods if prod in prods_to_update_set
+            ]
             if not common_prods:
                 continue
             # has common ones; the common ones should be updated
@@ -776,3 +885,4 @@ class CFG:
     def update_probabilities_based_on_weights(self):
         for prod_list in self.sym_to_prods.values():
             prod_list.update_probabilities_based_on_weights()
+        self.version += 1
@@ -1,3 +1,4 @@
+import difflib
 import itertools
 import os
 import shutil
@@ -5,6 +6,12 @@ import shutil
 from app import utilities, values
 
 patch_counter = 0
+# distinguishes patch names from processes that repair different locations concurrently
+patch_name_prefix = ""
+# (backup file path, its lines); the unpatched content patches are woven into
+original_lines: tuple[str, list[str]] | None = None
+# fix files that this process has written patched content to
+patched_files: set[str] = set()
 
 
 def concat_str_to_all(all_items, new_str):
@@ -66,55 +73,111 @@ def get_new_patch_file_name():
     """
     global patch_counter
     patch_counter = patch_counter + 1
-    new_name = os.path.join(values.DIR_RUNTIME_REPAIR, str(patch_counter) + ".patch")
+    new_name = os.path.join(
+        values.DIR_RUNTIME_REPAIR, patch_name_prefix + str(patch_counter) + ".patch"
+    )
     return new_name
 
 
+def get_original_lines() -> list[str]:
+    """
+    Lines (with line endings) of the unpatched fix file, read from the backup once.
+    """
+    global original_lines
+    backup_path = values.FIX_FILE_PATH_BACKUP
+    if original_lines is None or original_lines[0] != backup_path:
+        # keep line endings and undecodable bytes as they are, to write them back verbatim
+        with open(
+            backup_path, encoding="utf-8", errors="surrogateescape", newline=""
+        ) as f:
+            original_lines = (backup_path, f.readlines())
+    return original_lines[1]
+
+
+def write_fix_file(lines: list[str]):
+    with open(
+        values.FIX_FILE_PATH_ORIG,
+        "w",
+        encoding="utf-8",
+        errors="surrogateescape",
+        newline="",
+    ) as f:
+        f.writelines(lines)
+    patched_files.add(values.FIX_FILE_PATH_ORIG)
+
+
 def restore_file_to_unpatched_state():
     """
     Restore the original file to the unpatched state.
+    Nothing is done if the file has not been patched by this process.
     """
+    if values.FIX_FILE_PATH_ORIG not in patched_files:
+        return
     shutil.copyfile(values.FIX_FILE_PATH_BACKUP, values.FIX_FILE_PATH_ORIG)
+    patched_files.discard(values.FIX_FILE_PATH_ORIG)
+
 
+def insert_at_line_start(lines: list[str], line_num: int, content: str):
+    if 1 <= line_num <= len(lines):
+        lines[line_num - 1] = content + lines[line_num - 1]
 
-def weave_patch_instruction(patch_inst: str, start_line_num: int, end_line_num):
+
+def insert_at_line_end(lines: list[str], line_num: int, content: str):
+    if 1 <= line_num <= len(lines):
+        line = lines[line_num - 1]
+        body = line.rstrip("\r\n")
+        lines[line_num - 1] = body + content + line[len(body) :]
+
+
+def make_unified_diff(
+    old_lines: list[str], new_lines: list[str], old_path: str, new_path: str
+) -> str:
+    """
+    Same as `diff -u old_path new_path`, without timestamps in the header.
+    """
+    diff = ""
+    for line in difflib.unified_diff(old_lines, new_lines, old_path, new_path):
+        if not line.endswith("\n"):
+            # last line of a file without newline at the end
+            line += "\n\\ No newline at end of file\n"
+        diff += line
+    return diff
+
+
+def weave_patch_instruction(
+    patch_inst: str,
+    start_line_num: int,
+    end_line_num,
+    patch_file_path: str | None = None,
+):
     """
     Decode patch instruction based on the patch grammar, weave it into the original file, and produce a diff file representing the patch.
+    The patch is always woven into the unpatched content, no matter what is in the file at the moment.
+    :param patch_file_path: where the diff file should be written; a new name is picked if not given.
     """
+    original = get_original_lines()
+    patched = list(original)
     if patch_inst.startswith("INSERT FRONT"):
         patch_content = patch_inst[13:]
-        # do sed escape for patch content
-        patch_content = patch_content.replace("&", r"\&")
-        cmd = f"sed -i -e '{start_line_num}s:^:{patch_content} :' {values.FIX_FILE_PATH_ORIG}"
-        utilities.execute_command(cmd)
+        insert_at_line_start(patched, start_line_num, patch_content + " ")
     elif patch_inst.startswith("INSERT BACK"):
         patch_content = patch_inst[12:]
-        # do sed escape for patch content
-        patch_content = patch_content.replace("&", r"\&")
-        cmd = f"sed -i -e '{end_line_num}s:$: {patch_content}:' {values.FIX_FILE_PATH_ORIG}"
-        utilities.execute_command(cmd)
+        insert_at_line_end(patched, end_line_num, " " + patch_content)
     else:  # patch instruction starts with COND
         patch_content = patch_inst[5:]
         patch_content = "if (" + patch_content + ") {"
-        # do sed escape for patch content
-        patch_content = patch_content.replace("&", r"\&")
-        cmd_end = f"sed -i -e '{end_line_num}s:$: }}:' {values.FIX_FILE_PATH_ORIG}"
-        cmd_start = f"sed -i -e '{start_line_num}s:^:{patch_content} :' {values.FIX_FILE_PATH_ORIG}"
-        utilities.execute_command(cmd_end)
-        utilities.execute_command(cmd_start)
+        insert_at_line_end(patched, end_line_num, " }")
+        insert_at_line_start(patched, start_line_num, patch_content + " ")
+    write_fix_file(patched)
 
     # now create patch file
-    patch_file_path = get_new_patch_file_name()
-    diff_cmd = (
-        "diff -u "
-        + values.FIX_FILE_PATH_BACKUP
-        + " "
-        + values.FIX_FILE_PATH_ORIG
-        + " > "
-        + patch_file_path
+    if patch_file_path is None:
+        patch_file_path = get_new_patch_file_name()
+    diff = make_unified_diff(
+        original, patched, values.FIX_FILE_PATH_BACKUP, values.FIX_FILE_PATH_ORIG
     )
-
-    utilities.execute_command(diff_cmd, allow_failure=True)
+    with open(patch_file_path, "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.write(diff)
 
     return patch_file_path
 
@@ -128,4 +191,5 @@ def apply_patch_file(patch_file_path):
 
     # apply the patch file
     patch_cmd = "patch " + values.FIX_FILE_PATH_ORIG + " < " + patch_file_path
+    patched_files.add(values.FIX_FILE_PATH_ORIG)
     utilities.execute_command(patch_cmd)
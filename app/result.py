@@ -102,6 +102,25 @@ class Result:
             self.plausible_prod_rules[rule_signature] = 0
         self.plausible_prod_rules[rule_signature] += 1
 
+    ##### Merging
+    def merge_location_result(self, other, loc):
+        """
+        Merge in the results of repairing `loc`, obtained by another process.
+        `other` should be a copy of this result taken before repair started,
+        so that everything it recorded since then is about `loc` only.
+        """
+        self.loc_resutls[loc] = other.loc_resutls[loc]
+        self.patch_found_time.extend(other.patch_found_time)
+        self.patch_found_time.sort()
+        self.total_resets += other.total_resets
+        for ours, theirs in [
+            (self.stagnated_prod_rules, other.stagnated_prod_rules),
+            (self.used_prod_rules, other.used_prod_rules),
+            (self.plausible_prod_rules, other.plausible_prod_rules),
+        ]:
+            for rule_signature, count in theirs.items():
+                ours[rule_signature] = ours.get(rule_signature, 0) + count
+
     ##### Others
     def specify_avg_validation_time(self, t: float):
         self.average_validation_time = t
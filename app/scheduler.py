@@ -0,0 +1,155 @@
+"""
+Adaptive scheduling of the time budget across fix locations.
+Instead of giving each location an equal share up front, repair loops of all
+locations are interleaved in time slices. Each slice goes to the location that
+currently looks most promising, judged by the rewards its patches receive.
+"""
+
+import math
+
+from app import emitter, repair, utilities, values
+from app.equivalence.cluster import Cluster, ClusterManager, RewardType
+from app.workers import PatchEvaluationPool
+
+# how much a patch is worth to the scheduler, based on the cluster it falls into
+REWARD_OF_INCREMENT = {RewardType.BIG: 0.5, RewardType.SMALL: 0.25, RewardType.NO: 0}
+
+
+def get_cluster_reward(cluster: Cluster) -> float:
+    if cluster.is_locally_good:
+        return 1
+    return max(
+        REWARD_OF_INCREMENT[cluster.pe_increment],
+        REWARD_OF_INCREMENT[cluster.ppie_increment],
+    )
+
+
+class ScheduledLocation:
+    """
+    A location being repaired, together with what the scheduler knows about it.
+    """
+
+    def __init__(self, location: repair.LocationRepair):
+        self.location = location
+        self.num_slices = 0
+        # number of stagnations since the last new locally good cluster
+        self.num_stagnations = 0
+        self.num_good_clusters = 0
+
+    def get_reward_rate(self) -> float:
+        """
+        Average reward of the patches generated at this location so far.
+        """
+        cluster_manager = self.location.cluster_manager
+        num_patches = cluster_manager.get_total_num_patches()
+        if num_patches == 0:
+            return 0
+        total_reward = sum(
+            get_cluster_reward(c) * c.get_num_patches()
+            for c in cluster_manager.clusters
+        )
+        return total_reward / num_patches
+
+    def is_stagnating(self) -> bool:
+        return self.num_stagnations >= values.SCHEDULER_STAGNATION_LIMIT
+
+    def run_slice(self, time_budget: float, pool: PatchEvaluationPool | None):
+        num_stagnated_before = len(values.STAGNATED_PROD_RULES)
+        self.location.run(time_budget, pool)
+        self.num_slices += 1
+
+        num_good_clusters = len(
+            [c for c in self.location.cluster_manager.clusters if c.is_locally_good]
+        )
+        if num_good_clusters > self.num_good_clusters:
+            self.num_good_clusters = num_good_clusters
+            self.num_stagnations = 0
+        else:
+            self.num_stagnations += (
+                len(values.STAGNATED_PROD_RULES) - num_stagnated_before
+            )
+
+
+class LocationScheduler:
+    """
+    Hands out time slices to locations, treating them as arms of a bandit (UCB1):
+    a location is picked by its average patch reward, plus a bonus for having
+    been tried less often.
+    Exhausted locations are dropped; stagnating ones only get time when no
+    other location is left.
+    """
+
+    def __init__(self, locations: list[repair.LocationRepair], slice_length: float):
+        self.scheduled = [ScheduledLocation(loc) for loc in locations]
+        self.slice_length = slice_length
+
+    def get_score(self, scheduled: ScheduledLocation, total_slices: int) -> float:
+        if scheduled.num_slices == 0:
+            return math.inf
+        exploration = math.sqrt(2 * math.log(total_slices) / scheduled.num_slices)
+        return scheduled.get_reward_rate() + exploration
+
+    def pick_next(self) -> ScheduledLocation | None:
+        candidates = [s for s in self.scheduled if not s.location.is_exhausted()]
+        active = [s for s in candidates if not s.is_stagnating()]
+        if active:
+            candidates = active
+        if not candidates:
+            return None
+        total_slices = sum(s.num_slices for s in self.scheduled)
+        return max(candidates, key=lambda s: self.get_score(s, total_slices))
+
+    def run(self, pool: PatchEvaluationPool | None = None):
+        """
+        Keep handing out slices until the overall time budget is used up,
+        or all locations are exhausted.
+        """
+        while True:
+            time_left = utilities.global_timer.get_total_remaining_time()
+            if time_left <= 0:
+                emitter.information("Ending repair since time budget is exceeded")
+                break
+            scheduled = self.pick_next()
+            if scheduled is None:
+                emitter.information("Ending repair since all locations are exhausted")
+                break
+            emitter.information(
+                f"Loc {scheduled.location.fix_loc_line}: Scheduled for a time slice "
+                f"(reward rate: {scheduled.get_reward_rate():.3f}, "
+                f"slices so far: {scheduled.num_slices})"
+            )
+            scheduled.run_slice(min(self.slice_length, time_left), pool)
+
+
+def repair_adaptively(
+    fix_loc_lines: list[int],
+    return_stmts: list[str],
+    labels: list[str],
+    pool: PatchEvaluationPool | None = None,
+) -> list[ClusterManager]:
+    """
+    Repair all fix locations, with the time budget shared adaptively.
+    :return: cluster managers, in the order of `fix_loc_lines`.
+    """
+    all_ingredients = repair.collect_patch_ingredients(fix_loc_lines)
+    locations = [
+        repair.LocationRepair(
+            fix_loc_line, return_stmts, labels, all_ingredients[fix_loc_line]
+        )
+        for fix_loc_line in fix_loc_lines
+    ]
+    if utilities.global_timer.is_overall_time_exhausted():
+        utilities.error_exit(
+            "Time budget exceeded before entering the main repair loop. Try increasing the time limit."
+        )
+
+    scheduler = LocationScheduler(locations, values.SCHEDULER_SLICE_LENGTH)
+    scheduler.run(pool)
+
+    for scheduled in scheduler.scheduled:
+        emitter.information(
+            f"Loc {scheduled.location.fix_loc_line}: "
+            f"{scheduled.num_slices} time slices, "
+            f"reward rate {scheduled.get_reward_rate():.3f}"
+        )
+    return [location.finish() for location in locations]
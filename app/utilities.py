@@ -111,6 +111,16 @@ class Timer:
             # first time press pause
             self.elapsed_record[key] = elapsed
 
+    def accumulate(self, key, elapsed: float):
+        """
+        Accumulate a duration that was measured elsewhere (e.g. in a worker process)
+        to one session.
+        """
+        if key in self.elapsed_record:
+            self.elapsed_record[key] += elapsed
+        else:
+            self.elapsed_record[key] = elapsed
+
     def print_and_return(self, key):
         """
         Only print and return time information stored so far.
@@ -181,6 +191,21 @@ def create_dir_if_nonexists(dir_path):
         os.makedirs(dir_path)
 
 
+def remove_dir_contents_except(dir_path, paths_to_keep: list[str]):
+    """
+    Empty `dir_path` (creating it if needed), except for the given direct children.
+    """
+    create_dir_if_nonexists(dir_path)
+    for entry in os.listdir(dir_path):
+        entry_path = os.path.join(dir_path, entry)
+        if entry_path in paths_to_keep:
+            continue
+        if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+            shutil.rmtree(entry_path)
+        else:
+            os.remove(entry_path)
+
+
 def remove_and_create_new_dir(dir_path):
     remove_dir_if_exists(dir_path)
     create_dir_if_nonexists(dir_path)
@@ -13,24 +13,19 @@ INFER_PATH = ""
 DIR_RUNTIME_PRE = ""
 DIR_RUNTIME_REPAIR = ""
 DIR_CODEQL_DB = ""
+DIR_CODEQL_CACHE = ""  # results of codeql queries; kept as long as the database is
 
 DIR_INFER_OUT_WHOLE = ""  # output dir for Infer whole program analysis
 DIR_INFER_OUT_SINGLE = ""  # output dir for Infer single function analysis
 DIR_INFER_OUT_VALIDATION = ""  # output dir for Infer validation analysis
+DIR_WORKERS = ""  # where the per-worker copies of the source tree are placed
+DIR_SUMMARY_CACHE = ""  # Infer summaries of patched files; kept across repair runs
 INFER_CHANGED_FILES = ""
+FILE_COMPILE_COMMANDS = ""  # compilation database recorded in the pre stage
 
 # name of the summary file
 SUMMARY_FILE_NAME = "summary_posts.json"
 
-# codeql result files
-FILE_CODEQL_RES_EXTRACT_VAR = ""
-FILE_CODEQL_RES_STMT_BOUNDARY = ""
-FILE_CODEQL_RES_RETURN_STMTS = ""
-FILE_CODEQL_RES_LABELS = ""
-FILE_CODEQL_RES_LOC_AFTER = ""
-FILE_CODEQL_RES_LOC_BETWEEN = ""
-FILE_CODEQL_RES_CONSTS = ""
-
 
 # fix file
 FIX_FILE_PATH_ORIG = ""
@@ -73,6 +68,10 @@ silence_emitter = False
 
 DEBUG = False
 TOOL_STAGE = "repair"
+CONCURRENT_PRE = False  # build the codeql database and run Infer at the same time
+USE_COMPILATION_DATABASE = False  # build once, and give the compile commands to both
+CODEQL_THREADS = 32  # threads used for building the codeql database
+INFER_JOBS = 16  # parallel jobs of Infer
 GENERATOR_MAX_DEPTH = 10
 
 # adjustment factors
@@ -83,6 +82,17 @@ REPAIR_BUDGET = 20  # default, in mins
 LEARN_PROBABILITIES = True
 VALIDATE_GLOBAL = False
 IS_RESET_PROB = True
+NUM_WORKERS = 1  # number of processes evaluating patches in parallel
+# seconds to wait for the next patch from a worker after the repair loop ends
+WORKER_DRAIN_TIMEOUT = 600
+USE_SUMMARY_CACHE = True
+USE_CODEQL_CACHE = True
+CODEQL_CLEAR_CACHE = False  # recompile codeql queries every time, for benchmarking
+GENERATION_ENGINE = "random"  # how patch instructions are drawn from the grammar
+LOCATION_MODE = "sequential"  # how fix locations share the time budget
+SCHEDULER_SLICE_LENGTH = (
+    60  # in seconds; time slice given to a location in adaptive mode
+)
 
 USED_PROD_RULES = dict()
 STAGNATED_PROD_RULES = []
@@ -90,3 +100,11 @@ PLAUSIBLE_PROD_RULES = dict()
 
 MAX_PLAUSIBLE_THRESHOLD = 5
 MAX_GENERATE_THRESHOLD = 20
+# consecutive duplicate samples, after which a patch is drawn uniformly from the unused ones
+MAX_GENERATION_REJECTIONS = 100
+# in adaptive mode, stagnations without new locally good clusters before a location gives up its time
+SCHEDULER_STAGNATION_LIMIT = 3
+# results of solver queries kept for reuse (least recently used ones are dropped)
+SMT_QUERY_CACHE_SIZE = 100000
+# number of random assignments formulas are evaluated on, to tell them apart without a solver
+SMT_FINGERPRINT_SAMPLES = 64
@@ -0,0 +1,140 @@
+"""
+Evaluate patches in parallel.
+Each worker owns an isolated copy of the source tree (including build artifacts),
+and its own Infer output directory, so that several Infer runs can happen at once.
+"""
+
+import functools
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import signal
+import time
+from os.path import join as pjoin
+
+from app import emitter, infer, values
+from app.repairgen import patch_utils
+
+
+def get_tree_dir(tree_name: str) -> str:
+    return pjoin(values.DIR_WORKERS, tree_name)
+
+
+def prepare_tree(tree_name: str):
+    """
+    Copy the (already built) source tree for one worker, if not copied before.
+    Pre-condition: the fix file in the original tree is in unpatched state.
+    """
+    tree_src_dir = pjoin(get_tree_dir(tree_name), "src")
+    if os.path.isdir(tree_src_dir):
+        return
+    emitter.information(f"Copying source tree for {tree_name}")
+    shutil.copytree(values.CONF_DIR_SRC, tree_src_dir, symlinks=True)
+
+
+def switch_to_tree(tree_name: str):
+    """
+    Point the global configuration of the current process to the copied tree.
+    Should only be called in a process dedicated to this tree.
+    """
+    tree_dir = get_tree_dir(tree_name)
+    values.CONF_DIR_SRC = pjoin(tree_dir, "src")
+    values.CONF_DIR_SRC_BUILD = pjoin(values.CONF_DIR_SRC, values.CONF_BUILD_DIR)
+    values.FIX_FILE_PATH_ORIG = pjoin(values.CONF_DIR_SRC_BUILD, values.CONF_BUG_FILE)
+    values.DIR_INFER_OUT_SINGLE = pjoin(tree_dir, "infer-out-single")
+
+
+def init_worker(tree_names: mp.Queue):
+    """
+    Initializer of each pool process: claim one tree and stay with it.
+    """
+    # the pool is terminated with SIGTERM; no need to go through the main handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    switch_to_tree(tree_names.get())
+
+
+def evaluate_patch(
+    patch_inst: str, start_line_num: int, end_line_num: int, patch_file_path: str
+) -> tuple[str, str | None, float]:
+    """
+    Runs in a worker. Weave the patch into the worker's tree and run Infer on it.
+    :return: (patch file path, summary file path or None, time spent in Infer)
+    """
+    # the summary is consumed by the coordinator later, when this worker may
+    # already be analyzing another patch - give it a name of its own
+    summary_file_path = patch_file_path + "." + values.SUMMARY_FILE_NAME
+    time_start = time.perf_counter()
+    try:
+        patch_utils.weave_patch_instruction(
+            patch_inst, start_line_num, end_line_num, patch_file_path
+        )
+        time_start = time.perf_counter()
+        summary_file_path = infer.infer_target_function(summary_file_path)
+    except Exception as e:
+        # the coordinator is waiting for this patch; report it as not compilable
+        emitter.warning(f"Worker failed to evaluate {patch_file_path}: {e}")
+        summary_file_path = None
+    return patch_file_path, summary_file_path, time.perf_counter() - time_start
+
+
+class PatchEvaluationPool:
+    """
+    A pool of workers; each one weaves and analyzes patches in its own tree.
+    Patch generation and clustering stay with the coordinator (the caller).
+    """
+
+    def __init__(self, num_workers: int, pool_name: str):
+        self.num_workers = num_workers
+        tree_names = [f"{pool_name}-worker-{i}" for i in range(num_workers)]
+        for tree_name in tree_names:
+            prepare_tree(tree_name)
+
+        # fork, so that workers inherit configurations and the parsed target bug
+        ctx = mp.get_context("fork")
+        tree_name_queue = ctx.Queue()
+        for tree_name in tree_names:
+            tree_name_queue.put(tree_name)
+        self.pool = ctx.Pool(
+            num_workers, initializer=init_worker, initargs=(tree_name_queue,)
+        )
+        # evaluated patches are collected here, in the order they finish
+        self.results: queue.Queue[tuple[str, str | None, float]] = queue.Queue()
+
+    def submit(
+        self,
+        patch_inst: str,
+        start_line_num: int,
+        end_line_num: int,
+        patch_file_path: str,
+    ):
+        self.pool.apply_async(
+            evaluate_patch,
+            (patch_inst, start_line_num, end_line_num, patch_file_path),
+            callback=self.results.put,
+            error_callback=functools.partial(self.report_failure, patch_file_path),
+        )
+
+    def report_failure(self, patch_file_path: str, error: BaseException):
+        """
+        Called when a patch could not be evaluated at all; the coordinator is
+        still waiting for it, so report it as not compilable.
+        """
+        emitter.warning(f"Worker failed to evaluate {patch_file_path}: {error}")
+        self.results.put((patch_file_path, None, 0.0))
+
+    def get_result(
+        self, timeout: float | None = None
+    ) -> tuple[str, str | None, float] | None:
+        """
+        Wait for the next evaluated patch.
+        :return: None if nothing finished within `timeout` seconds.
+        """
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()